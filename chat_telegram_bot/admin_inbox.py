@@ -0,0 +1,190 @@
+import asyncio
+import html
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message
+
+from database import Database
+from media_groups import copy_message_ids
+from outbound import Priority, send_priority
+
+
+# --- تنظیمات صندوق پیام ادمین ---
+DIGEST_INTERVAL = 60     # فاصله پیام‌های خلاصه؛ در حالت فوری فاصله تلاش دوباره برای اعلان‌های ناموفق
+DIGEST_MAX_ITEMS = 20    # بقیه موارد به پیام خلاصه بعدی می‌رسند
+PAGE_SIZE = 10
+PREVIEW_LENGTH = 60
+CALLBACK_PREFIX = "ib"
+
+# callback_data:
+#   ib:o:<id>   باز کردن یک مورد؛ متن پیام فقط همین‌جا از چت کاربر کپی می‌شود
+#   ib:r:<id>   پاسخ به یک مورد
+#   ib:d:<id>   بستن مورد بدون پاسخ
+#   ib:l:<filter>:<n|p>:<key>   صفحه‌بندی؛ filter یکی از o (فقط باز) یا a (همه) و key شناسه مرز صفحه
+
+
+def parse_callback(data: str) -> list[str]:
+    return data.split(":")[1:]
+
+
+def user_label(user_id: int, username: str | None) -> str:
+    return f"@{username}" if username else str(user_id)
+
+
+def make_preview(message: Message, album: list[Message] | None = None) -> str:
+    """خلاصه یک‌خطی برای فهرست‌ها تا بدون کپی پیام قابل مرور باشند"""
+    text = message.text or message.caption or ""
+    if not text and album:
+        text = next((m.caption for m in album if m.caption), "")
+    kind = f"[{len(album)} {message.content_type}]" if album else ("" if message.text else f"[{message.content_type}]")
+    preview = " ".join(f"{kind} {text}".split())
+    return preview if len(preview) <= PREVIEW_LENGTH else preview[:PREVIEW_LENGTH - 1] + "…"
+
+
+def item_keyboard(item_id: int, user_id: int, username: str | None, status: str = "open") -> InlineKeyboardMarkup:
+    buttons = [[InlineKeyboardButton(
+        text=f"✍️ پاسخ به {user_label(user_id, username)}", callback_data=f"{CALLBACK_PREFIX}:r:{item_id}"
+    )]]
+    if status == "open":
+        buttons.append([InlineKeyboardButton(text="✅ بستن", callback_data=f"{CALLBACK_PREFIX}:d:{item_id}")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+class AdminInbox:
+    """پیام‌های کاربران به ادمین در جدول admin_inbox ثبت می‌شوند و وضعیت باز/پاسخ‌داده دارند
+
+    در حالت فوری هر پیام مثل قبل با یک copy به ادمین می‌رسد. در حالت خلاصه (digest) فقط ثبت
+    می‌شود و هر DIGEST_INTERVAL ثانیه یک پیام فهرست با دکمه باز کردن هر مورد فرستاده می‌شود،
+    پس هجوم پیام کاربران از سقف ارسال به چت ادمین عبور نمی‌کند.
+    """
+
+    def __init__(self, bot: Bot, db: Database, admin_chat_id: int, digest: bool = False,
+                 interval: float = DIGEST_INTERVAL):
+        self.bot = bot
+        self.db = db
+        self.admin_chat_id = admin_chat_id
+        self.digest = digest
+        self.interval = interval
+        self._sending: set[int] = set()
+
+    async def add(self, message: Message, album: list[Message] | None = None) -> int:
+        """مورد را ثبت می‌کند؛ خطای اعلان فوری فقط ثبت می‌شود و مورد در دور بعدی خلاصه اعلام می‌شود"""
+        user = message.from_user
+        message_ids = [m.message_id for m in album] if album else [message.message_id]
+        item_id = await self.db.add_inbox_item(
+            user.id, user.username, message.chat.id, message_ids, make_preview(message, album), notified=False
+        )
+        if self.digest:
+            return item_id
+
+        self._sending.add(item_id)
+        try:
+            with send_priority(Priority.ADMIN):
+                await copy_message_ids(
+                    self.bot, self.admin_chat_id, message.chat.id, message_ids,
+                    reply_markup=item_keyboard(item_id, user.id, user.username),
+                )
+            await self.db.mark_inbox_notified([item_id])
+        except TelegramAPIError as e:
+            logging.warning(f"Could not notify admin about inbox item {item_id}: {e}")
+        finally:
+            self._sending.discard(item_id)
+        return item_id
+
+    async def send_digest(self) -> int:
+        rows = [row for row in await self.db.get_pending_inbox_items(DIGEST_MAX_ITEMS) if row[0] not in self._sending]
+        if not rows:
+            return 0
+        lines = [f"📥 <b>{len(rows)} پیام تازه در صندوق</b>\n"]
+        buttons = []
+        for item_id, user_id, username, _, _, preview, _, _ in rows:
+            label = user_label(user_id, username)
+            lines.append(f"#{item_id} • {html.escape(label)}: {html.escape(preview)}")
+            buttons.append([InlineKeyboardButton(text=f"📂 #{item_id} {label}", callback_data=f"{CALLBACK_PREFIX}:o:{item_id}")])
+        with send_priority(Priority.ADMIN):
+            await self.bot.send_message(
+                self.admin_chat_id, "\n".join(lines), reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons)
+            )
+        await self.db.mark_inbox_notified([row[0] for row in rows])
+        return len(rows)
+
+    async def run_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.send_digest()
+            except Exception as e:
+                logging.error(f"Admin inbox digest failed: {e}")
+
+    async def open_item(self, item_id: int) -> bool:
+        """متن مورد را از چت کاربر برای ادمین کپی می‌کند؛ False یعنی مورد وجود ندارد"""
+        item = await self.db.get_inbox_item(item_id)
+        if item is None:
+            return False
+        keyboard = item_keyboard(item_id, item["user_id"], item["username"], item["status"])
+        status = "✅ پاسخ داده شده" if item["status"] == "answered" else "🟢 باز"
+        with send_priority(Priority.ADMIN):
+            try:
+                await copy_message_ids(
+                    self.bot, self.admin_chat_id, item["from_chat_id"],
+                    [int(i) for i in item["message_ids"].split(",")],
+                    reply_markup=keyboard, button_text=f"#{item_id} • {status}",
+                )
+            except TelegramAPIError:
+                # کاربر پیام را پاک کرده است؛ خلاصه ذخیره‌شده نمایش داده می‌شود
+                await self.bot.send_message(
+                    self.admin_chat_id,
+                    f"#{item_id} • {status}\nپیام اصلی دیگر در دسترس نیست:\n{html.escape(item['preview'])}",
+                    reply_markup=keyboard,
+                )
+        return True
+
+
+async def build_inbox_page(db: Database, status_filter: str = "o", direction: str = "n",
+                           key: str = "") -> tuple[str, InlineKeyboardMarkup]:
+    """فهرست یک صفحه از صندوق، جدیدترین اول؛ هر صفحه فقط PAGE_SIZE + 1 ردیف می‌خواند"""
+    status = "open" if status_filter == "o" else None
+    backwards = direction == "p"
+    rows = await db.get_inbox_page(
+        status,
+        before=int(key) if key and not backwards else None,
+        after=int(key) if backwards else None,
+        limit=PAGE_SIZE + 1,
+    )
+    more = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if backwards:
+        rows.reverse()
+        has_newer, has_older = more, True
+    else:
+        has_newer, has_older = bool(key), more
+
+    counts = await db.count_inbox_items()
+    lines = [f"<b>📥 صندوق پیام‌ها</b> (باز: {counts.get('open', 0)} | پاسخ داده شده: {counts.get('answered', 0)})\n"]
+    for item_id, user_id, username, _, _, preview, item_status, created_at in rows:
+        mark = "🟢" if item_status == "open" else "✅"
+        lines.append(f"{mark} #{item_id} • {html.escape(user_label(user_id, username))} • {created_at[:16]}\n"
+                     f"    {html.escape(preview)}")
+    if not rows:
+        lines.append("موردی یافت نشد.")
+
+    item_buttons = [
+        InlineKeyboardButton(text=f"📂 #{row[0]}", callback_data=f"{CALLBACK_PREFIX}:o:{row[0]}") for row in rows
+    ]
+    keyboard = [item_buttons[i:i + 5] for i in range(0, len(item_buttons), 5)]
+    navigation = []
+    if rows and has_newer:
+        navigation.append(InlineKeyboardButton(
+            text="⬅️ جدیدتر", callback_data=f"{CALLBACK_PREFIX}:l:{status_filter}:p:{rows[0][0]}"
+        ))
+    if rows and has_older:
+        navigation.append(InlineKeyboardButton(
+            text="قدیمی‌تر ➡️", callback_data=f"{CALLBACK_PREFIX}:l:{status_filter}:n:{rows[-1][0]}"
+        ))
+    if navigation:
+        keyboard.append(navigation)
+    other_filter, other_text = ("a", "📋 همه موارد") if status_filter == "o" else ("o", "🟢 فقط موارد باز")
+    keyboard.append([InlineKeyboardButton(text=other_text, callback_data=f"{CALLBACK_PREFIX}:l:{other_filter}:n:")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -1,13 +1,13 @@
 import asyncio
+import html
 import logging
-import sqlite3
-import datetime
-import hashlib
 import os
 import secrets
+import tempfile
+from datetime import date
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import CommandStart
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import (
@@ -16,12 +16,58 @@ from aiogram.types import (
     KeyboardButton,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    BufferedInputFile,
     CallbackQuery,
+    FSInputFile,
     ReplyKeyboardRemove,
+    User,
 )
 from aiogram.client.default import DefaultBotProperties
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramAPIError
-from aiogram.enums import ChatMemberStatus
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.dispatcher.event.handler import HandlerObject
+
+from admin_inbox import AdminInbox, build_inbox_page
+from admin_inbox import parse_callback as parse_inbox_callback
+from broadcast import BroadcastEngine
+from database import DB_PATH, READER_COUNT, Database
+from floodcontrol import FloodControlMiddleware, FloodLimiter
+from fsm_storage import SQLiteStorage, count_states, create_fsm_storage
+from identity import IdentityCache
+from inbound import MAX_CONCURRENT_UPDATES, MAX_QUEUED_UPDATES, SHED_POLICY, UpdateScheduler
+from lifecycle import SHUTDOWN_TIMEOUT, Lifecycle, snapshot_path
+from media_groups import MediaGroupMiddleware, copy_content
+from membership import RECONCILE_WARM_DELAY, ForceSubGate, MembershipCache
+from metrics import (
+    ApiMetricsMiddleware,
+    HandlerTimingMiddleware,
+    TimedMiddleware,
+    UpdateTimingMiddleware,
+    format_summary,
+    registry,
+    serve_metrics,
+    set_metrics_instance,
+)
+from outbound import GLOBAL_RATE, OutboundMiddleware, OutboundScheduler, Priority, send_priority
+from profiler import MAX_PROFILE_SECONDS, PROFILE_MODES, is_running as profile_running, run_profile
+from retention import MessageRetention
+from stats import HISTORY_DAYS, StatsDashboard, format_history
+from tracing import Tracer
+from user_browser import EXPORT_CALLBACK, SEARCH_CALLBACK, build_user_page, export_users_csv, parse_callback
+from webhook import load_webhook_settings, run_webhook_workers, serve_webhook
+from writebehind import WriteBehind
+
+
+# در حالت چند رباتی (tenants.py) هر ربات نسخه جدایی از این ماژول است و این مقادیر را جداگانه می‌گیرد
+TENANT_NAME = None
+# هر ربات ردیابی‌های خودش را دارد
+tracer = Tracer()
+DB_READERS = READER_COUNT
+UPDATE_SHED_POLICY = SHED_POLICY
+
+# پروفایل‌های در حال اجرا (پنل ⏱ عملکرد)
+profile_tasks: set[asyncio.Task] = set()
 
 
 # --- State ها ---
@@ -32,72 +78,13 @@ class Form(StatesGroup):
     sending_message_to_admin = State()
     replying_to_user = State()
     getting_broadcast_message = State()
+    user_search = State()
     force_sub_add_channel = State()
     force_sub_add_link = State()
     force_sub_add_button_text = State()
     force_sub_remove = State()
 
 
-# --- توابع پایگاه داده و هش ---
-def setup_database():
-    conn = sqlite3.connect("anonymous_chat.db")
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            hashed_id TEXT PRIMARY KEY,
-            user_id INTEGER UNIQUE NOT NULL,
-            username TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sender_hashed_id TEXT,
-            recipient_hashed_id TEXT,
-            telegram_message_id INTEGER,
-            FOREIGN KEY (sender_hashed_id) REFERENCES users(hashed_id),
-            FOREIGN KEY (recipient_hashed_id) REFERENCES users(hashed_id)
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS force_sub_targets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            target TEXT UNIQUE NOT NULL,
-            type TEXT NOT NULL, -- 'channel' or 'link'
-            button_text TEXT NOT NULL
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-def get_hashed_id(user_id: int, salt: str) -> str:
-    return hashlib.sha256(f"{user_id}{salt}".encode()).hexdigest()[:12]
-
-def db_get_user_id_by_hash(hashed_id: str) -> int | None:
-    conn = sqlite3.connect("anonymous_chat.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM users WHERE hashed_id = ?", (hashed_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
-
-def db_get_user_by_username(username: str) -> int | None:
-    conn = sqlite3.connect("anonymous_chat.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM users WHERE LOWER(username) = LOWER(?)", (username,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
-
-def db_get_force_sub_targets() -> list:
-    conn = sqlite3.connect("anonymous_chat.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT target, type, button_text FROM force_sub_targets")
-    targets = cursor.fetchall()
-    conn.close()
-    return targets
-
 # --- کیبوردها ---
 main_keyboard = ReplyKeyboardMarkup(
     keyboard=[
@@ -109,13 +96,23 @@ main_keyboard = ReplyKeyboardMarkup(
 
 admin_keyboard = ReplyKeyboardMarkup(
     keyboard=[
-        [KeyboardButton(text="📢 پیام همگانی")],
+        [KeyboardButton(text="📢 پیام همگانی"), KeyboardButton(text="📥 صندوق پیام‌ها")],
         [KeyboardButton(text="👥 لیست کاربران"), KeyboardButton(text="📊 آمار فعالیت")],
-        [KeyboardButton(text="🔒 مدیریت عضویت اجباری")],
+        [KeyboardButton(text="🔒 مدیریت عضویت اجباری"), KeyboardButton(text="⏱ عملکرد")],
     ],
     resize_keyboard=True,
 )
 
+performance_keyboard = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="🔬 cProfile ۳۰ ثانیه", callback_data="pf:cprofile:30"),
+            InlineKeyboardButton(text="🎯 نمونه‌برداری ۳۰ ثانیه", callback_data="pf:sample:30"),
+        ],
+        [InlineKeyboardButton(text="🐢 آپدیت‌های کند و ردیابی‌ها", callback_data="pf:traces")],
+    ]
+)
+
 force_sub_keyboard = ReplyKeyboardMarkup(
     keyboard=[
         [KeyboardButton(text="➕ افزودن کانال/گروه"), KeyboardButton(text="🔗 افزودن لینک")],
@@ -132,22 +129,19 @@ class SubscriptionMiddleware:
         if not user or user.id == ADMIN_USER_ID:
             return await handler(event, data)
 
-        targets = db_get_force_sub_targets()
-        if not targets:
+        gate = force_sub_gate.current
+        if not gate.targets:
             return await handler(event, data)
 
-        unsubscribed_targets = []
-        for target, target_type, button_text in targets:
-            if target_type == 'channel':
-                try:
-                    member = await bot.get_chat_member(chat_id=target, user_id=user.id)
-                    if member.status not in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]:
-                        unsubscribed_targets.append((target, target_type, button_text))
-                except (TelegramBadRequest, TelegramAPIError):
-                    logging.warning(f"Bot is not admin in {target}. Trusting user {user.id} click.")
-                    unsubscribed_targets.append((target, target_type, button_text))
-            else: # برای لینک‌ها
-                unsubscribed_targets.append((target, target_type, button_text))
+        # با زدن «عضو شدم» وضعیت عضویت از تلگرام تازه‌سازی می‌شود
+        refresh = isinstance(event, CallbackQuery) and event.data == "check_sub"
+        membership = await membership_cache.check_channels(user.id, gate.channels, refresh=refresh)
+
+        unsubscribed_targets = [
+            (target, target_type, button_text)
+            for target, target_type, button_text in gate.targets
+            if target_type != 'channel' or not membership[target]
+        ]
 
         # اگر کاربر در تمام کانال‌ها عضو بود و فقط لینک باقی مانده بود
         if not any(t[1] == 'channel' for t in unsubscribed_targets) and any(t[1] == 'link' for t in unsubscribed_targets):
@@ -158,28 +152,69 @@ class SubscriptionMiddleware:
                 return
 
         if unsubscribed_targets:
-            join_buttons = [
-                [InlineKeyboardButton(text=btn_text, url=f"https://t.me/{tgt.lstrip('@')}" if not tgt.startswith("http") else tgt)]
-                for tgt, t_type, btn_text in targets
-            ]
-            join_buttons.append([InlineKeyboardButton(text="✅ عضو شدم", callback_data="check_sub")])
-            keyboard = InlineKeyboardMarkup(inline_keyboard=join_buttons)
-
             text_to_send = "برای استفاده از ربات، لطفاً مراحل زیر را تکمیل کنید:"
             if isinstance(event, Message):
-                await event.answer(text_to_send, reply_markup=keyboard)
+                await event.answer(text_to_send, reply_markup=gate.keyboard)
             elif isinstance(event, CallbackQuery):
                 await event.answer("شما هنوز تمام مراحل عضویت را تکمیل نکرده‌اید.", show_alert=True)
             return
 
         return await handler(event, data)
 
+# --- کلاس‌بندی آپدیت‌ها برای کنترل سیل پیام ---
+ANONYMOUS_FLOW_STATES = {Form.getting_recipient_id.state, Form.sending_message.state, Form.getting_reply.state}
+
+def flood_action(event, data) -> str | None:
+    user = data.get('event_from_user')
+    if not user or user.id == ADMIN_USER_ID:
+        return None
+    if isinstance(event, CallbackQuery):
+        return "callback"
+    # کنترل سیل پیش از جمع شدن آلبوم اجرا می‌شود؛ کل آلبوم یک بار (با اولین جزء) شمرده می‌شود
+    if media_group_collector.collecting(event):
+        return None
+    raw_state = data.get('raw_state')
+    if raw_state in ANONYMOUS_FLOW_STATES or event.text == "📨 ارسال به کاربر":
+        return "anonymous"
+    if raw_state == Form.sending_message_to_admin.state or event.text == "📞 ارتباط با ادمین":
+        return "admin_contact"
+    return "message"
+
+# --- Middleware برای به‌روز نگه داشتن نام کاربری ---
+class UsernameMiddleware:
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user:
+            await identity_cache.observe_username(user.id, user.username)
+        return await handler(event, data)
+
 # --- Handlers ---
+# هندلری که متد تلگرام را برمی‌گرداند (return message.answer(...)) در حالت webhook پاسخ را
+# داخل پاسخ HTTP همان آپدیت می‌فرستد؛ چنین ارسالی از session و در نتیجه از OutboundScheduler،
+# متریک‌های API و تشخیص کاربر بلاک‌کننده عبور نمی‌کند و خطای آن هم دیده نمی‌شود. پس فقط
+# پاسخ کوتاه و ثابت به کاربری که همین حالا پیام داده برگردانده می‌شود؛ متن با طول متغیر یا
+# هر ارسالی که نتیجه‌اش مهم است با await فرستاده می‌شود.
 
 async def register_handlers(dp: Dispatcher):
     # Middleware
-    dp.message.middleware(SubscriptionMiddleware())
-    dp.callback_query.middleware(SubscriptionMiddleware())
+    # آپدیت‌های در حال پردازش برای خاموش شدن منظم شمرده می‌شوند
+    dp.update.outer_middleware(lifecycle)
+    # صف و سقف پردازش پیش از اندازه‌گیری زمان آپدیت تا انتظار صف جدا (bot_update_queue_wait_seconds) ثبت شود
+    dp.update.outer_middleware(update_scheduler)
+    dp.update.outer_middleware(UpdateTimingMiddleware(tracer))
+    # اولین middleware پیام و callback تا آپدیت‌های محدودشده نه منتظر آلبوم بمانند، نه نام کاربری
+    # بنویسند و نه هیچ get_chat_member یا کوئری‌ای هزینه کنند
+    flood_control = TimedMiddleware("flood", FloodControlMiddleware(flood_limiter, flood_action))
+    dp.message.outer_middleware(flood_control)
+    dp.callback_query.outer_middleware(flood_control)
+    # اجزای آلبوم پیش از بقیه middlewareهای پیام یکی می‌شوند و هندلرها آن را در پارامتر album می‌گیرند
+    dp.message.outer_middleware(TimedMiddleware("album", media_group_collector))
+    dp.message.outer_middleware(TimedMiddleware("username", UsernameMiddleware()))
+    dp.message.middleware(TimedMiddleware("subscription", SubscriptionMiddleware()))
+    dp.callback_query.middleware(TimedMiddleware("subscription", SubscriptionMiddleware()))
+    # پس از SubscriptionMiddleware ثبت می‌شود تا فقط زمان خود هندلر اندازه‌گیری شود
+    dp.message.middleware(HandlerTimingMiddleware())
+    dp.callback_query.middleware(HandlerTimingMiddleware())
 
     # User Handlers
     dp.message.register(command_start_handler, CommandStart())
@@ -193,14 +228,26 @@ async def register_handlers(dp: Dispatcher):
     dp.message.register(send_reply_message, Form.getting_reply)
     dp.message.register(cancel_handler, F.text == "/cancel")
     dp.callback_query.register(check_sub_callback, F.data == "check_sub")
+    # ثبت این دو هندلر باعث می‌شود chat_member و my_chat_member در allowed_updates درخواست شوند
+    # (start_polling و serve_webhook هر دو از resolve_used_update_types استفاده می‌کنند)
+    dp.chat_member.register(membership_cache.on_member_updated)
+    dp.my_chat_member.register(membership_cache.on_bot_member_updated)
 
     # Admin Handlers
     dp.callback_query.register(handle_admin_reply_button, F.data.startswith("admin_reply_"))
     dp.message.register(send_admin_reply_to_user, Form.replying_to_user)
+    dp.message.register(show_inbox, F.from_user.id == ADMIN_USER_ID, F.text == "📥 صندوق پیام‌ها")
+    dp.callback_query.register(inbox_callback, F.from_user.id == ADMIN_USER_ID, F.data.startswith("ib:"))
     dp.message.register(broadcast_start, F.from_user.id == ADMIN_USER_ID, F.text == "📢 پیام همگانی")
     dp.message.register(process_broadcast, F.from_user.id == ADMIN_USER_ID, Form.getting_broadcast_message)
     dp.message.register(get_user_list, F.from_user.id == ADMIN_USER_ID, F.text == "👥 لیست کاربران")
+    dp.callback_query.register(user_browser_callback, F.from_user.id == ADMIN_USER_ID, F.data.startswith("ub:"))
+    dp.message.register(process_user_search, F.from_user.id == ADMIN_USER_ID, Form.user_search)
     dp.message.register(get_stats, F.from_user.id == ADMIN_USER_ID, F.text == "📊 آمار فعالیت")
+    dp.message.register(get_performance, F.from_user.id == ADMIN_USER_ID, F.text == "⏱ عملکرد")
+    dp.callback_query.register(performance_callback, F.from_user.id == ADMIN_USER_ID, F.data.startswith("pf:"))
+    dp.message.register(profile_command, F.from_user.id == ADMIN_USER_ID, Command("profile"))
+    dp.message.register(trace_command, F.from_user.id == ADMIN_USER_ID, Command("trace"))
     dp.message.register(force_sub_settings, F.from_user.id == ADMIN_USER_ID, F.text == "🔒 مدیریت عضویت اجباری")
     dp.message.register(list_force_sub_channels, F.from_user.id == ADMIN_USER_ID, F.text == "📋 لیست اهداف")
     dp.message.register(add_force_sub_channel_start, F.from_user.id == ADMIN_USER_ID, F.text == "➕ افزودن کانال/گروه")
@@ -215,13 +262,7 @@ async def register_handlers(dp: Dispatcher):
 
 async def command_start_handler(message: Message, state: FSMContext) -> None:
     user = message.from_user
-    hashed_id = get_hashed_id(user.id, HASH_SALT)
-    
-    conn = sqlite3.connect("anonymous_chat.db")
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR IGNORE INTO users (user_id, username, hashed_id) VALUES (?, ?, ?)", (user.id, user.username, hashed_id))
-    conn.commit()
-    conn.close()
+    await identity_cache.register(user.id, user.username)
 
     if user.id == ADMIN_USER_ID:
         await message.answer("سلام ادمین! به پنل مدیریت خوش آمدید.", reply_markup=admin_keyboard)
@@ -230,7 +271,7 @@ async def command_start_handler(message: Message, state: FSMContext) -> None:
     args = message.text.split()
     if len(args) > 1:
         recipient_hashed_id = args[1]
-        recipient_id = db_get_user_id_by_hash(recipient_hashed_id)
+        recipient_id = await identity_cache.user_id_by_hash(recipient_hashed_id)
         if not recipient_id:
             await message.answer("لینک نامعتبر است یا کاربر مورد نظر دیگر در ربات حضور ندارد.", reply_markup=main_keyboard)
             return
@@ -254,10 +295,10 @@ async def command_start_handler(message: Message, state: FSMContext) -> None:
         )
 
 async def get_my_link(message: Message):
-    user_hashed_id = get_hashed_id(message.from_user.id, HASH_SALT)
+    user_hashed_id = identity_cache.hashed_id(message.from_user.id)
     bot_info = await bot.get_me()
     link = f"https://t.me/{bot_info.username}?start={user_hashed_id}"
-    await message.answer(
+    return message.answer(
         "لینک ناشناس شما آماده است:\n\n"
         f"<code>{link}</code>\n\n"
         "این لینک را با دیگران به اشتراک بگذارید.",
@@ -266,26 +307,13 @@ async def get_my_link(message: Message):
 async def contact_admin_start(message: Message, state: FSMContext):
     """شروع فرآیند ارسال پیام به ادمین"""
     await state.set_state(Form.sending_message_to_admin)
-    await message.answer("پیام خود را برای ارسال به ادمین وارد کنید. می‌توانید از متن، عکس، ویدیو و... استفاده کنید.", reply_markup=ReplyKeyboardRemove())
-
-async def forward_to_admin(message: Message, state: FSMContext):
-    """پیام کاربر را برای ادمین ارسال می‌کند"""
-    user = message.from_user
-    user_info = f"@{user.username}" if user.username else f"کاربر {user.first_name}"
+    return message.answer("پیام خود را برای ارسال به ادمین وارد کنید. می‌توانید از متن، عکس، ویدیو و... استفاده کنید.", reply_markup=ReplyKeyboardRemove())
 
+async def forward_to_admin(message: Message, state: FSMContext, album: list[Message] | None = None):
+    """پیام کاربر (یا آلبوم او) را در صندوق ادمین ثبت و بسته به حالت صندوق فوراً یا در خلاصه بعدی اعلام می‌کند"""
     try:
-        # ایجاد دکمه پاسخ برای ادمین
-        reply_markup = InlineKeyboardMarkup(
-            inline_keyboard=[[InlineKeyboardButton(text="✍️ پاسخ به کاربر", callback_data=f"admin_reply_{user.id}")]]
-        )
-
-        await bot.send_message(ADMIN_USER_ID, f"پیام جدید از <b>{user_info}</b> (ID: <code>{user.id}</code>):")
-        await bot.copy_message(
-            chat_id=ADMIN_USER_ID,
-            from_chat_id=message.chat.id,
-            message_id=message.message_id,
-            reply_markup=reply_markup
-        )
+        await admin_inbox.add(message, album)
+        await write_behind.record_daily_event("admin_contacts")
         await message.answer("پیام شما با موفقیت برای ادمین ارسال شد.", reply_markup=main_keyboard)
     except Exception as e:
         logging.error(f"Could not forward message to admin: {e}")
@@ -295,11 +323,11 @@ async def forward_to_admin(message: Message, state: FSMContext):
 
 async def send_to_user_start(message: Message, state: FSMContext):
     await state.set_state(Form.getting_recipient_id)
-    await message.answer("نام کاربری تلگرام کاربر مقصد را با @ وارد کنید (مثال: @Username):")
+    return message.answer("نام کاربری تلگرام کاربر مقصد را با @ وارد کنید (مثال: @Username):")
 
 async def get_recipient_username(message: Message, state: FSMContext):
     username = message.text.lstrip('@')
-    recipient_id = db_get_user_by_username(username)
+    recipient_id = await identity_cache.user_id_by_username(username)
 
     if not recipient_id:
         await message.answer("کاربر یافت نشد. مطمئن شوید که کاربر مورد نظر ربات را استارت کرده است و نام کاربری را درست وارد کرده‌اید.", reply_markup=main_keyboard)
@@ -319,10 +347,10 @@ async def get_recipient_username(message: Message, state: FSMContext):
         reply_markup=ReplyKeyboardRemove()
     )
 
-async def forward_anonymous_message(message: Message, state: FSMContext):
+async def forward_anonymous_message(message: Message, state: FSMContext, album: list[Message] | None = None):
     data = await state.get_data()
     recipient_id = data.get("recipient_id")
-    sender_hashed_id = get_hashed_id(message.from_user.id, HASH_SALT)
+    sender_hashed_id = identity_cache.hashed_id(message.from_user.id)
 
     if not recipient_id:
         await message.answer("خطا: کاربر مقصد مشخص نیست. لطفاً دوباره امتحان کنید.", reply_markup=main_keyboard)
@@ -330,33 +358,23 @@ async def forward_anonymous_message(message: Message, state: FSMContext):
         return
 
     try:
-        sent_message = await bot.copy_message(
-            chat_id=recipient_id,
-            from_chat_id=message.chat.id,
-            message_id=message.message_id
-        )
-
-        conn = sqlite3.connect("anonymous_chat.db")
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO messages (sender_hashed_id, recipient_hashed_id, telegram_message_id) VALUES (?, ?, ?)",
-            (sender_hashed_id, get_hashed_id(recipient_id, HASH_SALT), sent_message.message_id)
-        )
-        conn.commit()
-        db_message_id = cursor.lastrowid
-        conn.close()
-
+        # شناسه پیام پیش از ارسال گرفته می‌شود تا دکمه پاسخ در همان copy_message فرستاده شود؛
+        # ردیف فقط پس از ارسال موفق (و در commit دسته‌ای بعدی) نوشته می‌شود. هر آلبوم یک ردیف و یک دکمه دارد
+        db_message_id = await write_behind.allocate_message_id()
         reply_markup = InlineKeyboardMarkup(
             inline_keyboard=[[InlineKeyboardButton(text="✍️ پاسخ", callback_data=f"reply_{db_message_id}")]]
         )
-        await bot.edit_message_reply_markup(
-            chat_id=recipient_id,
-            message_id=sent_message.message_id,
-            reply_markup=reply_markup
-        )
+        sent_message_id = await copy_content(bot, recipient_id, message, album, reply_markup=reply_markup)
 
+        await write_behind.add_message(
+            db_message_id, sender_hashed_id, identity_cache.hashed_id(recipient_id), sent_message_id
+        )
+        await write_behind.mark_user_delivered(recipient_id)
         await message.answer("پیام شما با موفقیت به صورت ناشناس ارسال شد.", reply_markup=main_keyboard)
 
+    except TelegramForbiddenError:
+        await write_behind.mark_user_blocked(recipient_id)
+        await message.answer("ارسال پیام ممکن نیست؛ کاربر مقصد ربات را بلاک کرده است.", reply_markup=main_keyboard)
     except TelegramBadRequest as e:
         logging.error(f"Error forwarding to {recipient_id}: {e}")
         await message.answer("ارسال پیام با خطا مواجه شد. ممکن است کاربر ربات را بلاک کرده باشد یا شناسه اشتباه باشد.", reply_markup=main_keyboard)
@@ -364,26 +382,24 @@ async def forward_anonymous_message(message: Message, state: FSMContext):
 
 async def handle_reply_button(callback: CallbackQuery, state: FSMContext):
     db_message_id = int(callback.data.split("_")[1])
+    await write_behind.sync_message(db_message_id)
 
-    conn = sqlite3.connect("anonymous_chat.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT sender_hashed_id FROM messages WHERE id = ?", (db_message_id,))
-    result = cursor.fetchone()
-    conn.close()
+    status, original_sender_id = await identity_cache.reply_sender(db_message_id)
 
-    if not result:
+    if status == "expired":
+        await callback.answer(f"⌛️ مهلت پاسخ به این پیام ({REPLY_WINDOW_DAYS} روز) به پایان رسیده است.", show_alert=True)
+        return
+    if status == "missing":
         await callback.answer("خطا: این پیام در سیستم یافت نشد.", show_alert=True)
         return
 
-    original_sender_hashed_id = result[0]
-    original_sender_id = db_get_user_id_by_hash(original_sender_hashed_id)
     await state.update_data(reply_to_user_id=original_sender_id)
     await state.set_state(Form.getting_reply)
 
     await callback.message.answer("پاسخ خود را وارد کنید:")
     await callback.answer()
 
-async def send_reply_message(message: Message, state: FSMContext):
+async def send_reply_message(message: Message, state: FSMContext, album: list[Message] | None = None):
     data = await state.get_data()
     reply_to_user_id = data.get("reply_to_user_id")
 
@@ -397,26 +413,27 @@ async def send_reply_message(message: Message, state: FSMContext):
             chat_id=reply_to_user_id,
             text=" پاسخی برای پیام ناشناس خود دریافت کردید: "
         )
-        await bot.copy_message(
-            chat_id=reply_to_user_id,
-            from_chat_id=message.chat.id,
-            message_id=message.message_id
-        )
+        await copy_content(bot, reply_to_user_id, message, album)
+        await write_behind.mark_user_delivered(reply_to_user_id)
+        await write_behind.record_daily_event("replies")
         await message.answer("پاسخ شما با موفقیت ارسال شد.", reply_markup=main_keyboard)
 
+    except TelegramForbiddenError:
+        await write_behind.mark_user_blocked(reply_to_user_id)
+        await message.answer("ارسال پاسخ ممکن نیست؛ کاربر ربات را بلاک کرده است.", reply_markup=main_keyboard)
     except TelegramBadRequest as e:
         logging.error(f"Error sending reply to {reply_to_user_id}: {e}")
         await message.answer("ارسال پاسخ با خطا مواجه شد.", reply_markup=main_keyboard)
     finally:
         await state.clear()
 
-async def cancel_handler(message: Message, state: FSMContext) -> None:
+async def cancel_handler(message: Message, state: FSMContext):
     await state.clear()
     keyboard = admin_keyboard if message.from_user.id == ADMIN_USER_ID else main_keyboard
-    await message.answer("عملیات لغو شد. به منوی اصلی بازگشتید.", reply_markup=keyboard)
+    return message.answer("عملیات لغو شد. به منوی اصلی بازگشتید.", reply_markup=keyboard)
 
 async def handle_admin_reply_button(callback: CallbackQuery, state: FSMContext):
-    """هندلر دکمه پاسخ ادمین به کاربر"""
+    """هندلر دکمه پاسخ پیام‌هایی که پیش از صندوق پیام‌ها برای ادمین فرستاده شده‌اند"""
     if callback.from_user.id != ADMIN_USER_ID:
         await callback.answer("این دکمه مخصوص ادمین است.", show_alert=True)
         return
@@ -427,7 +444,7 @@ async def handle_admin_reply_button(callback: CallbackQuery, state: FSMContext):
     await callback.message.answer(f"در حال پاسخ به کاربر با شناسه <code>{user_id_to_reply}</code>. پیام خود را ارسال کنید:")
     await callback.answer()
 
-async def send_admin_reply_to_user(message: Message, state: FSMContext):
+async def send_admin_reply_to_user(message: Message, state: FSMContext, album: list[Message] | None = None):
     """ارسال پیام پاسخ ادمین به کاربر"""
     data = await state.get_data()
     user_id = data.get("user_id_to_reply")
@@ -439,111 +456,243 @@ async def send_admin_reply_to_user(message: Message, state: FSMContext):
 
     try:
         await bot.send_message(user_id, " پاسخی از طرف ادمین دریافت کردید: ")
-        await bot.copy_message(user_id, from_chat_id=message.chat.id, message_id=message.message_id)
+        await copy_content(bot, user_id, message, album)
+        await write_behind.mark_user_delivered(user_id)
+        if data.get("inbox_item_id"):
+            await db.mark_inbox_answered(user_id, data["inbox_item_id"])
         await message.answer(f"پاسخ شما برای کاربر <code>{user_id}</code> ارسال شد.", reply_markup=admin_keyboard)
+    except TelegramForbiddenError:
+        await write_behind.mark_user_blocked(user_id)
+        await message.answer(f"کاربر <code>{user_id}</code> ربات را بلاک کرده است.", reply_markup=admin_keyboard)
     except Exception as e:
         await message.answer(f"ارسال پیام به کاربر <code>{user_id}</code> ناموفق بود. خطا: {e}", reply_markup=admin_keyboard)
     finally:
         await state.clear()
 
+async def show_inbox(message: Message):
+    text, keyboard = await build_inbox_page(db)
+    await message.answer(text, reply_markup=keyboard)
+
+async def inbox_callback(callback: CallbackQuery, state: FSMContext):
+    action, *args = parse_inbox_callback(callback.data)
+    if action == "l":
+        text, keyboard = await build_inbox_page(db, *args)
+        try:
+            await callback.message.edit_text(text, reply_markup=keyboard)
+        except TelegramBadRequest:
+            pass  # صفحه تغییری نکرده است
+        await callback.answer()
+        return
+
+    item_id = int(args[0])
+    if action == "o":
+        if await admin_inbox.open_item(item_id):
+            await callback.answer()
+        else:
+            await callback.answer("این مورد یافت نشد.", show_alert=True)
+        return
+
+    item = await db.get_inbox_item(item_id)
+    if item is None:
+        await callback.answer("این مورد یافت نشد.", show_alert=True)
+        return
+    if action == "r":
+        await state.update_data(user_id_to_reply=item["user_id"], inbox_item_id=item_id)
+        await state.set_state(Form.replying_to_user)
+        await callback.message.answer(
+            f"در حال پاسخ به مورد #{item_id} از کاربر <code>{item['user_id']}</code>. پیام خود را ارسال کنید:"
+        )
+        await callback.answer()
+    elif action == "d":
+        await db.mark_inbox_answered(item["user_id"], item_id)
+        await callback.answer(f"مورد #{item_id} بسته شد.")
+
 async def broadcast_start(message: Message, state: FSMContext):
     await state.set_state(Form.getting_broadcast_message)
-    await message.answer("پیامی که می‌خواهید برای همه کاربران ارسال شود را وارد کنید:")
+    return message.answer("پیامی که می‌خواهید برای همه کاربران ارسال شود را وارد کنید:")
 
-async def process_broadcast(message: Message, state: FSMContext):
+async def process_broadcast(message: Message, state: FSMContext, album: list[Message] | None = None):
     await state.clear()
-    await message.answer("در حال ارسال پیام همگانی...")
-
-    conn = sqlite3.connect("anonymous_chat.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM users")
-    users = cursor.fetchall()
-    conn.close()
-
-    sent_count = 0
-    failed_count = 0
-    for user in users:
-        try:
-            await bot.copy_message(
-                chat_id=user[0],
-                from_chat_id=message.chat.id,
-                message_id=message.message_id
-            )
-            sent_count += 1
-            await asyncio.sleep(0.1)
-        except TelegramForbiddenError:
-            failed_count += 1
-        except Exception as e:
-            failed_count += 1
-            logging.error(f"Broadcast error to user {user[0]}: {e}")
+    status_message = await message.answer("در حال ارسال پیام همگانی...")
+    await broadcast_engine.start(
+        from_chat_id=message.chat.id,
+        message_id=message.message_id,
+        admin_chat_id=message.chat.id,
+        status_message_id=status_message.message_id,
+        album_message_ids=[m.message_id for m in album] if album else None,
+    )
 
-    await message.answer(
+async def on_broadcast_finished(job: dict, sent_count: int, failed_count: int):
+    await bot.send_message(
+        job["admin_chat_id"],
         f"پیام همگانی با موفقیت به {sent_count} کاربر ارسال شد.\n"
-        f"ارسال به {failed_count} کاربر ناموفق بود (کاربرانی که ربات را بلاک کرده‌اند).",
+        f"ارسال به {failed_count} کاربر ناموفق بود (کاربرانی که ربات را بلاک کرده‌اند).\n"
+        f"کاربرانی که قبلاً ربات را بلاک کرده بودند نادیده گرفته شدند.",
         reply_markup=admin_keyboard
     )
 
-async def get_user_list(message: Message):
-    conn = sqlite3.connect("anonymous_chat.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, username FROM users")
-    users = cursor.fetchall()
-    conn.close()
+async def on_write_dropped(rows: list[str]):
+    # ردیف پیام کنار گذاشته‌شده یعنی دکمه پاسخ آن پیام دیگر کار نمی‌کند
+    shown = "\n".join(rows[:10]) + (f"\n... و {len(rows) - 10} مورد دیگر" if len(rows) > 10 else "")
+    with send_priority(Priority.ADMIN):
+        await bot.send_message(
+            ADMIN_USER_ID,
+            f"⚠️ {len(rows)} نوشته به دلیل نقض قیدهای پایگاه داده ثبت نشد و کنار گذاشته شد:\n{html.escape(shown)}",
+        )
 
-    user_list_text = f"تعداد کل کاربران: {len(users)}\n\n"
-    for uid, uname in users[:20]:
-        user_list_text += f"• <code>{uid}</code> - @{uname or 'None'}\n"
+async def get_user_list(message: Message):
+    stats = await stats_dashboard.snapshot()
+    text, keyboard = await build_user_page(db, stats["total_users"])
+    await message.answer(text, reply_markup=keyboard)
+
+async def user_browser_callback(callback: CallbackQuery, state: FSMContext):
+    if callback.data == SEARCH_CALLBACK:
+        await state.set_state(Form.user_search)
+        await callback.message.answer("ابتدای نام کاربری مورد نظر را وارد کنید (یا /cancel):")
+        return await callback.answer()
+    if callback.data == EXPORT_CALLBACK:
+        return await export_users(callback)
+
+    mode, direction, key = parse_callback(callback.data)
+    prefix = (await state.get_data()).get("user_search_prefix") if mode == "s" else None
+    stats = await stats_dashboard.snapshot()
+    text, keyboard = await build_user_page(db, stats["total_users"], mode, direction, key, prefix)
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest:
+        # صفحه تغییری نکرده است (message is not modified)
+        pass
+    await callback.answer()
 
-    await message.answer(user_list_text)
+async def process_user_search(message: Message, state: FSMContext):
+    prefix = (message.text or "").strip().lstrip("@")
+    if not prefix:
+        return message.answer("لطفاً یک متن برای جستجو وارد کنید.")
+    # set_state(None) داده FSM را نگه می‌دارد تا دکمه‌های صفحه‌بندی پیشوند را پیدا کنند
+    await state.set_state(None)
+    await state.update_data(user_search_prefix=prefix)
+    text, keyboard = await build_user_page(db, 0, "s", prefix=prefix)
+    await message.answer(text, reply_markup=keyboard)
+
+async def export_users(callback: CallbackQuery):
+    await callback.answer("در حال آماده‌سازی فایل خروجی...")
+    fd, path = tempfile.mkstemp(suffix=".csv.gz")
+    os.close(fd)
+    try:
+        count = await export_users_csv(db, path)
+        await bot.send_document(
+            callback.from_user.id,
+            FSInputFile(path, filename=f"users-{date.today().isoformat()}.csv.gz"),
+            caption=f"📥 خروجی {count} کاربر",
+        )
+    except Exception as e:
+        logging.error(f"User export failed: {e}")
+        await bot.send_message(callback.from_user.id, "خطایی در تهیه خروجی کاربران رخ داد.")
+    finally:
+        os.remove(path)
 
 async def get_stats(message: Message):
-    conn = sqlite3.connect("anonymous_chat.db")
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM messages")
-        total_messages = cursor.fetchone()[0]
-
-        today = datetime.date.today()
-        start_of_week = today - datetime.timedelta(days=today.weekday())
-        start_of_month = today.replace(day=1)
-        start_of_year = today.replace(month=1, day=1)
-
-        cursor.execute("SELECT COUNT(*) FROM users WHERE DATE(created_at) = ?", (today,))
-        today_users = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users WHERE DATE(created_at) >= ?", (start_of_week,))
-        week_users = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users WHERE DATE(created_at) >= ?", (start_of_month,))
-        month_users = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users WHERE DATE(created_at) >= ?", (start_of_year,))
-        year_users = cursor.fetchone()[0]
+        stats = await stats_dashboard.snapshot()
+        identity_stats = identity_cache.stats()
+        identity_hits = sum(c["hits"] for c in identity_stats.values())
+        identity_lookups = identity_hits + sum(c["misses"] for c in identity_stats.values())
 
         stats_text = (
             f"<b>📊 آمار کلی ربات:</b>\n\n"
-            f"👤 تعداد کل کاربران: {total_users}\n"
-            f"✉️ تعداد کل پیام‌ها: {total_messages}\n\n"
+            f"👤 تعداد کل کاربران: {stats['total_users']}\n"
+            f"🟢 کاربران فعال: {stats['total_users'] - stats['blocked_users']}\n"
+            f"⛔️ کاربرانی که ربات را بلاک کرده‌اند: {stats['blocked_users']}\n"
+            f"✉️ تعداد کل پیام‌ها: {stats['total_messages']}\n"
+            f"↩️ تعداد کل پاسخ‌ها: {stats['total_replies']}\n"
+            f"📞 پیام‌های ارسالی به ادمین: {stats['total_admin_contacts']}\n\n"
             f"<b>📈 آمار کاربران جدید:</b>\n"
-            f"▫️ امروز: {today_users} نفر\n"
-            f"▫️ این هفته: {week_users} نفر\n"
-            f"▫️ این ماه: {month_users} نفر\n"
-            f"▫️ امسال: {year_users} نفر"
+            f"▫️ امروز: {stats['today_users']} نفر\n"
+            f"▫️ این هفته: {stats['week_users']} نفر\n"
+            f"▫️ این ماه: {stats['month_users']} نفر\n"
+            f"▫️ امسال: {stats['year_users']} نفر\n\n"
+            f"<b>📅 {HISTORY_DAYS} روز اخیر:</b>\n"
+            f"{format_history(stats['history'])}\n\n"
+            f"🧠 کش هویت: {identity_stats['user_by_hash']['size']} کاربر، "
+            f"نرخ برخورد {identity_hits * 100 // max(identity_lookups, 1)}٪"
         )
         await message.answer(stats_text)
     except Exception as e:
         logging.error(f"Error getting stats: {e}")
         await message.answer("خطایی در دریافت آمار رخ داد.")
-    finally:
-        conn.close()
+
+async def get_performance(message: Message):
+    tracing = (
+        f"نمونه‌برداری {tracer.sample_rate:g}، آستانه کندی {tracer.slow_seconds * 1000:.0f}ms"
+        if tracer.enabled else "خاموش"
+    )
+    await message.answer(
+        f"{await format_summary(TENANT_NAME)}\n\n<b>🔎 ردیابی:</b> {tracing}\n"
+        f"<code>/trace نرخ [میلی‌ثانیه]</code> • <code>/profile sample|cprofile [ثانیه]</code>",
+        reply_markup=performance_keyboard,
+    )
+
+async def send_profile(chat_id: int, mode: str, seconds: float):
+    try:
+        filename, report = await run_profile(mode, seconds)
+        await bot.send_document(chat_id, BufferedInputFile(report, filename=filename), caption=f"📈 پروفایل {mode}")
+    except Exception as e:
+        logging.error(f"Profile failed: {e}")
+        await bot.send_message(chat_id, f"پروفایل ناموفق بود: {e}")
+
+def start_profile(chat_id: int, mode: str, seconds: float) -> bool:
+    if profile_running():
+        return False
+    # هندلر منتظر پایان پروفایل نمی‌ماند؛ ارجاع task تا پایان نگه داشته می‌شود
+    task = asyncio.create_task(send_profile(chat_id, mode, seconds))
+    profile_tasks.add(task)
+    task.add_done_callback(profile_tasks.discard)
+    return True
+
+async def performance_callback(callback: CallbackQuery):
+    _, action, *args = callback.data.split(":")
+    if action == "traces":
+        await callback.answer()
+        await bot.send_document(
+            callback.from_user.id,
+            BufferedInputFile(tracer.report().encode("utf-8"), filename=f"traces-{date.today().isoformat()}.txt"),
+        )
+    elif start_profile(callback.from_user.id, action, float(args[0])):
+        await callback.answer(f"پروفایل {action} به مدت {args[0]} ثانیه شروع شد؛ گزارش به صورت فایل ارسال می‌شود.")
+    else:
+        await callback.answer("یک پروفایل دیگر در حال اجراست.", show_alert=True)
+
+async def profile_command(message: Message, command: CommandObject):
+    """/profile [sample|cprofile] [ثانیه]"""
+    args = (command.args or "").split()
+    mode = args[0] if args else "sample"
+    if mode not in PROFILE_MODES or (len(args) > 1 and not args[1].isdigit()):
+        return message.answer(f"استفاده: <code>/profile sample|cprofile [1-{MAX_PROFILE_SECONDS}]</code>")
+    seconds = float(args[1]) if len(args) > 1 else 30
+    if not start_profile(message.chat.id, mode, seconds):
+        return message.answer("یک پروفایل دیگر در حال اجراست.")
+    return message.answer(f"پروفایل {mode} شروع شد؛ گزارش پس از پایان به صورت فایل ارسال می‌شود.")
+
+async def trace_command(message: Message, command: CommandObject):
+    """/trace <نرخ نمونه‌برداری 0..1> [آستانه آپدیت کند به میلی‌ثانیه]؛ /trace 0 0 یعنی خاموش"""
+    args = (command.args or "").split()
+    try:
+        sample_rate = float(args[0])
+        slow_ms = float(args[1]) if len(args) > 1 else tracer.slow_seconds * 1000
+    except (IndexError, ValueError):
+        return message.answer("استفاده: <code>/trace 0.01 500</code> (نرخ نمونه‌برداری و آستانه کندی)؛ <code>/trace 0 0</code> برای خاموش کردن")
+    tracer.configure(sample_rate, slow_ms / 1000)
+    return message.answer(
+        f"ردیابی: نمونه‌برداری {tracer.sample_rate:g}، آستانه کندی {tracer.slow_seconds * 1000:.0f}ms"
+    )
 
 async def force_sub_settings(message: Message):
-    await message.answer("منوی مدیریت عضویت اجباری:", reply_markup=force_sub_keyboard)
+    return message.answer("منوی مدیریت عضویت اجباری:", reply_markup=force_sub_keyboard)
 
 async def list_force_sub_channels(message: Message):
-    targets = db_get_force_sub_targets()
+    targets = force_sub_gate.current.targets
     if not targets:
-        await message.answer("هیچ هدفی برای عضویت اجباری تنظیم نشده است.")
-        return
+        return message.answer("هیچ هدفی برای عضویت اجباری تنظیم نشده است.")
     
     text = "لیست اهداف عضویت اجباری:\n\n"
     for target, type, button_text in targets:
@@ -552,7 +701,7 @@ async def list_force_sub_channels(message: Message):
 
 async def add_force_sub_channel_start(message: Message, state: FSMContext):
     await state.set_state(Form.force_sub_add_channel)
-    await message.answer("نام کاربری کانال/گروه را با @ وارد کنید (مثال: @mychannel):", reply_markup=ReplyKeyboardRemove())
+    return message.answer("نام کاربری کانال/گروه را با @ وارد کنید (مثال: @mychannel):", reply_markup=ReplyKeyboardRemove())
 
 async def add_force_sub_channel_get_target(message: Message, state: FSMContext):
     if not message.text.startswith('@'):
@@ -564,7 +713,7 @@ async def add_force_sub_channel_get_target(message: Message, state: FSMContext):
 
 async def add_force_sub_link_start(message: Message, state: FSMContext):
     await state.set_state(Form.force_sub_add_link)
-    await message.answer("لینک کامل سایت یا صفحه اجتماعی را وارد کنید (مثال: https://example.com):", reply_markup=ReplyKeyboardRemove())
+    return message.answer("لینک کامل سایت یا صفحه اجتماعی را وارد کنید (مثال: https://example.com):", reply_markup=ReplyKeyboardRemove())
 
 async def add_force_sub_link_get_target(message: Message, state: FSMContext):
     if not message.text.startswith('http'):
@@ -585,60 +734,41 @@ async def add_force_sub_get_button_text(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    conn = sqlite3.connect("anonymous_chat.db")
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "INSERT INTO force_sub_targets (target, type, button_text) VALUES (?, ?, ?)",
-            (target, target_type, button_text)
-        )
-        conn.commit()
+    if await db.add_force_sub_target(target, target_type, button_text):
+        await membership_cache.refresh_channels((await force_sub_gate.reload(db)).channels)
         await message.answer(f"هدف '{target}' با موفقیت اضافه شد.", reply_markup=force_sub_keyboard)
-    except sqlite3.IntegrityError:
+    else:
         await message.answer("این هدف قبلاً در سیستم ثبت شده است.", reply_markup=force_sub_keyboard)
-    finally:
-        conn.close()
-        await state.clear()
+    await state.clear()
 
 async def remove_force_sub_start(message: Message, state: FSMContext):
     await state.set_state(Form.force_sub_remove)
-    await message.answer("آدرس هدفی که می‌خواهید حذف شود را وارد کنید:")
+    return message.answer("آدرس هدفی که می‌خواهید حذف شود را وارد کنید:")
 
 async def remove_force_sub_process(message: Message, state: FSMContext):
     target = message.text
-    conn = sqlite3.connect("anonymous_chat.db")
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM force_sub_targets WHERE target = ?", (target,))
-    conn.commit()
-    
-    if cursor.rowcount > 0:
+    if await db.remove_force_sub_target(target):
+        await membership_cache.refresh_channels((await force_sub_gate.reload(db)).channels)
+        membership_cache.invalidate(channel=target)
         await message.answer(f"هدف '{target}' با موفقیت حذف شد.", reply_markup=force_sub_keyboard)
     else:
         await message.answer("این هدف در لیست وجود ندارد.", reply_markup=force_sub_keyboard)
-    
-    conn.close()
     await state.clear()
 
 async def back_to_main_admin_panel(message: Message):
-    await message.answer("به پنل اصلی مدیریت بازگشتید.", reply_markup=admin_keyboard)
+    return message.answer("به پنل اصلی مدیریت بازگشتید.", reply_markup=admin_keyboard)
 
 async def check_sub_callback(callback: CallbackQuery):
-    targets = db_get_force_sub_targets()
-    is_subscribed_to_all = True
-    for target, target_type, button_text in targets:
-        if target_type == 'channel':
-            try:
-                member = await bot.get_chat_member(chat_id=target, user_id=callback.from_user.id)
-                if member.status not in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]:
-                    is_subscribed_to_all = False
-                    break
-            except (TelegramBadRequest, TelegramAPIError):
-                logging.warning(f"Bot is not admin in {target}. Trusting user {callback.from_user.id} click for check.")
-                pass
-            except Exception as e:
-                logging.error(f"Error in check_sub_callback for {target}: {e}")
-                await callback.answer("خطایی در بررسی عضویت رخ داد.", show_alert=True)
-                return
+    try:
+        # مقادیر همین لحظه توسط middleware تازه‌سازی شده‌اند
+        membership = await membership_cache.check_channels(callback.from_user.id, force_sub_gate.current.channels)
+    except Exception as e:
+        logging.error(f"Error in check_sub_callback for {callback.from_user.id}: {e}")
+        await callback.answer("خطایی در بررسی عضویت رخ داد.", show_alert=True)
+        return
+
+    # اگر ربات در کانال ادمین نباشد (None)، به کلیک کاربر اعتماد می‌شود
+    is_subscribed_to_all = all(status is not False for status in membership.values())
 
     if is_subscribed_to_all:
         await callback.message.delete()
@@ -647,12 +777,19 @@ async def check_sub_callback(callback: CallbackQuery):
     else:
         await callback.answer("شما هنوز در تمام کانال‌ها عضو نشده‌اید!", show_alert=True)
 
-async def set_bot_description():
+BOT_DESCRIPTION = "💬 با من می‌تونی به صورت ناشناس برای دوستات پیام بفرستی! لینک خودت رو بساز و برای بقیه بفرست."
+
+async def set_bot_description(current: str | None = None) -> str | None:
+    """توضیحاتی که اکنون روی ربات ثبت است؛ اگر همین متن در اجرای قبلی ثبت شده باشد درخواستی فرستاده نمی‌شود"""
+    if current == BOT_DESCRIPTION:
+        return current
     try:
-        await bot.set_my_description("💬 با من می‌تونی به صورت ناشناس برای دوستات پیام بفرستی! لینک خودت رو بساز و برای بقیه بفرست.")
+        await bot.set_my_description(BOT_DESCRIPTION)
         logging.info("Bot description set successfully.")
+        return BOT_DESCRIPTION
     except Exception as e:
         logging.error(f"Could not set bot description: {e}")
+        return None
 
 def setup_bot():
     print("--- شروع نصب ربات چت ناشناس ---")
@@ -671,6 +808,48 @@ def setup_bot():
 TELEGRAM_BOT_TOKEN = "{token}"
 ADMIN_USER_ID = {admin_id}
 HASH_SALT = "{salt}"
+TELEGRAM_API_URL = ""        # خالی یعنی https://api.telegram.org
+
+# --- حالت اجرا ---
+# "polling" (پیش‌فرض) یا "webhook"
+RUN_MODE = "polling"
+WEBHOOK_BASE_URL = ""        # مثال: https://bot.example.com
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""          # خالی یعنی در هر اجرا یک توکن تصادفی ساخته شود
+WEBHOOK_HOST = "127.0.0.1"   # پشت reverse proxy محلی (مثلاً nginx)
+WEBHOOK_PORT = 8080
+WEBHOOK_WORKERS = 1
+
+# --- ذخیره وضعیت گفتگوها ---
+# "sqlite" (پیش‌فرض، ماندگار)، "memory" یا "redis" (نیازمند pip install redis)
+FSM_STORAGE = "sqlite"
+FSM_REDIS_URL = "redis://localhost:6379/0"
+
+# --- نگهداری پیام‌ها ---
+REPLY_WINDOW_DAYS = 30       # پس از این مدت دکمه پاسخ منقضی می‌شود؛ 0 یعنی نگهداری دائمی
+MESSAGE_ARCHIVE_DIR = "archive"  # بایگانی ماهانه فشرده؛ خالی یعنی حذف بدون بایگانی
+
+# --- متریک‌ها (فرمت Prometheus در /metrics) ---
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9110          # 0 یعنی غیرفعال؛ worker شماره n روی پورت METRICS_PORT + n
+
+# --- ردیابی آپدیت‌ها (قابل تغییر در حین اجرا با /trace) ---
+TRACE_SAMPLE_RATE = 0.0      # سهم آپدیت‌هایی که ریز زمان‌هایشان ثبت می‌شود؛ 0 یعنی خاموش
+SLOW_UPDATE_MS = 0           # آپدیت‌های کندتر از این مقدار با ریز زمان‌ها لاگ می‌شوند؛ 0 یعنی خاموش
+
+# --- سقف پردازش هم‌زمان آپدیت‌ها (آپدیت‌های ادمین محدود نمی‌شوند) ---
+MAX_CONCURRENT_UPDATES = 64
+MAX_QUEUED_UPDATES = 1000    # آپدیت‌های بیشتر در زمان هجوم دور ریخته می‌شوند
+UPDATE_SHED_POLICY = "drop_newest"  # یا "drop_oldest"
+
+# --- صندوق پیام ادمین ---
+# True یعنی پیام‌های کاربران به جای ارسال تک‌تک، هر دقیقه در یک پیام خلاصه به ادمین اعلام می‌شوند
+ADMIN_INBOX_DIGEST = False
+
+# --- چند ربات در یک پردازه ---
+# مسیر فایل JSON ربات‌ها (نام، توکن، ادمین و salt هر ربات)؛ خالی یعنی فقط ربات همین فایل.
+# در این حالت تنظیمات بالا بین همه ربات‌ها مشترک است و فقط polling پشتیبانی می‌شود.
+TENANTS_FILE = ""
 """
     with open("config.py", "w", encoding="utf-8") as f:
         f.write(config_content)
@@ -678,21 +857,276 @@ HASH_SALT = "{salt}"
     print("\nفایل 'config.py' با موفقیت ایجاد شد.")
     print("نصب با موفقیت انجام شد. اکنون می‌توانید ربات را اجرا کنید.")
 
-async def main() -> None:
-    global bot, dp
+def register_runtime_gauges(fsm_storage, own_scheduler: bool = True):
+    """گیج‌هایی که هنگام خواندن متریک‌ها از اشیای همین پردازه محاسبه می‌شوند
+
+    در حالت چند رباتی برچسب bot با نام ربات اضافه می‌شود و گیج‌های زمان‌بند مشترک را میزبان ثبت می‌کند.
+    """
+
+    async def fsm_states():
+        counts = await count_states(fsm_storage)
+        return {(state,): n for state, n in (counts or {}).items()}
+
+    async def outbound_queued():
+        return {(name,): s["queued"] for name, s in outbound_scheduler.stats().items()}
+
+    async def outbound_wait():
+        return {(name,): round(s["wait_avg"], 4) for name, s in outbound_scheduler.stats().items()}
+
+    async def cache_hit_ratio():
+        identity_stats = identity_cache.stats()
+        identity_hits = sum(c["hits"] for c in identity_stats.values())
+        identity_lookups = identity_hits + sum(c["misses"] for c in identity_stats.values())
+        membership_lookups = membership_cache.hits + membership_cache.misses
+        return {
+            ("identity",): round(identity_hits / max(identity_lookups, 1), 3),
+            ("membership",): round(membership_cache.hits / max(membership_lookups, 1), 3),
+        }
+
+    async def membership_index():
+        return {(name,): value for name, value in membership_cache.stats().items()}
+
+    async def membership_members():
+        return {(channel,): members for channel, members, _ in await db.count_channel_members()}
+
+    async def flood_throttled():
+        return {(action,): n for action, n in flood_limiter.stats()["throttled"].items()}
+
+    async def flood_users():
+        flood_stats = flood_limiter.stats()
+        return {("tracked",): flood_stats["tracked"], ("muted",): flood_stats["muted_now"]}
+
+    async def media_group_stats():
+        return {(name,): value for name, value in media_group_collector.stats().items()}
+
+    async def tracing_stats():
+        return {(name,): value for name, value in tracer.stats().items()}
+
+    async def update_queue():
+        return {(name,): value for name, value in update_scheduler.stats().items()}
+
+    async def updates_shed():
+        return {(reason,): n for reason, n in update_scheduler.shed_stats().items()}
+
+    async def lifecycle_stats():
+        return {(name,): value for name, value in lifecycle.stats().items()}
+
+    async def write_behind_stats():
+        return {(name,): value for name, value in write_behind.stats().items()}
+
+    registry.gauge("bot_fsm_states", "Conversations currently in each FSM state", ("state",), fsm_states, TENANT_NAME)
+    if isinstance(fsm_storage, SQLiteStorage):
+        async def fsm_cache():
+            return {("cached",): fsm_storage.cached_count(), ("pending",): fsm_storage.pending_count()}
+        registry.gauge("bot_fsm_storage_entries", "FSM records held in memory", ("kind",), fsm_cache, TENANT_NAME)
+    if own_scheduler:
+        registry.gauge("bot_outbound_queued", "Sends waiting in the outbound scheduler", ("priority",), outbound_queued)
+        registry.gauge("bot_outbound_wait_avg_seconds", "Average outbound queue wait", ("priority",), outbound_wait)
+    registry.gauge("bot_cache_hit_ratio", "In-process cache hit ratio", ("cache",), cache_hit_ratio, TENANT_NAME)
+    registry.gauge(
+        "bot_membership_index", "Membership lookups by source and chat_member events", ("kind",), membership_index,
+        TENANT_NAME
+    )
+    registry.gauge(
+        "bot_channel_members", "Members of each force-sub channel in the local index", ("channel",),
+        membership_members, TENANT_NAME
+    )
+    registry.gauge("bot_media_groups", "Albums collected into one update", ("kind",), media_group_stats, TENANT_NAME)
+    registry.gauge("bot_traced_updates", "Updates traced and updates over the slow threshold", ("kind",), tracing_stats)
+    registry.gauge("bot_update_queue", "Updates running, waiting and processed by the scheduler", ("kind",),
+                   update_queue, TENANT_NAME)
+    registry.gauge("bot_updates_shed", "Updates dropped under load since start", ("reason",), updates_shed, TENANT_NAME)
+    registry.gauge("bot_lifecycle", "Updates in flight and redelivered updates skipped", ("kind",), lifecycle_stats,
+                   TENANT_NAME)
+    registry.gauge("bot_write_behind", "Write-behind queue size and totals", ("kind",), write_behind_stats, TENANT_NAME)
+    registry.gauge(
+        "bot_flood_throttled", "Updates dropped by flood control since start", ("action",), flood_throttled, TENANT_NAME
+    )
+    registry.gauge(
+        "bot_flood_users", "Users tracked and currently muted by flood control", ("kind",), flood_users, TENANT_NAME
+    )
+
+def register_snapshot_sections(bot_profile: dict):
+    """کش‌هایی که هنگام خاموش شدن منظم ذخیره و در اجرای بعدی بازیابی می‌شوند"""
+
+    def dump_bot_profile():
+        # aiogram نتیجه get_me را در bot._me نگه می‌دارد و polling پیش از شروع آن را می‌خواند
+        # (ویژگی خصوصی؛ نسخه aiogram در requirements.txt ثابت است)
+        me = bot._me
+        return {"me": me.model_dump(mode="json") if me else None, "description": bot_profile.get("description")}
+
+    def restore_bot_profile(snapshot):
+        if snapshot["me"] and snapshot["me"]["id"] == bot.id:
+            bot._me = User.model_validate(snapshot["me"])
+        bot_profile["description"] = snapshot["description"]
+
+    lifecycle.register("bot", dump_bot_profile, restore_bot_profile)
+    lifecycle.register("membership", membership_cache.dump, membership_cache.restore)
+    lifecycle.register("identity", identity_cache.dump, identity_cache.restore)
+
+async def main(worker_index: int = 0, shared=None) -> None:
+    """shared (tenants.SharedResources) یعنی اجرا به عنوان یکی از چند ربات با نشست و زمان‌بند مشترک"""
+    global bot, dp, db, membership_cache, force_sub_gate, broadcast_engine, stats_dashboard, identity_cache
+    global outbound_scheduler, flood_limiter, write_behind, media_group_collector, admin_inbox, update_scheduler
+    global lifecycle
     
-    bot = Bot(token=TELEGRAM_BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-    dp = Dispatcher()
+    # هیستوگرام‌ها و شمارنده‌های مشترک پردازه در حالت چند رباتی با نام همین ربات ثبت می‌شوند
+    set_metrics_instance(TENANT_NAME)
+    if shared is not None:
+        bot = Bot(token=TELEGRAM_BOT_TOKEN, session=shared.session, default=DefaultBotProperties(parse_mode="HTML"))
+        outbound_scheduler = shared.scheduler
+    else:
+        # آدرس دیگری برای Bot API (مثلاً Bot API Server محلی یا سرور جعلی آزمون بار)
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+        bot = Bot(token=TELEGRAM_BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode="HTML"))
+        # هر worker سهم برابری از سقف سراسری تلگرام دارد
+        worker_count = webhook_settings.workers if RUN_MODE == "webhook" else 1
+        outbound_scheduler = OutboundScheduler(global_rate=GLOBAL_RATE / worker_count)
+        bot.session.middleware(OutboundMiddleware(outbound_scheduler))
+        bot.session.middleware(ApiMetricsMiddleware())
+    db = Database(DB_PATH, DB_READERS)
+    shared_storage = RUN_MODE == "webhook" and webhook_settings.workers > 1
+    fsm_storage = create_fsm_storage(
+        FSM_STORAGE, db, redis_url=FSM_REDIS_URL, shared=shared_storage, bot_scoped=shared is not None
+    )
+    dp = Dispatcher(storage=fsm_storage)
+    force_sub_gate = ForceSubGate()
+    broadcast_engine = BroadcastEngine(bot, db, on_finished=on_broadcast_finished)
+    stats_dashboard = StatsDashboard(db)
+    write_behind = WriteBehind(db, on_dropped=on_write_dropped)
+    membership_cache = MembershipCache(bot, db=db, writer=write_behind)
+    identity_cache = IdentityCache(db, HASH_SALT, reply_window=REPLY_WINDOW_DAYS * 86400, writer=write_behind)
+    flood_limiter = FloodLimiter()
+    media_group_collector = MediaGroupMiddleware()
+    # در حالت webhook با چند worker سقف برای هر worker جداست
+    update_scheduler = UpdateScheduler(
+        MAX_CONCURRENT_UPDATES, MAX_QUEUED_UPDATES, UPDATE_SHED_POLICY, exempt=(ADMIN_USER_ID,)
+    )
+    admin_inbox = AdminInbox(bot, db, ADMIN_USER_ID, digest=ADMIN_INBOX_DIGEST)
+    tracer.configure(TRACE_SAMPLE_RATE, SLOW_UPDATE_MS / 1000)
+    lifecycle = Lifecycle(snapshot_path(DB_PATH))
+    bot_profile = {}
     
     await register_handlers(dp)
-
-    setup_database()
-    await set_bot_description()
-    await dp.start_polling(bot)
+    register_runtime_gauges(fsm_storage, own_scheduler=shared is None)
+    register_snapshot_sections(bot_profile)
+    restored = lifecycle.restore()
+
+    # کارهای یک‌باره فقط در پردازه اصلی انجام می‌شوند
+    primary = worker_index == 0
+    await db.connect()
+    gate = await force_sub_gate.reload(db)
+    if membership_cache.channels != gate.channels:
+        await membership_cache.refresh_channels(gate.channels)
+    if shared is None:
+        outbound_scheduler.start()
+    write_behind.start()
+    if isinstance(fsm_storage, SQLiteStorage):
+        fsm_storage.start()
+    background_tasks = [asyncio.create_task(flood_limiter.run_periodically())]
+    metrics_runner = None
+    serving = False
+    drained = False
+
+    async def drain_updates():
+        """کارهای نیمه‌تمام تا SHUTDOWN_TIMEOUT فرصت دارند؛ storage وضعیت هنوز باز است"""
+        nonlocal drained
+        if drained:
+            return
+        drained = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SHUTDOWN_TIMEOUT
+        await lifecycle.drain(SHUTDOWN_TIMEOUT)
+        for task in background_tasks:
+            task.cancel()
+        await broadcast_engine.stop(timeout=max(0.1, deadline - loop.time()))
+
+    # Dispatcher بستن storage (dp.fsm.close) را در سازنده ثبت کرده است؛ تخلیه باید پیش از آن اجرا شود
+    # (هوک عمومی برای این ترتیب وجود ندارد؛ به همین دلیل نسخه aiogram در requirements.txt ثابت است)
+    dp.shutdown.handlers.insert(0, HandlerObject(callback=drain_updates))
+    try:
+        if METRICS_PORT:
+            metrics_runner = await serve_metrics(METRICS_HOST, METRICS_PORT + worker_index)
+        if primary:
+            bot_profile["description"] = await set_bot_description(bot_profile.get("description"))
+            await broadcast_engine.resume_pending()
+            retention = MessageRetention(db, REPLY_WINDOW_DAYS, MESSAGE_ARCHIVE_DIR)
+            background_tasks.append(asyncio.create_task(retention.run_periodically()))
+            background_tasks.append(asyncio.create_task(membership_cache.reconcile_periodically(
+                force_sub_gate, delay=RECONCILE_WARM_DELAY if "membership" in restored else 0
+            )))
+            background_tasks.append(asyncio.create_task(admin_inbox.run_periodically()))
+        if RUN_MODE == "webhook":
+            if webhook_settings.workers > 1:
+                # تغییرات ادمین در یک worker باید به بقیه workerها هم برسد
+                background_tasks.append(asyncio.create_task(force_sub_gate.refresh_periodically(db)))
+            serving = True
+            await serve_webhook(bot, dp, webhook_settings, primary=primary)
+        else:
+            serving = True
+            # سیگنال‌ها در حالت چند رباتی در اختیار میزبان است؛ نشست پس از تخلیه صف‌ها بسته می‌شود
+            await dp.start_polling(bot, handle_signals=shared is None, close_bot_session=False)
+    finally:
+        if not drained:
+            # dp.shutdown اجرا نشده است (خطا پیش از شروع دریافت آپدیت‌ها)
+            await drain_updates()
+            await dp.fsm.close()
+        if serving and RUN_MODE != "webhook":
+            await lifecycle.confirm_offset(bot)
+        if serving and primary:
+            try:
+                lifecycle.save()
+            except OSError as e:
+                logging.error(f"Could not save cache snapshot: {e}")
+        if shared is None:
+            await outbound_scheduler.stop()
+        await write_behind.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await db.close()
+        if shared is None:
+            await bot.session.close()
 
 if __name__ == "__main__":
     if not os.path.exists('config.py'):
         setup_bot()
     else:
-        from config import TELEGRAM_BOT_TOKEN, ADMIN_USER_ID, HASH_SALT
-        asyncio.run(main())
\ No newline at end of file
+        import config
+        RUN_MODE = getattr(config, "RUN_MODE", "polling")
+        TELEGRAM_API_URL = getattr(config, "TELEGRAM_API_URL", "")
+        FSM_STORAGE = getattr(config, "FSM_STORAGE", "sqlite")
+        FSM_REDIS_URL = getattr(config, "FSM_REDIS_URL", None)
+        REPLY_WINDOW_DAYS = getattr(config, "REPLY_WINDOW_DAYS", 30)
+        MESSAGE_ARCHIVE_DIR = getattr(config, "MESSAGE_ARCHIVE_DIR", "archive")
+        METRICS_HOST = getattr(config, "METRICS_HOST", "127.0.0.1")
+        METRICS_PORT = getattr(config, "METRICS_PORT", 9110)
+        ADMIN_INBOX_DIGEST = getattr(config, "ADMIN_INBOX_DIGEST", False)
+        TRACE_SAMPLE_RATE = getattr(config, "TRACE_SAMPLE_RATE", 0.0)
+        MAX_CONCURRENT_UPDATES = getattr(config, "MAX_CONCURRENT_UPDATES", MAX_CONCURRENT_UPDATES)
+        MAX_QUEUED_UPDATES = getattr(config, "MAX_QUEUED_UPDATES", MAX_QUEUED_UPDATES)
+        UPDATE_SHED_POLICY = getattr(config, "UPDATE_SHED_POLICY", SHED_POLICY)
+        SLOW_UPDATE_MS = getattr(config, "SLOW_UPDATE_MS", 0)
+        TENANTS_FILE = getattr(config, "TENANTS_FILE", "")
+        if TENANTS_FILE:
+            from tenants import run_tenant_host
+            asyncio.run(run_tenant_host(TENANTS_FILE, {
+                "TELEGRAM_API_URL": TELEGRAM_API_URL,
+                "FSM_STORAGE": FSM_STORAGE,
+                "FSM_REDIS_URL": FSM_REDIS_URL,
+                "REPLY_WINDOW_DAYS": REPLY_WINDOW_DAYS,
+                "ADMIN_INBOX_DIGEST": ADMIN_INBOX_DIGEST,
+                "TRACE_SAMPLE_RATE": TRACE_SAMPLE_RATE,
+                "SLOW_UPDATE_MS": SLOW_UPDATE_MS,
+                "MAX_CONCURRENT_UPDATES": MAX_CONCURRENT_UPDATES,
+                "MAX_QUEUED_UPDATES": MAX_QUEUED_UPDATES,
+                "UPDATE_SHED_POLICY": UPDATE_SHED_POLICY,
+                "METRICS_HOST": METRICS_HOST,
+                "METRICS_PORT": METRICS_PORT,
+            }))
+        else:
+            from config import TELEGRAM_BOT_TOKEN, ADMIN_USER_ID, HASH_SALT
+            if RUN_MODE == "webhook":
+                webhook_settings = load_webhook_settings(config)
+                run_webhook_workers(webhook_settings, lambda worker_index: asyncio.run(main(worker_index)))
+            else:
+                asyncio.run(main())
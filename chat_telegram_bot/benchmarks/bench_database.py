@@ -0,0 +1,147 @@
+"""مقایسه توان پردازش آپدیت‌ها: sqlite3 همگام (قدیمی) در برابر لایه Database
+
+اجرا از پوشه chat_telegram_bot:
+    python benchmarks/bench_database.py --updates 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database, _SCHEMA  # noqa: E402
+from writebehind import WriteBehind  # noqa: E402
+
+
+# --- مسیر قدیمی: یک اتصال جدید برای هر کوئری ---
+def legacy_setup(path):
+    conn = sqlite3.connect(path)
+    for statement in _SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    conn.close()
+
+
+def legacy_add_user(path, user_id, hashed_id):
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT OR IGNORE INTO users (user_id, username, hashed_id) VALUES (?, ?, ?)", (user_id, None, hashed_id))
+    conn.commit()
+    conn.close()
+
+
+def legacy_get_user_id_by_hash(path, hashed_id):
+    conn = sqlite3.connect(path)
+    row = conn.execute("SELECT user_id FROM users WHERE hashed_id = ?", (hashed_id,)).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def legacy_force_sub_targets(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT target, type, button_text FROM force_sub_targets").fetchall()
+    conn.close()
+    return rows
+
+
+def legacy_add_message(path, sender, recipient):
+    conn = sqlite3.connect(path)
+    cursor = conn.execute(
+        "INSERT INTO messages (sender_hashed_id, recipient_hashed_id, telegram_message_id) VALUES (?, ?, ?)",
+        (sender, recipient, 1),
+    )
+    conn.commit()
+    rowid = cursor.lastrowid
+    conn.close()
+    return rowid
+
+
+async def legacy_update(path, i):
+    # معادل یک /start با لینک عمیق و سپس یک پیام ناشناس
+    legacy_force_sub_targets(path)
+    legacy_add_user(path, i, f"h{i}")
+    legacy_get_user_id_by_hash(path, f"h{i // 2}")
+    legacy_force_sub_targets(path)
+    legacy_add_message(path, f"h{i}", f"h{i // 2}")
+
+
+async def pooled_update(db, i):
+    await db.get_force_sub_targets()
+    await db.add_user(i, None, f"h{i}")
+    await db.get_user_id_by_hash(f"h{i // 2}")
+    await db.get_force_sub_targets()
+    message_id = await db.allocate_message_ids(1)
+    created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    await db.write_batch({}, {}, [(message_id, f"h{i}", f"h{i // 2}", 1, created_at)], set(), {})
+
+
+async def write_behind_update(db, writes, i):
+    await db.get_force_sub_targets()
+    await writes.add_user(i, None, f"h{i}")
+    await db.get_user_id_by_hash(f"h{i // 2}")
+    await db.get_force_sub_targets()
+    await writes.add_message(await writes.allocate_message_id(), f"h{i}", f"h{i // 2}", 1)
+
+
+async def _probe(stop: asyncio.Event, stalls: list):
+    """تاخیر حلقه رویداد را اندازه می‌گیرد (هر چه بیشتر، حلقه بیشتر مسدود شده است)"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        stalls.append(time.perf_counter() - started - 0.001)
+
+
+async def _run(make_update, updates: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    stop = asyncio.Event()
+    stalls: list = []
+    probe = asyncio.create_task(_probe(stop, stalls))
+
+    async def one(i):
+        async with semaphore:
+            await make_update(i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(updates)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    return elapsed, max(stalls, default=0.0)
+
+
+async def main(updates: int, concurrency: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        legacy_setup(legacy_path)
+        elapsed, stall = await _run(lambda i: legacy_update(legacy_path, i), updates, concurrency)
+        print(f"before (sqlite3 per call): {updates / elapsed:8.0f} updates/s, max loop stall {stall * 1000:6.1f} ms")
+
+        db = Database(os.path.join(tmp, "pooled.db"))
+        await db.connect()
+        try:
+            elapsed, stall = await _run(lambda i: pooled_update(db, i), updates, concurrency)
+        finally:
+            await db.close()
+        print(f"after  (Database pool):    {updates / elapsed:8.0f} updates/s, max loop stall {stall * 1000:6.1f} ms")
+
+        db = Database(os.path.join(tmp, "batched.db"))
+        await db.connect()
+        writes = WriteBehind(db)
+        writes.start()
+        try:
+            elapsed, stall = await _run(lambda i: write_behind_update(db, writes, i), updates, concurrency)
+            await writes.stop()
+        finally:
+            await db.close()
+        print(f"after  (+ write-behind):   {updates / elapsed:8.0f} updates/s, max loop stall {stall * 1000:6.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.updates, args.concurrency))
@@ -0,0 +1,284 @@
+"""آزمون بار سرتاسری: anonymous_bot_aiogram واقعی در برابر سرور جعلی Bot API
+
+همه چیز در یک پردازه و بدون اینترنت اجرا می‌شود. اجرا از پوشه chat_telegram_bot:
+    python benchmarks/bench_load.py --users 200 --concurrency 50
+    python benchmarks/bench_load.py --latency 0.05 --retry-after-ratio 0.01 --blocked-ratio 0.1
+
+سقف پیش‌فرض ارسال (۲۸ پیام در ثانیه) همان سقف تلگرام است؛ برای سنجش توان خود ربات
+مقدار بزرگ‌تری به --global-rate بدهید.
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import anonymous_bot_aiogram as bot_module  # noqa: E402
+from database import DB_PATH, Database  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from identity import get_hashed_id  # noqa: E402
+from inbound import MAX_CONCURRENT_UPDATES, MAX_QUEUED_UPDATES, SHED_POLICIES, SHED_POLICY  # noqa: E402
+from outbound import GLOBAL_RATE  # noqa: E402
+
+
+ADMIN_ID = 1
+FIRST_USER_ID = 10_000
+SALT = "bench-salt"
+CHANNEL = "@bench_channel"
+STEP_TIMEOUT = 30
+BROADCAST_TIMEOUT = 600
+
+# متن‌هایی که پایان هر مرحله را نشان می‌دهند
+WELCOME = "خوش آمدید"
+FORCE_SUB_PROMPT = "لطفاً مراحل زیر را تکمیل کنید"
+FORCE_SUB_REJECTED = "هنوز"
+DEEP_LINK_READY = "در حال ارسال پیام ناشناس"
+ANONYMOUS_SENT = "به صورت ناشناس ارسال شد"
+REPLY_PROMPT = "پاسخ خود را وارد کنید"
+REPLY_SENT = "پاسخ شما با موفقیت ارسال شد"
+RECIPIENT_BLOCKED = "بلاک کرده"
+BROADCAST_PROMPT = "پیامی که می‌خواهید"
+BROADCAST_DONE = "پیام همگانی با موفقیت"
+
+
+class LoadGenerator:
+    def __init__(self, api: FakeBotAPI, concurrency: int):
+        self.api = api
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"U{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+
+    async def _step(self, user_id: int, kind: str, payload: dict, fragments: tuple, timeout: float) -> float:
+        expected = self.api.expect(user_id, *fragments)
+        started = time.perf_counter()
+        self.api.push_update(kind, payload)
+        await asyncio.wait_for(expected, timeout)
+        return time.perf_counter() - started
+
+    async def send_text(self, user_id: int, text: str, *fragments: str, timeout: float = STEP_TIMEOUT) -> float:
+        return await self._step(user_id, "message", self._message(user_id, text), fragments, timeout)
+
+    async def send_album(self, user_id: int, size: int, *fragments: str, timeout: float = STEP_TIMEOUT) -> float:
+        """size عکس با یک media_group_id؛ زمان تا پاسخ ربات به کل آلبوم"""
+        expected = self.api.expect(user_id, *fragments)
+        group_id = f"album-{next(self._ids)}"
+        started = time.perf_counter()
+        for _ in range(size):
+            payload = self._message(user_id, "")
+            del payload["text"]
+            payload["media_group_id"] = group_id
+            payload["photo"] = [{"file_id": "photo", "file_unique_id": "photo", "width": 1, "height": 1}]
+            self.api.push_update("message", payload)
+        await asyncio.wait_for(expected, timeout)
+        return time.perf_counter() - started
+
+    async def click(self, user_id: int, data: str, *fragments: str, timeout: float = STEP_TIMEOUT) -> float:
+        payload = {
+            "id": f"{user_id}-{next(self._ids)}",
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": self._message(user_id, "…"),
+        }
+        return await self._step(user_id, "callback_query", payload, fragments, timeout)
+
+    async def run_phase(self, name: str, flows: list, db_path: str) -> dict:
+        """flows فهرستی از coroutineهایی است که زمان هر مرحله را برمی‌گردانند"""
+        latencies: list[float] = []
+        errors = 0
+
+        async def run(flow):
+            nonlocal errors
+            async with self.semaphore:
+                try:
+                    latencies.extend(await flow)
+                except asyncio.TimeoutError:
+                    errors += 1
+
+        calls_before = self.api.snapshot_calls()
+        size_before = db_size(db_path)
+        started = time.perf_counter()
+        await asyncio.gather(*(run(flow) for flow in flows))
+        elapsed = time.perf_counter() - started
+        calls = self.api.snapshot_calls() - calls_before
+        return {
+            "name": name,
+            "flows": len(flows),
+            "updates": len(latencies),
+            "errors": errors,
+            "elapsed": elapsed,
+            "latencies": sorted(latencies),
+            "calls": calls,
+            "db_growth": db_size(db_path) - size_before,
+        }
+
+
+def db_size(path: str) -> int:
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(result: dict):
+    flows = max(result["flows"], 1)
+    print(
+        f"{result['name']:<10} {result['flows']:>6} {result['updates']:>8} {result['elapsed']:>7.2f}"
+        f" {result['updates'] / result['elapsed']:>8.1f} {percentile(result['latencies'], 0.5) * 1000:>7.1f}"
+        f" {percentile(result['latencies'], 0.99) * 1000:>7.1f} {result['errors']:>6}"
+        f" {sum(result['calls'].values()) / flows:>8.2f} {result['db_growth'] / 1024:>8.1f}"
+    )
+    per_flow = ", ".join(f"{method} {n / flows:.2f}" for method, n in sorted(result["calls"].items()))
+    print(f"{'':<10} API calls/flow: {per_flow or '-'}")
+
+
+# --- سناریوها ---
+async def start_flow(gen: LoadGenerator, user_id: int) -> list[float]:
+    return [await gen.send_text(user_id, "/start", WELCOME, FORCE_SUB_PROMPT)]
+
+
+async def anonymous_flow(gen: LoadGenerator, user_id: int, recipient_id: int) -> list[float]:
+    link = get_hashed_id(recipient_id, SALT)
+    return [
+        await gen.send_text(user_id, f"/start {link}", DEEP_LINK_READY, FORCE_SUB_PROMPT),
+        await gen.send_text(user_id, "سلام! این یک پیام ناشناس است.", ANONYMOUS_SENT, RECIPIENT_BLOCKED),
+    ]
+
+
+async def album_flow(gen: LoadGenerator, user_id: int, recipient_id: int, size: int) -> list[float]:
+    link = get_hashed_id(recipient_id, SALT)
+    return [
+        await gen.send_text(user_id, f"/start {link}", DEEP_LINK_READY, FORCE_SUB_PROMPT),
+        await gen.send_album(user_id, size, ANONYMOUS_SENT, RECIPIENT_BLOCKED),
+    ]
+
+
+async def reply_flow(gen: LoadGenerator, user_id: int, button: str) -> list[float]:
+    return [
+        await gen.click(user_id, button, REPLY_PROMPT),
+        await gen.send_text(user_id, "ممنون از پیامت!", REPLY_SENT, RECIPIENT_BLOCKED),
+    ]
+
+
+async def force_sub_flow(gen: LoadGenerator, user_id: int) -> list[float]:
+    return [await gen.click(user_id, "check_sub", WELCOME, FORCE_SUB_REJECTED)]
+
+
+async def broadcast_flow(gen: LoadGenerator) -> list[float]:
+    return [
+        await gen.send_text(ADMIN_ID, "📢 پیام همگانی", BROADCAST_PROMPT),
+        await gen.send_text(ADMIN_ID, "اطلاعیه آزمون بار", BROADCAST_DONE, timeout=BROADCAST_TIMEOUT),
+    ]
+
+
+async def main(args):
+    logging.basicConfig(level=logging.WARNING)
+    api = FakeBotAPI(latency=args.latency, retry_after_ratio=args.retry_after_ratio, left_ratio=args.left_ratio)
+    api_url = await api.start()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # ربات پایگاه داده را با مسیر نسبی DB_PATH در پوشه جاری می‌سازد
+        os.chdir(tmp)
+        db_path = os.path.join(tmp, DB_PATH)
+        if args.force_sub:
+            db = Database(db_path)
+            await db.connect()
+            await db.add_force_sub_target(CHANNEL, "channel", "عضویت")
+            await db.close()
+
+        bot_module.TELEGRAM_BOT_TOKEN = "123456:BENCHMARK"
+        bot_module.ADMIN_USER_ID = ADMIN_ID
+        bot_module.HASH_SALT = SALT
+        bot_module.TELEGRAM_API_URL = api_url
+        bot_module.RUN_MODE = "polling"
+        bot_module.FSM_STORAGE = args.fsm_storage
+        bot_module.FSM_REDIS_URL = None
+        bot_module.REPLY_WINDOW_DAYS = 30
+        bot_module.MESSAGE_ARCHIVE_DIR = "archive"
+        bot_module.ADMIN_INBOX_DIGEST = False
+        bot_module.TRACE_SAMPLE_RATE = args.trace_sample_rate
+        bot_module.SLOW_UPDATE_MS = 0
+        bot_module.MAX_CONCURRENT_UPDATES = args.max_concurrent_updates
+        bot_module.MAX_QUEUED_UPDATES = args.max_queued_updates
+        bot_module.UPDATE_SHED_POLICY = args.shed_policy
+        bot_module.METRICS_HOST = "127.0.0.1"
+        bot_module.METRICS_PORT = 0
+        bot_module.GLOBAL_RATE = args.global_rate
+        bot_task = asyncio.create_task(bot_module.main())
+        while not api.calls["getUpdates"]:
+            await asyncio.sleep(0.05)
+
+        gen = LoadGenerator(api, args.concurrency)
+        users = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+        print(f"{'phase':<10} {'flows':>6} {'updates':>8} {'secs':>7} {'upd/s':>8} {'p50ms':>7} {'p99ms':>7}"
+              f" {'errors':>6} {'api/flow':>8} {'db+KB':>8}")
+        try:
+            report(await gen.run_phase("start", [start_flow(gen, u) for u in users], db_path))
+
+            # کاربرانی که ربات را بلاک کرده‌اند دیگر پیامی نمی‌فرستند اما هنوز مقصد پیام‌ها هستند
+            blocked_count = int(len(users) * args.blocked_ratio)
+            active = users[:len(users) - blocked_count]
+            api.blocked = set(users[len(active):])
+
+            report(await gen.run_phase(
+                "anonymous", [anonymous_flow(gen, u, users[(i + 1) % len(users)]) for i, u in enumerate(active)], db_path
+            ))
+            if args.album_size:
+                report(await gen.run_phase("album", [
+                    album_flow(gen, u, users[(i + 1) % len(users)], args.album_size) for i, u in enumerate(active)
+                ], db_path))
+            buttons = {u: next(b for b in api.last_buttons.get(u, []) if b.startswith("reply_")) for u in active
+                       if any(b.startswith("reply_") for b in api.last_buttons.get(u, []))}
+            report(await gen.run_phase("reply", [reply_flow(gen, u, b) for u, b in buttons.items()], db_path))
+            if args.force_sub:
+                report(await gen.run_phase("force_sub", [force_sub_flow(gen, u) for u in active], db_path))
+            if args.broadcast:
+                report(await gen.run_phase("broadcast", [broadcast_flow(gen)], db_path))
+            shed = bot_module.update_scheduler.shed_stats()
+            print(f"{'':<10} updates shed: {', '.join(f'{k} {v}' for k, v in shed.items())}")
+        finally:
+            await bot_module.dp.stop_polling()
+            await bot_task
+            await api.stop()
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0, help="fake Bot API latency per call (seconds)")
+    parser.add_argument("--retry-after-ratio", type=float, default=0.0, help="share of sends answered with 429")
+    parser.add_argument("--blocked-ratio", type=float, default=0.05, help="share of users who block the bot")
+    parser.add_argument("--left-ratio", type=float, default=0.0, help="share of getChatMember answers that are 'left'")
+    parser.add_argument("--global-rate", type=float, default=GLOBAL_RATE, help="outbound messages per second")
+    parser.add_argument("--trace-sample-rate", type=float, default=0.0, help="share of updates traced")
+    parser.add_argument("--max-concurrent-updates", type=int, default=MAX_CONCURRENT_UPDATES)
+    parser.add_argument("--max-queued-updates", type=int, default=MAX_QUEUED_UPDATES)
+    parser.add_argument("--shed-policy", default=SHED_POLICY, choices=SHED_POLICIES)
+    parser.add_argument("--fsm-storage", default="sqlite", choices=("sqlite", "memory"))
+    parser.add_argument("--no-force-sub", dest="force_sub", action="store_false")
+    parser.add_argument("--album-size", type=int, default=5, help="photos per album in the album phase; 0 skips it")
+    parser.add_argument("--no-broadcast", dest="broadcast", action="store_false")
+    asyncio.run(main(parser.parse_args()))
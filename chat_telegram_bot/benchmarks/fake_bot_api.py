@@ -0,0 +1,175 @@
+"""سرور جعلی Bot API تلگرام برای آزمون بار بدون اینترنت
+
+فقط متدهایی که ربات استفاده می‌کند پیاده‌سازی شده‌اند؛ بقیه متدها True برمی‌گردانند.
+تأخیر، خطای 429 و خطای 403 (کاربر ربات را بلاک کرده) قابل تنظیم هستند.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+
+BOT_ID = 123456     # همان شناسه توکن آزمون بار
+CHANNEL_ID = -1001234567890
+BOT_USERNAME = "bench_bot"
+SEND_METHODS = {"sendMessage", "copyMessage", "copyMessages", "editMessageText", "editMessageReplyMarkup"}
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, retry_after_ratio: float = 0.0, retry_after: int = 1,
+                 left_ratio: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.retry_after_ratio = retry_after_ratio
+        self.retry_after = retry_after
+        self.left_ratio = left_ratio
+        self.random = random.Random(seed)
+        # کاربرانی که ربات را بلاک کرده‌اند؛ ارسال به آن‌ها 403 می‌گیرد
+        self.blocked: set[int] = set()
+        self.calls: Counter = Counter()
+        # آخرین دکمه‌های inline ارسال‌شده به هر چت (برای شبیه‌سازی کلیک کاربر)
+        self.last_buttons: dict[int, list[str]] = {}
+        # مثل تلگرام، آپدیت‌ها تا تأیید با offset در getUpdates بعدی دوباره فرستاده می‌شوند
+        self._updates: list[dict] = []
+        self._arrived = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._waiters: dict[int, list[tuple]] = defaultdict(list)
+        self._runner: web.AppRunner | None = None
+
+    # --- کنترل از سمت مولد بار ---
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        # getUpdates رهاشده ربات (پس از stop_polling) نباید cleanup را تا پایان long polling نگه دارد
+        self._arrived.set()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def push_update(self, kind: str, payload: dict):
+        self._updates.append({"update_id": next(self._update_ids), kind: payload})
+        self._arrived.set()
+
+    def expect(self, chat_id: int, *fragments: str) -> asyncio.Future:
+        """Future که با اولین پیام یا پاسخ callback به chat_id که یکی از fragments را دارد کامل می‌شود"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append((fragments, future))
+        return future
+
+    def snapshot_calls(self) -> Counter:
+        return Counter({method: n for method, n in self.calls.items() if method != "getUpdates"})
+
+    # --- پیاده‌سازی متدها ---
+    def _message(self, chat_id: int, text: str | None = None) -> dict:
+        message = {"message_id": next(self._message_ids), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}}
+        if text is not None:
+            message["text"] = text
+        return message
+
+    def _notify(self, chat_id: int, text: str):
+        waiters = self._waiters.get(chat_id)
+        if not waiters:
+            return
+        for entry in list(waiters):
+            fragments, future = entry
+            if future.done():
+                waiters.remove(entry)
+            elif any(fragment in text for fragment in fragments):
+                waiters.remove(entry)
+                future.set_result(text)
+                return
+
+    def _remember_buttons(self, chat_id: int, reply_markup: str | None):
+        if not reply_markup:
+            return
+        markup = json.loads(reply_markup)
+        buttons = [b["callback_data"] for row in markup.get("inline_keyboard", []) for b in row if "callback_data" in b]
+        if buttons:
+            self.last_buttons[chat_id] = buttons
+
+    async def _get_updates(self, params: dict):
+        timeout = float(params.get("timeout", 0))
+        limit = int(params.get("limit", 100))
+        offset = int(params.get("offset", 0))
+        if offset:
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        return self._updates[:limit]
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = int(params["chat_id"]) if str(params.get("chat_id", "")).lstrip("-").isdigit() else None
+        if method in SEND_METHODS:
+            if self.retry_after_ratio and self.random.random() < self.retry_after_ratio:
+                self.calls[f"{method}:429"] += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }, status=429)
+            if chat_id in self.blocked:
+                self.calls[f"{method}:403"] += 1
+                return web.json_response(
+                    {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}, status=403
+                )
+
+        if method == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME}
+        elif method == "getChat":
+            gifts = dict.fromkeys(
+                ("unlimited_gifts", "limited_gifts", "unique_gifts", "premium_subscription", "gifts_from_channels"), False
+            )
+            result = {"id": CHANNEL_ID, "type": "channel", "title": "Bench", "username": params["chat_id"].lstrip("@"),
+                      "accent_color_id": 0, "max_reaction_count": 0, "accepted_gift_types": gifts}
+        elif method == "getChatMember":
+            user_id = int(params["user_id"])
+            if user_id == BOT_ID:
+                # ربات سازنده کانال است تا نمایه عضویت فعال شود
+                result = {"status": "creator", "is_anonymous": False,
+                          "user": {"id": user_id, "is_bot": True, "first_name": "Bench"}}
+            else:
+                status = "left" if self.left_ratio and self.random.random() < self.left_ratio else "member"
+                result = {"status": status, "user": {"id": user_id, "is_bot": False, "first_name": "U"}}
+        elif method in ("sendMessage", "editMessageText"):
+            self._remember_buttons(chat_id, params.get("reply_markup"))
+            self._notify(chat_id, params.get("text", ""))
+            result = self._message(chat_id, params.get("text", ""))
+        elif method == "copyMessage":
+            self._remember_buttons(chat_id, params.get("reply_markup"))
+            result = {"message_id": next(self._message_ids)}
+        elif method == "copyMessages":
+            result = [{"message_id": next(self._message_ids)} for _ in json.loads(params["message_ids"])]
+        elif method == "editMessageReplyMarkup":
+            self._remember_buttons(chat_id, params.get("reply_markup"))
+            result = self._message(chat_id)
+        elif method == "answerCallbackQuery":
+            # مولد بار شناسه callback را به شکل "user_id-n" می‌سازد
+            self._notify(int(params["callback_query_id"].split("-")[0]), params.get("text", ""))
+            result = True
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError
+
+from database import Database
+from outbound import Priority, set_send_priority
+
+
+# --- تنظیمات پیام همگانی ---
+WORKER_COUNT = 10
+CHUNK_SIZE = 200          # پس از هر chunk cursor ذخیره می‌شود
+PROGRESS_INTERVAL = 3     # فاصله به‌روزرسانی پیام وضعیت برای ادمین (ثانیه)
+
+
+class BroadcastEngine:
+    """ارسال همگانی با چند worker و ذخیره پیشرفت برای ادامه پس از ری‌استارت
+
+    سرعت و تلاش دوباره پس از RetryAfter را OutboundScheduler با کمترین اولویت مدیریت می‌کند.
+    """
+
+    def __init__(self, bot: Bot, db: Database, on_finished=None, workers: int = WORKER_COUNT,
+                 chunk_size: int = CHUNK_SIZE):
+        self.bot = bot
+        self.db = db
+        self.on_finished = on_finished
+        self.worker_count = workers
+        self.chunk_size = chunk_size
+        self._tasks: dict[int, asyncio.Task] = {}
+        # با خاموش شدن منظم، workerها ارسال‌های شروع‌شده را تمام می‌کنند و بقیه را رها می‌کنند
+        self._draining = False
+
+    async def start(self, from_chat_id: int, message_id: int, admin_chat_id: int, status_message_id: int | None,
+                    include_blocked: bool = False, album_message_ids: list[int] | None = None) -> int:
+        """کاربرانی که ربات را بلاک کرده‌اند به صورت پیش‌فرض نادیده گرفته می‌شوند
+
+        با album_message_ids کل آلبوم با یک copy_messages برای هر کاربر فرستاده می‌شود.
+        """
+        total = await self.db.count_users(include_blocked=include_blocked)
+        job_id = await self.db.create_broadcast_job(
+            from_chat_id, message_id, admin_chat_id, status_message_id, include_blocked, total, album_message_ids
+        )
+        self._spawn(job_id)
+        return job_id
+
+    async def resume_pending(self):
+        """کارهای ناتمام قبل از ری‌استارت را از آخرین cursor ذخیره‌شده ادامه می‌دهد"""
+        for job_id in await self.db.get_running_broadcast_job_ids():
+            logging.info(f"Resuming broadcast job {job_id}")
+            self._spawn(job_id)
+
+    async def stop(self, timeout: float = 0):
+        """با timeout ارسال‌های در جریان تمام و cursor دقیق ذخیره می‌شود تا پس از ری‌استارت تکراری فرستاده نشود"""
+        tasks = list(self._tasks.values())
+        if timeout and tasks:
+            self._draining = True
+            await asyncio.wait(tasks, timeout=timeout)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, job_id: int):
+        task = asyncio.create_task(self._run(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _send(self, job: dict, user_id: int) -> str:
+        """خروجی یکی از 'sent'، 'blocked' یا 'failed' است"""
+        try:
+            if job["album_message_ids"]:
+                await self.bot.copy_messages(
+                    chat_id=user_id, from_chat_id=job["from_chat_id"],
+                    message_ids=[int(i) for i in job["album_message_ids"].split(",")],
+                )
+            else:
+                await self.bot.copy_message(chat_id=user_id, from_chat_id=job["from_chat_id"], message_id=job["message_id"])
+            return "sent"
+        except TelegramForbiddenError:
+            return "blocked"
+        except Exception as e:
+            logging.error(f"Broadcast error to user {user_id}: {e}")
+            return "failed"
+
+    async def _worker(self, job: dict, queue: asyncio.Queue, progress: dict, outcome: dict):
+        set_send_priority(Priority.BROADCAST)
+        while True:
+            user_id = await queue.get()
+            try:
+                if self._draining:
+                    continue
+                # صف به ترتیب شناسه خالی می‌شود، پس آخرین کاربر شروع‌شده cursor مطمئن است
+                progress["cursor"] = user_id
+                result = await self._send(job, user_id)
+                if result == "sent":
+                    progress["sent"] += 1
+                    outcome["delivered"].append(user_id)
+                else:
+                    progress["failed"] += 1
+                    if result == "blocked":
+                        outcome["blocked"].append(user_id)
+            finally:
+                queue.task_done()
+
+    async def _report(self, job: dict, progress: dict, finished: bool = False):
+        if not job["status_message_id"]:
+            return
+        title = "✅ پیام همگانی به پایان رسید." if finished else "📢 در حال ارسال پیام همگانی..."
+        done = progress["sent"] + progress["failed"]
+        try:
+            await self.bot.edit_message_text(
+                chat_id=job["admin_chat_id"],
+                message_id=job["status_message_id"],
+                text=(
+                    f"{title}\n\n"
+                    f"📊 پیشرفت: {done} از {job['total_count']}\n"
+                    f"✅ موفق: {progress['sent']}\n"
+                    f"❌ ناموفق: {progress['failed']}"
+                ),
+            )
+        except TelegramAPIError:
+            pass  # پیام تغییری نکرده یا حذف شده است
+
+    async def _reporter(self, job: dict, progress: dict):
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            await self._report(job, progress)
+
+    async def _run(self, job_id: int):
+        # گزارش پیشرفت و پیام پایانی اعلان ادمین هستند؛ workerها خودشان BROADCAST می‌شوند
+        set_send_priority(Priority.ADMIN)
+        job = await self.db.get_broadcast_job(job_id)
+        progress = {"sent": job["sent_count"], "failed": job["failed_count"], "cursor": job["last_user_id"]}
+        outcome = {"delivered": [], "blocked": []}
+        queue: asyncio.Queue = asyncio.Queue()
+        workers = [asyncio.create_task(self._worker(job, queue, progress, outcome)) for _ in range(self.worker_count)]
+        workers.append(asyncio.create_task(self._reporter(job, progress)))
+        try:
+            chunks = self.db.iter_user_id_chunks(job["last_user_id"], self.chunk_size, bool(job["include_blocked"]))
+            async for chunk in chunks:
+                for user_id in chunk:
+                    queue.put_nowait(user_id)
+                await queue.join()
+                # وضعیت دسترس‌پذیری کاربران هر chunk در یک تراکنش ثبت می‌شود
+                await self.db.mark_users_delivered(outcome["delivered"])
+                await self.db.mark_users_blocked(outcome["blocked"])
+                outcome["delivered"].clear()
+                outcome["blocked"].clear()
+                await self.db.update_broadcast_progress(job_id, progress["cursor"], progress["sent"], progress["failed"])
+                if self._draining:
+                    logging.info(f"Broadcast {job_id} paused at user {progress['cursor']}; it resumes after restart")
+                    return
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        await self.db.finish_broadcast_job(job_id)
+        await self._report(job, progress, finished=True)
+        if self.on_finished:
+            await self.on_finished(job, progress["sent"], progress["failed"])
@@ -0,0 +1,756 @@
+import asyncio
+import contextlib
+import sqlite3
+import time
+
+import aiosqlite
+
+from metrics import DB_LOCK_WAIT_SECONDS, DB_SECONDS
+
+
+DB_PATH = "anonymous_chat.db"
+
+# --- تنظیمات اتصال ---
+# هر اتصال یک نخ (thread) جداگانه در aiosqlite دارد؛ یک نویسنده و چند خواننده
+# باعث می‌شود کوئری‌ها هرگز حلقه asyncio را مسدود نکنند.
+READER_COUNT = 4
+STATEMENT_CACHE_SIZE = 256
+
+_PRAGMAS = (
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+)
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        hashed_id TEXT PRIMARY KEY,
+        user_id INTEGER UNIQUE NOT NULL,
+        username TEXT,
+        username_norm TEXT, -- نام کاربری با حروف کوچک برای جستجو
+        username_seen_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        status TEXT NOT NULL DEFAULT 'active', -- 'active' or 'blocked'
+        blocked_at TIMESTAMP,
+        last_delivery_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_hashed_id TEXT,
+        recipient_hashed_id TEXT,
+        telegram_message_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (sender_hashed_id) REFERENCES users(hashed_id),
+        FOREIGN KEY (recipient_hashed_id) REFERENCES users(hashed_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS force_sub_targets (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        target TEXT UNIQUE NOT NULL,
+        type TEXT NOT NULL, -- 'channel' or 'link'
+        button_text TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        album_message_ids TEXT, -- شناسه‌های اجزای آلبوم با کاما؛ برای پیام تکی NULL
+        admin_chat_id INTEGER NOT NULL,
+        status_message_id INTEGER,
+        status TEXT NOT NULL DEFAULT 'running', -- 'running' or 'done'
+        include_blocked INTEGER NOT NULL DEFAULT 0,
+        last_user_id INTEGER NOT NULL DEFAULT 0,
+        total_count INTEGER NOT NULL DEFAULT 0,
+        sent_count INTEGER NOT NULL DEFAULT 0,
+        failed_count INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day TEXT PRIMARY KEY, -- YYYY-MM-DD
+        new_users INTEGER NOT NULL DEFAULT 0,
+        messages INTEGER NOT NULL DEFAULT 0,
+        replies INTEGER NOT NULL DEFAULT 0,
+        admin_contacts INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}', -- JSON
+        updated_at REAL NOT NULL -- unix time
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS channel_members (
+        channel TEXT NOT NULL, -- همان مقدار target در force_sub_targets
+        user_id INTEGER NOT NULL,
+        is_member INTEGER NOT NULL,
+        updated_at REAL NOT NULL, -- unix time
+        PRIMARY KEY (channel, user_id)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS admin_inbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        username TEXT,
+        from_chat_id INTEGER NOT NULL,
+        message_ids TEXT NOT NULL, -- شناسه پیام (یا اجزای آلبوم با کاما) در چت کاربر؛ متن فقط هنگام باز کردن کپی می‌شود
+        preview TEXT NOT NULL DEFAULT '',
+        status TEXT NOT NULL DEFAULT 'open', -- 'open' or 'answered'
+        notified INTEGER NOT NULL DEFAULT 0, -- در پیام خلاصه یا به صورت فوری به ادمین اعلام شده است
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        answered_at TIMESTAMP
+    )
+    """,
+)
+
+# ستون‌هایی که بعداً اضافه شده‌اند و باید روی پایگاه داده‌های قدیمی هم ساخته شوند
+_COLUMNS = {
+    "users": (
+        ("status", "TEXT NOT NULL DEFAULT 'active'"),
+        ("blocked_at", "TIMESTAMP"),
+        ("last_delivery_at", "TIMESTAMP"),
+        ("username_norm", "TEXT"),
+        ("username_seen_at", "TIMESTAMP"),
+    ),
+    "messages": (
+        ("created_at", "TIMESTAMP"),
+    ),
+    "broadcast_jobs": (
+        ("include_blocked", "INTEGER NOT NULL DEFAULT 0"),
+        ("album_message_ids", "TEXT"),
+    ),
+}
+
+# مقداردهی اولیه ستون‌های تازه اضافه‌شده روی داده‌های قدیمی
+_COLUMN_BACKFILLS = {
+    # اگر چند ردیف نام کاربری یکسانی داشته باشند، جدیدترین ردیف صاحب آن می‌شود
+    ("users", "username_norm"): """
+        UPDATE users SET username_norm = LOWER(username)
+        WHERE username IS NOT NULL AND rowid = (
+            SELECT MAX(u.rowid) FROM users u WHERE LOWER(u.username) = LOWER(users.username)
+        )
+    """,
+}
+
+_INDEXES = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username_norm ON users (username_norm) WHERE username_norm IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_users_status ON users (status, user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at)",
+    # بازبینی دوره‌ای عضویت از قدیمی‌ترین ردیف شروع می‌شود
+    "CREATE INDEX IF NOT EXISTS idx_channel_members_updated_at ON channel_members (updated_at)",
+    "CREATE INDEX IF NOT EXISTS idx_admin_inbox_status ON admin_inbox (status, id)",
+    "CREATE INDEX IF NOT EXISTS idx_admin_inbox_user ON admin_inbox (user_id, status)",
+    # صف پیام خلاصه فقط موارد اعلام‌نشده را دربر می‌گیرد
+    "CREATE INDEX IF NOT EXISTS idx_admin_inbox_pending ON admin_inbox (id) WHERE notified = 0",
+    # پاک‌سازی دوره‌ای پیام‌های قدیمی به ترتیب created_at پیش می‌رود
+    "CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_hashed_id)",
+    "CREATE INDEX IF NOT EXISTS idx_messages_recipient ON messages (recipient_hashed_id)",
+)
+
+# پیام‌های قدیمی‌تر از ستون created_at زمان ارتقا را می‌گیرند تا مهلت پاسخ از همان لحظه حساب شود
+_REPAIRS = (
+    "UPDATE messages SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL",
+)
+
+# آمار روزانه در همان تراکنش نوشتن به‌روز می‌شود تا پنل آمار نیازی به اسکن جدول‌ها نداشته باشد
+_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_users_daily_stats AFTER INSERT ON users
+    BEGIN
+        INSERT INTO daily_stats (day, new_users) VALUES (DATE(COALESCE(NEW.created_at, 'now')), 1)
+        ON CONFLICT (day) DO UPDATE SET new_users = new_users + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_messages_daily_stats AFTER INSERT ON messages
+    BEGIN
+        INSERT INTO daily_stats (day, messages) VALUES (DATE(COALESCE(NEW.created_at, 'now')), 1)
+        ON CONFLICT (day) DO UPDATE SET messages = messages + 1;
+    END
+    """,
+)
+
+# پر کردن آمار روزانه برای پایگاه داده‌هایی که قبل از جدول daily_stats ساخته شده‌اند
+_BACKFILL_DAILY_STATS = (
+    """
+    INSERT INTO daily_stats (day, new_users)
+    SELECT DATE(COALESCE(created_at, 'now')), COUNT(*) FROM users GROUP BY 1
+    """,
+    """
+    INSERT INTO daily_stats (day, messages)
+    SELECT DATE(COALESCE(created_at, 'now')), COUNT(*) FROM messages WHERE true GROUP BY 1
+    ON CONFLICT (day) DO UPDATE SET messages = excluded.messages
+    """,
+)
+
+DAILY_STATS_EVENTS = ("replies", "admin_contacts")
+
+# --- کوئری‌ها ---
+# متن ثابت هر کوئری باعث می‌شود sqlite3 نسخه آماده (prepared) آن را از کش
+# هر اتصال دوباره استفاده کند.
+
+# استارت دوباره یعنی کاربر ربات را آنبلاک کرده است
+SQL_INSERT_USER = (
+    "INSERT INTO users (user_id, hashed_id) VALUES (?, ?) "
+    "ON CONFLICT (hashed_id) DO UPDATE SET status = 'active', blocked_at = NULL WHERE status != 'active'"
+)
+# نام کاربری منتقل‌شده از صاحب قبلی گرفته می‌شود (آخرین مشاهده برنده است)
+SQL_RELEASE_USERNAME = "UPDATE users SET username_norm = NULL WHERE username_norm = ? AND user_id != ?"
+SQL_UPDATE_USERNAME = (
+    "UPDATE users SET username = ?, username_norm = ?, username_seen_at = CURRENT_TIMESTAMP "
+    "WHERE user_id = ? AND (username IS NOT ? OR username_norm IS NOT ?)"
+)
+SQL_USER_ID_BY_HASH = "SELECT user_id FROM users WHERE hashed_id = ?"
+SQL_USER_ID_BY_USERNAME = "SELECT user_id FROM users WHERE username_norm = ?"
+# صفحه‌بندی keyset: هر صفحه از ایندکس شروع می‌شود و هزینه‌اش به شماره صفحه بستگی ندارد
+SQL_USERS_AFTER = "SELECT user_id, username, username_norm, status FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?"
+SQL_USERS_BEFORE = (
+    "SELECT user_id, username, username_norm, status FROM users WHERE user_id < ? ORDER BY user_id DESC LIMIT ?"
+)
+SQL_USERS_PREFIX_FROM = (
+    "SELECT user_id, username, username_norm, status FROM users "
+    "WHERE username_norm >= ? AND username_norm < ? ORDER BY username_norm LIMIT ?"
+)
+SQL_USERS_PREFIX_AFTER = (
+    "SELECT user_id, username, username_norm, status FROM users "
+    "WHERE username_norm > ? AND username_norm < ? ORDER BY username_norm LIMIT ?"
+)
+SQL_USERS_PREFIX_BEFORE = (
+    "SELECT user_id, username, username_norm, status FROM users "
+    "WHERE username_norm < ? AND username_norm >= ? ORDER BY username_norm DESC LIMIT ?"
+)
+SQL_EXPORT_USERS_AFTER = (
+    "SELECT user_id, username, hashed_id, created_at, status, blocked_at, last_delivery_at FROM users "
+    "WHERE user_id > ? ORDER BY user_id LIMIT ?"
+)
+# شناسه پیام‌های write-behind به صورت بلوکی از sqlite_sequence برداشته می‌شود
+SQL_ENSURE_MESSAGE_SEQUENCE = (
+    "INSERT INTO sqlite_sequence (name, seq) SELECT 'messages', (SELECT COALESCE(MAX(id), 0) FROM messages) "
+    "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'messages')"
+)
+SQL_ALLOCATE_MESSAGE_IDS = "UPDATE sqlite_sequence SET seq = seq + ? WHERE name = 'messages' RETURNING seq"
+SQL_INSERT_MESSAGE = (
+    "INSERT INTO messages (id, sender_hashed_id, recipient_hashed_id, telegram_message_id, created_at) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+SQL_MESSAGE_SENDER_IDENTITY = (
+    "SELECT m.sender_hashed_id, u.user_id, m.created_at FROM messages m "
+    "LEFT JOIN users u ON u.hashed_id = m.sender_hashed_id WHERE m.id = ?"
+)
+# شناسه‌ها صعودی‌اند و پاک‌سازی از قدیمی‌ترین پیام شروع می‌شود
+SQL_MESSAGE_ID_EXPIRED = (
+    "SELECT ? < COALESCE((SELECT MIN(id) FROM messages), "
+    "(SELECT seq + 1 FROM sqlite_sequence WHERE name = 'messages'), 0)"
+)
+SQL_EXPIRED_MESSAGES = (
+    "SELECT id, sender_hashed_id, recipient_hashed_id, telegram_message_id, created_at FROM messages "
+    "WHERE created_at < DATETIME('now', ?) ORDER BY created_at LIMIT ?"
+)
+SQL_DELETE_MESSAGE = "DELETE FROM messages WHERE id = ?"
+SQL_COUNT_USERS = "SELECT COUNT(*) FROM users"
+SQL_CHANNEL_MEMBER = "SELECT is_member FROM channel_members WHERE channel = ? AND user_id = ?"
+SQL_UPSERT_CHANNEL_MEMBER = (
+    "INSERT INTO channel_members (channel, user_id, is_member, updated_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (channel, user_id) DO UPDATE SET is_member = excluded.is_member, updated_at = excluded.updated_at"
+)
+SQL_COUNT_CHANNEL_MEMBERS = "SELECT channel, SUM(is_member), COUNT(*) FROM channel_members GROUP BY channel"
+SQL_INSERT_INBOX_ITEM = (
+    "INSERT INTO admin_inbox (user_id, username, from_chat_id, message_ids, preview, notified) VALUES (?, ?, ?, ?, ?, ?)"
+)
+SQL_INBOX_COLUMNS = "id, user_id, username, from_chat_id, message_ids, preview, status, created_at"
+SQL_INBOX_ITEM = f"SELECT {SQL_INBOX_COLUMNS} FROM admin_inbox WHERE id = ?"
+SQL_INBOX_PENDING = f"SELECT {SQL_INBOX_COLUMNS} FROM admin_inbox WHERE notified = 0 ORDER BY id LIMIT ?"
+SQL_MARK_INBOX_NOTIFIED = "UPDATE admin_inbox SET notified = 1 WHERE id = ?"
+# پاسخ ادمین همه موارد باز قبلی همان کاربر را هم بسته می‌کند (یک رشته گفتگو)
+SQL_MARK_INBOX_ANSWERED = (
+    "UPDATE admin_inbox SET status = 'answered', answered_at = CURRENT_TIMESTAMP "
+    "WHERE user_id = ? AND status = 'open' AND id <= ?"
+)
+SQL_COUNT_INBOX = "SELECT status, COUNT(*) FROM admin_inbox GROUP BY status"
+SQL_DAILY_STATS_TOTALS = (
+    "SELECT COALESCE(SUM(new_users), 0), COALESCE(SUM(messages), 0), "
+    "COALESCE(SUM(replies), 0), COALESCE(SUM(admin_contacts), 0) FROM daily_stats WHERE day >= ?"
+)
+SQL_DAILY_STATS_HISTORY = (
+    "SELECT day, new_users, messages, replies, admin_contacts FROM daily_stats WHERE day >= ? ORDER BY day"
+)
+SQL_DAILY_STATS_EMPTY = "SELECT NOT EXISTS (SELECT 1 FROM daily_stats)"
+SQL_USER_IDS_AFTER = "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?"
+SQL_ACTIVE_USER_IDS_AFTER = "SELECT user_id FROM users WHERE status = 'active' AND user_id > ? ORDER BY user_id LIMIT ?"
+SQL_COUNT_ACTIVE_USERS = "SELECT COUNT(*) FROM users WHERE status = 'active'"
+SQL_COUNT_BLOCKED_USERS = "SELECT COUNT(*) FROM users WHERE status = 'blocked'"
+SQL_MARK_USER_BLOCKED = "UPDATE users SET status = 'blocked', blocked_at = CURRENT_TIMESTAMP WHERE user_id = ? AND status != 'blocked'"
+SQL_MARK_USER_DELIVERED = "UPDATE users SET status = 'active', blocked_at = NULL, last_delivery_at = CURRENT_TIMESTAMP WHERE user_id = ?"
+SQL_INSERT_BROADCAST_JOB = (
+    "INSERT INTO broadcast_jobs (from_chat_id, message_id, album_message_ids, admin_chat_id, status_message_id, "
+    "include_blocked, total_count) VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_BROADCAST_JOB = "SELECT * FROM broadcast_jobs WHERE id = ?"
+SQL_RUNNING_BROADCAST_JOBS = "SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id"
+SQL_UPDATE_BROADCAST_PROGRESS = "UPDATE broadcast_jobs SET last_user_id = ?, sent_count = ?, failed_count = ? WHERE id = ?"
+SQL_FINISH_BROADCAST_JOB = "UPDATE broadcast_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = ?"
+SQL_FSM_RECORD = "SELECT state, data FROM fsm_states WHERE key = ?"
+SQL_UPSERT_FSM_RECORD = (
+    "INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at"
+)
+SQL_DELETE_FSM_RECORD = "DELETE FROM fsm_states WHERE key = ?"
+SQL_EXPIRE_FSM_RECORDS = "DELETE FROM fsm_states WHERE updated_at < ?"
+SQL_COUNT_FSM_STATES = "SELECT COALESCE(state, ''), COUNT(*) FROM fsm_states GROUP BY 1"
+SQL_FORCE_SUB_TARGETS = "SELECT target, type, button_text FROM force_sub_targets"
+SQL_INSERT_FORCE_SUB_TARGET = "INSERT INTO force_sub_targets (target, type, button_text) VALUES (?, ?, ?)"
+SQL_DELETE_FORCE_SUB_TARGET = "DELETE FROM force_sub_targets WHERE target = ?"
+
+
+def normalize_username(username: str | None) -> str | None:
+    if not username:
+        return None
+    return username.lstrip('@').lower() or None
+
+
+class Database:
+    """لایه دسترسی ناهمگام به پایگاه داده با اتصال‌های ماندگار (WAL)"""
+
+    def __init__(self, path: str = DB_PATH, readers: int = READER_COUNT):
+        self.path = path
+        self.reader_count = readers
+        self._writer: aiosqlite.Connection | None = None
+        self._readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._all_readers: list[aiosqlite.Connection] = []
+        self._write_lock = asyncio.Lock()
+
+    async def _open(self, read_only: bool) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in _PRAGMAS:
+            await conn.execute(pragma)
+        if read_only:
+            await conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    async def connect(self):
+        self._writer = await self._open(read_only=False)
+        # فقط روی پایگاه داده تازه اثر دارد؛ فایل‌های موجود یک بار VACUUM کامل لازم دارند
+        await self._writer.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await self._writer.execute("PRAGMA journal_mode = WAL")
+        # قفل نوشتن از ابتدا گرفته می‌شود تا چند پردازه هم‌زمان مهاجرت را دوباره اجرا نکنند
+        await self._writer.execute("BEGIN IMMEDIATE")
+        for statement in _SCHEMA:
+            await self._writer.execute(statement)
+        await self._migrate()
+        for statement in _INDEXES + _TRIGGERS + _REPAIRS:
+            await self._writer.execute(statement)
+        async with self._writer.execute(SQL_DAILY_STATS_EMPTY) as cursor:
+            if (await cursor.fetchone())[0]:
+                for statement in _BACKFILL_DAILY_STATS:
+                    await self._writer.execute(statement)
+        await self._writer.commit()
+
+        for _ in range(self.reader_count):
+            conn = await self._open(read_only=True)
+            self._all_readers.append(conn)
+            self._readers.put_nowait(conn)
+
+    async def _migrate(self):
+        for table, columns in _COLUMNS.items():
+            async with self._writer.execute(f"PRAGMA table_info({table})") as cursor:
+                existing = {row[1] for row in await cursor.fetchall()}
+            for name, definition in columns:
+                if name not in existing:
+                    await self._writer.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+                    if (table, name) in _COLUMN_BACKFILLS:
+                        await self._writer.execute(_COLUMN_BACKFILLS[(table, name)])
+
+    async def close(self):
+        for conn in self._all_readers:
+            await conn.close()
+        self._all_readers.clear()
+        self._readers = asyncio.Queue()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    # --- عملیات پایه ---
+    async def fetchone(self, sql: str, params: tuple = ()):
+        conn = await self._readers.get()
+        try:
+            with DB_SECONDS.time("fetchone"):
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchone()
+        finally:
+            self._readers.put_nowait(conn)
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        conn = await self._readers.get()
+        try:
+            with DB_SECONDS.time("fetchall"):
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchall()
+        finally:
+            self._readers.put_nowait(conn)
+
+    async def fetchdict(self, sql: str, params: tuple = ()) -> dict | None:
+        conn = await self._readers.get()
+        try:
+            with DB_SECONDS.time("fetchdict"):
+                async with conn.execute(sql, params) as cursor:
+                    row = await cursor.fetchone()
+                    return dict(zip([col[0] for col in cursor.description], row)) if row else None
+        finally:
+            self._readers.put_nowait(conn)
+
+    async def fetchval(self, sql: str, params: tuple = ()):
+        row = await self.fetchone(sql, params)
+        return row[0] if row else None
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, operation: str = "transaction"):
+        """اتصال نویسنده را برای چند دستور در یک تراکنش در اختیار می‌گذارد
+
+        زمان کل تراکنش تا پایان commit با برچسب operation ثبت می‌شود.
+        """
+        waiting_since = time.perf_counter()
+        async with self._write_lock:
+            DB_LOCK_WAIT_SECONDS.observe(time.perf_counter() - waiting_since)
+            with DB_SECONDS.time(operation):
+                try:
+                    yield self._writer
+                    await self._writer.commit()
+                except BaseException:
+                    await self._writer.rollback()
+                    raise
+
+    async def execute(self, sql: str, params: tuple = ()) -> tuple[int, int]:
+        """یک دستور نوشتنی را اجرا و commit می‌کند؛ خروجی (lastrowid, rowcount) است"""
+        async with self.transaction("execute") as conn:
+            async with conn.execute(sql, params) as cursor:
+                return cursor.lastrowid, cursor.rowcount
+
+    async def executemany(self, sql: str, seq_of_params) -> None:
+        """چند ردیف را در یک تراکنش (یک fsync) می‌نویسد"""
+        async with self.transaction("executemany") as conn:
+            await conn.executemany(sql, seq_of_params)
+
+    # --- کاربران ---
+    async def add_user(self, user_id: int, username: str | None, hashed_id: str):
+        async with self.transaction() as conn:
+            await conn.execute(SQL_INSERT_USER, (user_id, hashed_id))
+            await self._set_username(conn, user_id, username)
+
+    async def update_username(self, user_id: int, username: str | None):
+        """فقط اگر نام کاربری تغییر کرده باشد چیزی نوشته می‌شود"""
+        async with self.transaction() as conn:
+            await self._set_username(conn, user_id, username)
+
+    @staticmethod
+    async def _set_username(conn: aiosqlite.Connection, user_id: int, username: str | None):
+        username_norm = normalize_username(username)
+        if username_norm:
+            await conn.execute(SQL_RELEASE_USERNAME, (username_norm, user_id))
+        await conn.execute(SQL_UPDATE_USERNAME, (username, username_norm, user_id, username, username_norm))
+
+    async def get_user_id_by_hash(self, hashed_id: str) -> int | None:
+        return await self.fetchval(SQL_USER_ID_BY_HASH, (hashed_id,))
+
+    async def get_user_by_username(self, username: str) -> int | None:
+        username_norm = normalize_username(username)
+        if not username_norm:
+            return None
+        return await self.fetchval(SQL_USER_ID_BY_USERNAME, (username_norm,))
+
+    async def iter_user_id_chunks(self, after: int = 0, chunk_size: int = 500, include_blocked: bool = False):
+        """شناسه کاربران را به صورت صفحه‌بندی keyset (بر اساس user_id) برمی‌گرداند"""
+        sql = SQL_USER_IDS_AFTER if include_blocked else SQL_ACTIVE_USER_IDS_AFTER
+        while True:
+            rows = await self.fetchall(sql, (after, chunk_size))
+            if not rows:
+                return
+            chunk = [row[0] for row in rows]
+            yield chunk
+            after = chunk[-1]
+
+    async def count_users(self, include_blocked: bool = True) -> int:
+        return await self.fetchval(SQL_COUNT_USERS if include_blocked else SQL_COUNT_ACTIVE_USERS)
+
+    # --- دسترس‌پذیری کاربران ---
+    async def mark_user_blocked(self, user_id: int):
+        await self.execute(SQL_MARK_USER_BLOCKED, (user_id,))
+
+    async def mark_user_delivered(self, user_id: int):
+        await self.execute(SQL_MARK_USER_DELIVERED, (user_id,))
+
+    async def mark_users_blocked(self, user_ids: list[int]):
+        if user_ids:
+            await self.executemany(SQL_MARK_USER_BLOCKED, [(user_id,) for user_id in user_ids])
+
+    async def mark_users_delivered(self, user_ids: list[int]):
+        if user_ids:
+            await self.executemany(SQL_MARK_USER_DELIVERED, [(user_id,) for user_id in user_ids])
+
+    async def get_users_page(self, after: int = 0, before: int | None = None, limit: int = 20) -> list:
+        """(user_id, username, username_norm, status) به ترتیب user_id؛ با before صفحه قبلی برعکس برمی‌گردد"""
+        if before is not None:
+            return await self.fetchall(SQL_USERS_BEFORE, (before, limit))
+        return await self.fetchall(SQL_USERS_AFTER, (after, limit))
+
+    async def search_users_by_prefix(self, prefix: str, after: str | None = None, before: str | None = None,
+                                     limit: int = 20) -> list:
+        """جستجوی پیشوند نام کاربری روی ایندکس username_norm با همان قالب get_users_page"""
+        prefix = normalize_username(prefix) or ""
+        upper = prefix + "\U0010ffff"
+        if before is not None:
+            return await self.fetchall(SQL_USERS_PREFIX_BEFORE, (before, prefix, limit))
+        if after is not None:
+            return await self.fetchall(SQL_USERS_PREFIX_AFTER, (after, upper, limit))
+        return await self.fetchall(SQL_USERS_PREFIX_FROM, (prefix, upper, limit))
+
+    async def iter_user_export_chunks(self, chunk_size: int = 1000):
+        """همه ستون‌های قابل خروجی users را chunk به chunk برمی‌گرداند"""
+        after = 0
+        while True:
+            rows = await self.fetchall(SQL_EXPORT_USERS_AFTER, (after, chunk_size))
+            if not rows:
+                return
+            yield rows
+            after = rows[-1][0]
+
+    # --- پیام‌ها ---
+    async def allocate_message_ids(self, count: int) -> int:
+        """count شناسه پیاپی رزرو می‌کند و اولین آن‌ها را برمی‌گرداند"""
+        async with self.transaction("allocate_message_ids") as conn:
+            await conn.execute(SQL_ENSURE_MESSAGE_SEQUENCE)
+            async with conn.execute(SQL_ALLOCATE_MESSAGE_IDS, (count,)) as cursor:
+                return (await cursor.fetchone())[0] - count + 1
+
+    async def get_message_sender_identity(self, db_message_id: int) -> tuple | None:
+        """(sender_hashed_id, user_id, created_at) فرستنده پیام؛ None اگر پیام وجود نداشته باشد"""
+        return await self.fetchone(SQL_MESSAGE_SENDER_IDENTITY, (db_message_id,))
+
+    async def is_message_id_expired(self, db_message_id: int) -> bool:
+        """پیامی که دیگر وجود ندارد توسط پاک‌سازی دوره‌ای حذف شده است یا هرگز ارسال نشده بود"""
+        return bool(await self.fetchval(SQL_MESSAGE_ID_EXPIRED, (db_message_id,)))
+
+    async def get_expired_messages(self, older_than: int, limit: int) -> list:
+        return await self.fetchall(SQL_EXPIRED_MESSAGES, (f"-{older_than} seconds", limit))
+
+    async def delete_messages(self, ids: list[int]):
+        if ids:
+            await self.executemany(SQL_DELETE_MESSAGE, [(message_id,) for message_id in ids])
+
+    async def get_auto_vacuum_mode(self) -> int:
+        """0 = NONE، 1 = FULL، 2 = INCREMENTAL"""
+        return await self.fetchval("PRAGMA auto_vacuum")
+
+    async def incremental_vacuum(self, pages: int) -> int:
+        """حداکثر pages صفحه آزاد را به سیستم‌عامل برمی‌گرداند؛ خروجی تعداد صفحات آزاد باقی‌مانده است"""
+        async with self.transaction("incremental_vacuum") as conn:
+            # هر گام این pragma یک صفحه آزاد می‌کند، پس باید تا انتها خوانده شود
+            async with conn.execute(f"PRAGMA incremental_vacuum({int(pages)})") as cursor:
+                await cursor.fetchall()
+            async with conn.execute("PRAGMA freelist_count") as cursor:
+                return (await cursor.fetchone())[0]
+
+    # --- عضویت کانال‌ها ---
+    async def get_channel_member(self, channel: str, user_id: int) -> bool | None:
+        """None یعنی این جفت هنوز در نمایه عضویت ثبت نشده است"""
+        value = await self.fetchval(SQL_CHANNEL_MEMBER, (channel, user_id))
+        return None if value is None else bool(value)
+
+    async def set_channel_member(self, channel: str, user_id: int, is_member: bool):
+        await self.execute(SQL_UPSERT_CHANNEL_MEMBER, (channel, user_id, is_member, time.time()))
+
+    async def set_channel_members(self, rows: list[tuple[str, int, bool, float]]):
+        """ردیف‌ها به شکل (channel, user_id, is_member, updated_at)"""
+        if rows:
+            await self.executemany(SQL_UPSERT_CHANNEL_MEMBER, rows)
+
+    async def get_stale_channel_members(self, channels: list[str], older_than: float, limit: int) -> list:
+        """قدیمی‌ترین ردیف‌های channels؛ ردیف کانال‌های دیگر جای ردیف‌های قابل بازبینی را نمی‌گیرند"""
+        if not channels:
+            return []
+        placeholders = ", ".join("?" * len(channels))
+        return await self.fetchall(
+            f"SELECT channel, user_id, is_member FROM channel_members WHERE channel IN ({placeholders}) "
+            f"AND updated_at < ? ORDER BY updated_at LIMIT ?",
+            (*channels, older_than, limit),
+        )
+
+    async def delete_channel_members_except(self, channels: list[str]) -> int:
+        """ردیف کانال‌هایی که دیگر هدف عضویت اجباری نیستند حذف می‌شوند"""
+        placeholders = ", ".join("?" * len(channels))
+        _, rowcount = await self.execute(f"DELETE FROM channel_members WHERE channel NOT IN ({placeholders})", tuple(channels))
+        return rowcount
+
+    async def count_channel_members(self) -> list:
+        """(channel, members, indexed) برای هر کانال"""
+        return await self.fetchall(SQL_COUNT_CHANNEL_MEMBERS)
+
+    # --- صندوق پیام ادمین ---
+    async def add_inbox_item(self, user_id: int, username: str | None, from_chat_id: int, message_ids: list[int],
+                             preview: str, notified: bool) -> int:
+        lastrowid, _ = await self.execute(
+            SQL_INSERT_INBOX_ITEM,
+            (user_id, username, from_chat_id, ",".join(map(str, message_ids)), preview, int(notified)),
+        )
+        return lastrowid
+
+    async def get_inbox_item(self, item_id: int) -> dict | None:
+        return await self.fetchdict(SQL_INBOX_ITEM, (item_id,))
+
+    async def get_pending_inbox_items(self, limit: int) -> list:
+        """مواردی که هنوز در هیچ پیام خلاصه‌ای اعلام نشده‌اند، قدیمی‌ترین اول"""
+        return await self.fetchall(SQL_INBOX_PENDING, (limit,))
+
+    async def mark_inbox_notified(self, item_ids: list[int]):
+        if item_ids:
+            await self.executemany(SQL_MARK_INBOX_NOTIFIED, [(item_id,) for item_id in item_ids])
+
+    async def mark_inbox_answered(self, user_id: int, up_to_id: int) -> int:
+        _, rowcount = await self.execute(SQL_MARK_INBOX_ANSWERED, (user_id, up_to_id))
+        return rowcount
+
+    async def get_inbox_page(self, status: str | None = None, before: int | None = None, after: int | None = None,
+                             limit: int = 10) -> list:
+        """جدیدترین موارد اول؛ با after صفحه جدیدتر به ترتیب صعودی برمی‌گردد"""
+        where, params = [], []
+        if status is not None:
+            where.append("status = ?")
+            params.append(status)
+        if after is not None:
+            where.append("id > ?")
+            params.append(after)
+        elif before is not None:
+            where.append("id < ?")
+            params.append(before)
+        order = "ASC" if after is not None else "DESC"
+        sql = f"SELECT {SQL_INBOX_COLUMNS} FROM admin_inbox"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return await self.fetchall(f"{sql} ORDER BY id {order} LIMIT ?", (*params, limit))
+
+    async def count_inbox_items(self) -> dict:
+        return dict(await self.fetchall(SQL_COUNT_INBOX))
+
+    # --- نوشتن دسته‌ای ---
+    async def write_batch(self, users: dict, usernames: dict, messages: list, delivered: set, events: dict,
+                          members: dict | None = None):
+        """نوشته‌های تجمیع‌شده write-behind را در یک تراکنش (یک fsync) ثبت می‌کند
+
+        users: user_id → hashed_id، usernames: user_id → username، messages: ردیف‌های
+        SQL_INSERT_MESSAGE، delivered: user_idها، events: رویداد روزانه → تعداد،
+        members: (channel, user_id) → (is_member, updated_at).
+        """
+        async with self.transaction("write_batch") as conn:
+            if users:
+                await conn.executemany(SQL_INSERT_USER, list(users.items()))
+            for user_id, username in usernames.items():
+                await self._set_username(conn, user_id, username)
+            if messages:
+                await conn.executemany(SQL_INSERT_MESSAGE, messages)
+            if delivered:
+                await conn.executemany(SQL_MARK_USER_DELIVERED, [(user_id,) for user_id in delivered])
+            if members:
+                await conn.executemany(SQL_UPSERT_CHANNEL_MEMBER, [
+                    (channel, user_id, is_member, updated_at)
+                    for (channel, user_id), (is_member, updated_at) in members.items()
+                ])
+            for event, count in events.items():
+                await conn.execute(
+                    f"INSERT INTO daily_stats (day, {event}) VALUES (DATE('now'), ?) "
+                    f"ON CONFLICT (day) DO UPDATE SET {event} = {event} + excluded.{event}",
+                    (count,),
+                )
+
+    # --- آمار ---
+    async def record_daily_event(self, event: str):
+        """یک رویداد بدون جدول اختصاصی (پاسخ، تماس با ادمین) را در آمار امروز ثبت می‌کند"""
+        if event not in DAILY_STATS_EVENTS:
+            raise ValueError(f"Unknown daily stats event: {event}")
+        await self.execute(
+            f"INSERT INTO daily_stats (day, {event}) VALUES (DATE('now'), 1) "
+            f"ON CONFLICT (day) DO UPDATE SET {event} = {event} + 1"
+        )
+
+    async def get_daily_totals(self, since: str = "") -> dict:
+        """جمع آمار روزانه از تاریخ since (YYYY-MM-DD) تا امروز؛ رشته خالی یعنی از ابتدا"""
+        row = await self.fetchone(SQL_DAILY_STATS_TOTALS, (since,))
+        return dict(zip(("new_users", "messages", "replies", "admin_contacts"), row))
+
+    async def get_daily_history(self, since: str) -> list:
+        return await self.fetchall(SQL_DAILY_STATS_HISTORY, (since,))
+
+    async def count_blocked_users(self) -> int:
+        return await self.fetchval(SQL_COUNT_BLOCKED_USERS)
+
+    # --- پیام همگانی ---
+    async def create_broadcast_job(self, from_chat_id: int, message_id: int, admin_chat_id: int,
+                                   status_message_id: int | None, include_blocked: bool, total_count: int,
+                                   album_message_ids: list[int] | None = None) -> int:
+        album = ",".join(map(str, album_message_ids)) if album_message_ids else None
+        lastrowid, _ = await self.execute(
+            SQL_INSERT_BROADCAST_JOB,
+            (from_chat_id, message_id, album, admin_chat_id, status_message_id, int(include_blocked), total_count),
+        )
+        return lastrowid
+
+    async def get_broadcast_job(self, job_id: int) -> dict | None:
+        return await self.fetchdict(SQL_BROADCAST_JOB, (job_id,))
+
+    async def get_running_broadcast_job_ids(self) -> list[int]:
+        return [row[0] for row in await self.fetchall(SQL_RUNNING_BROADCAST_JOBS)]
+
+    async def update_broadcast_progress(self, job_id: int, last_user_id: int, sent_count: int, failed_count: int):
+        await self.execute(SQL_UPDATE_BROADCAST_PROGRESS, (last_user_id, sent_count, failed_count, job_id))
+
+    async def finish_broadcast_job(self, job_id: int):
+        await self.execute(SQL_FINISH_BROADCAST_JOB, (job_id,))
+
+    # --- وضعیت گفتگوها (FSM) ---
+    async def get_fsm_record(self, key: str) -> tuple | None:
+        return await self.fetchone(SQL_FSM_RECORD, (key,))
+
+    async def save_fsm_records(self, upserts: list[tuple], deletes: list[str]):
+        """همه تغییرات یک دسته را در یک تراکنش می‌نویسد"""
+        async with self.transaction() as conn:
+            if upserts:
+                await conn.executemany(SQL_UPSERT_FSM_RECORD, upserts)
+            if deletes:
+                await conn.executemany(SQL_DELETE_FSM_RECORD, [(key,) for key in deletes])
+
+    async def expire_fsm_records(self, before: float) -> int:
+        _, rowcount = await self.execute(SQL_EXPIRE_FSM_RECORDS, (before,))
+        return rowcount
+
+    async def count_fsm_states(self) -> list:
+        """تعداد گفتگوها در هر state؛ state خالی یعنی فقط data ذخیره شده است"""
+        return await self.fetchall(SQL_COUNT_FSM_STATES)
+
+    # --- عضویت اجباری ---
+    async def get_force_sub_targets(self) -> list:
+        return await self.fetchall(SQL_FORCE_SUB_TARGETS)
+
+    async def add_force_sub_target(self, target: str, target_type: str, button_text: str) -> bool:
+        try:
+            await self.execute(SQL_INSERT_FORCE_SUB_TARGET, (target, target_type, button_text))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    async def remove_force_sub_target(self, target: str) -> bool:
+        _, rowcount = await self.execute(SQL_DELETE_FORCE_SUB_TARGET, (target,))
+        return rowcount > 0
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+
+# --- تنظیمات کنترل سیل پیام ---
+# برای هر کلاس عمل: (نرخ پر شدن سطل در ثانیه، ظرفیت انفجاری)
+ACTION_LIMITS = {
+    "anonymous": (1 / 3, 10),       # هر ارسال ناشناس چند مرحله (دکمه، گیرنده، پیام) مصرف می‌کند
+    "admin_contact": (1 / 20, 4),
+    "callback": (1, 10),
+    "message": (1, 15),             # بقیه پیام‌ها (منوها، /start و ...)
+}
+MUTE_AFTER = 10                     # پس از این تعداد پیام محدودشده پشت سر هم کاربر موقتاً ساکت می‌شود
+MUTE_SECONDS = 60
+MAX_TRACKED_USERS = 50_000
+SWEEP_INTERVAL = 300
+
+
+class _UserState:
+    __slots__ = ("tokens", "updated", "strikes", "muted_until", "warned")
+
+    def __init__(self, capacities: list[float], now: float):
+        self.tokens = list(capacities)
+        self.updated = now
+        self.strikes = 0
+        self.muted_until = 0.0
+        self.warned = False
+
+
+class FloodLimiter:
+    """سطل توکن جدا برای هر کاربر و هر کلاس عمل، فقط در حافظه همین پردازه
+
+    کاربری که سطلش پر است با کاربر ناشناخته فرقی ندارد، پس پاک‌سازی دوره‌ای چنین
+    ردیف‌هایی را حذف می‌کند و در بدترین حالت قدیمی‌ترین کاربر کنار گذاشته می‌شود.
+    """
+
+    def __init__(self, limits: dict | None = None, mute_after: int = MUTE_AFTER, mute_seconds: float = MUTE_SECONDS,
+                 max_users: int = MAX_TRACKED_USERS):
+        limits = limits or ACTION_LIMITS
+        self.actions = {action: i for i, action in enumerate(limits)}
+        self.rates = [rate for rate, _ in limits.values()]
+        self.capacities = [float(burst) for _, burst in limits.values()]
+        self.mute_after = mute_after
+        self.mute_seconds = mute_seconds
+        self.max_users = max_users
+        self._users: OrderedDict[int, _UserState] = OrderedDict()
+        self.allowed = dict.fromkeys(limits, 0)
+        self.throttled = dict.fromkeys(limits, 0)
+        self.mutes = 0
+
+    def _refill(self, state: _UserState, now: float):
+        elapsed = now - state.updated
+        if elapsed > 0:
+            state.tokens = [
+                min(capacity, tokens + elapsed * rate)
+                for tokens, rate, capacity in zip(state.tokens, self.rates, self.capacities)
+            ]
+            state.updated = now
+
+    def check(self, user_id: int, action: str) -> str:
+        """یکی از allow، warn (اولین رد در این دوره)، mute (تازه ساکت شد) یا drop"""
+        now = time.monotonic()
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _UserState(self.capacities, now)
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+
+        index = self.actions[action]
+        if now < state.muted_until:
+            self.throttled[action] += 1
+            return "drop"
+
+        self._refill(state, now)
+        if state.tokens[index] >= 1:
+            state.tokens[index] -= 1
+            state.strikes = 0
+            state.warned = False
+            self.allowed[action] += 1
+            return "allow"
+
+        self.throttled[action] += 1
+        state.strikes += 1
+        if state.strikes >= self.mute_after:
+            state.muted_until = now + self.mute_seconds
+            state.strikes = 0
+            self.mutes += 1
+            return "mute"
+        if not state.warned:
+            state.warned = True
+            return "warn"
+        return "drop"
+
+    def sweep(self) -> int:
+        """کاربرانی که سطل‌هایشان دوباره پر شده و ساکت نیستند را حذف می‌کند"""
+        now = time.monotonic()
+        idle = []
+        for user_id, state in self._users.items():
+            if now < state.muted_until:
+                continue
+            self._refill(state, now)
+            if state.tokens == self.capacities:
+                idle.append(user_id)
+        for user_id in idle:
+            del self._users[user_id]
+        return len(idle)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "tracked": len(self._users),
+            "muted_now": sum(1 for s in self._users.values() if now < s.muted_until),
+            "mutes": self.mutes,
+            "allowed": dict(self.allowed),
+            "throttled": dict(self.throttled),
+        }
+
+    async def run_periodically(self, interval: float = SWEEP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            removed = self.sweep()
+            if removed:
+                logging.debug(f"Flood control swept {removed} idle users, {len(self._users)} tracked")
+
+
+class FloodControlMiddleware(BaseMiddleware):
+    """آپدیت‌های بیش از حد را پیش از هر کار پرهزینه (عضویت اجباری، پایگاه داده) دور می‌ریزد
+
+    classify کلاس عمل را از روی آپدیت و data برمی‌گرداند؛ None یعنی بدون محدودیت (مثلاً ادمین).
+    به هر دوره محدودیت فقط یک هشدار داده می‌شود تا خود هشدارها سیل نسازند.
+    """
+
+    def __init__(self, limiter: FloodLimiter, classify: Callable[[TelegramObject, dict[str, Any]], str | None]):
+        self.limiter = limiter
+        self.classify = classify
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        action = self.classify(event, data)
+        if action is None:
+            return await handler(event, data)
+        verdict = self.limiter.check(data["event_from_user"].id, action)
+        if verdict == "allow":
+            return await handler(event, data)
+        if verdict == "warn":
+            await self._notify(event, "⏳ تعداد درخواست‌های شما زیاد است؛ لطفاً کمی صبر کنید.")
+        elif verdict == "mute":
+            await self._notify(
+                event, f"⛔️ به دلیل ارسال بیش از حد، تا {int(self.limiter.mute_seconds)} ثانیه درخواست‌های شما پردازش نمی‌شود."
+            )
+        return None
+
+    @staticmethod
+    async def _notify(event: TelegramObject, text: str):
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(text, show_alert=True)
+            elif isinstance(event, Message):
+                await event.answer(text)
+        except Exception as e:
+            logging.debug(f"Flood control notice failed: {e}")
@@ -0,0 +1,187 @@
+import asyncio
+import copy
+import json
+import logging
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from database import Database
+
+
+# --- تنظیمات ذخیره‌سازی وضعیت گفتگو ---
+FLUSH_INTERVAL = 0.05     # تغییرات حداکثر ۵۰ میلی‌ثانیه در حافظه می‌مانند
+FLUSH_BATCH_SIZE = 200
+CACHE_SIZE = 50_000
+IDLE_TTL = 24 * 3600      # گفتگوهای رهاشده پس از یک روز پاک می‌شوند
+SWEEP_INTERVAL = 600
+
+
+def create_fsm_storage(kind: str, db: Database, redis_url: str | None = None, shared: bool = False,
+                       bot_scoped: bool = False) -> BaseStorage:
+    """kind یکی از 'sqlite' (پیش‌فرض)، 'memory' یا 'redis' است
+
+    bot_scoped شناسه ربات را به کلیدهای redis اضافه می‌کند تا چند ربات روی یک سرور redis
+    وضعیت یکدیگر را نبینند.
+    """
+    if kind == "memory":
+        return MemoryStorage()
+    if kind == "redis":
+        # نیازمند نصب بسته redis است: pip install redis
+        from aiogram.fsm.storage.base import DefaultKeyBuilder
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(
+            redis_url or "redis://localhost:6379/0", state_ttl=IDLE_TTL, data_ttl=IDLE_TTL,
+            key_builder=DefaultKeyBuilder(with_bot_id=bot_scoped),
+        )
+    return SQLiteStorage(db, shared=shared)
+
+
+async def count_states(storage: BaseStorage) -> dict[str, int] | None:
+    """جمعیت هر state برای متریک‌ها؛ برای redis پشتیبانی نمی‌شود و None برمی‌گردد"""
+    if isinstance(storage, SQLiteStorage):
+        return dict(await storage.db.count_fsm_states())
+    if isinstance(storage, MemoryStorage):
+        return dict(Counter(record.state or "" for record in storage.storage.values() if record.state or record.data))
+    return None
+
+
+class SQLiteStorage(BaseStorage):
+    """ذخیره وضعیت گفتگوها در SQLite با کش داغ در حافظه و نوشتن دسته‌ای
+
+    با shared=True (چند پردازه روی یک پایگاه داده) کش خواندن غیرفعال و هر تغییر
+    بلافاصله نوشته می‌شود تا پردازه‌های دیگر وضعیت کهنه نبینند.
+    """
+
+    def __init__(self, db: Database, shared: bool = False, flush_interval: float = FLUSH_INTERVAL,
+                 cache_size: int = CACHE_SIZE, idle_ttl: float = IDLE_TTL):
+        self.db = db
+        self.cache_reads = not shared
+        self.flush_interval = 0 if shared else flush_interval
+        self.cache_size = cache_size
+        self.idle_ttl = idle_ttl
+        self._cache: OrderedDict[str, tuple[str | None, dict, float]] = OrderedDict()
+        self._pending: dict[str, tuple[str | None, dict, float]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+        self._sweep_task: asyncio.Task | None = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    def start(self):
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    async def _load(self, k: str) -> tuple[str | None, dict]:
+        record = self._pending.get(k)
+        if record is None and self.cache_reads:
+            record = self._cache.get(k)
+            if record is not None:
+                self._cache.move_to_end(k)
+        if record is not None:
+            return record[0], record[1]
+
+        row = await self.db.get_fsm_record(k)
+        state, data = (row[0], json.loads(row[1])) if row else (None, {})
+        if self.cache_reads:
+            self._remember(k, (state, data, time.time()))
+        return state, data
+
+    def _remember(self, k: str, record: tuple[str | None, dict, float]):
+        self._cache[k] = record
+        self._cache.move_to_end(k)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _write(self, k: str, state: str | None, data: dict):
+        record = (state, data, time.time())
+        if self.cache_reads:
+            self._remember(k, record)
+        self._pending[k] = record
+        if self.flush_interval <= 0 or len(self._pending) >= FLUSH_BATCH_SIZE:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"Could not flush FSM states: {e}")
+
+    async def flush(self):
+        # قفل ترتیب دسته‌ها را حفظ می‌کند تا نوشتن قدیمی‌تر روی جدیدتر ننشیند
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            upserts, deletes = [], []
+            for k, (state, data, updated_at) in pending.items():
+                if state is None and not data:
+                    deletes.append(k)
+                else:
+                    upserts.append((k, state, json.dumps(data, ensure_ascii=False), updated_at))
+            try:
+                await self.db.save_fsm_records(upserts, deletes)
+            except BaseException:
+                # تغییرات از دست نمی‌روند و در نوبت بعدی دوباره نوشته می‌شوند
+                self._pending = {**pending, **self._pending}
+                raise
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logging.error(f"Could not expire FSM states: {e}")
+
+    async def sweep(self) -> int:
+        cutoff = time.time() - self.idle_ttl
+        for k in [k for k, record in self._cache.items() if record[2] < cutoff]:
+            del self._cache[k]
+        return await self.db.expire_fsm_records(cutoff)
+
+    def cached_count(self) -> int:
+        return len(self._cache)
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    # --- رابط BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self._key(key)
+        _, data = await self._load(k)
+        await self._write(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        k = self._key(key)
+        state, _ = await self._load(k)
+        await self._write(k, state, copy.deepcopy(dict(data)))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return copy.deepcopy(data)
+
+    async def close(self) -> None:
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
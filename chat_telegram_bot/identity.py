@@ -0,0 +1,190 @@
+import datetime
+import hashlib
+import time
+from collections import OrderedDict
+
+from database import Database, normalize_username
+
+
+# --- تنظیمات کش هویت ---
+MAX_IDENTITIES = 100_000
+USERNAME_TTL = 600                     # نگاشت نام کاربری ممکن است در پردازه دیگری تغییر کند
+USERNAME_RECHECK_INTERVAL = 6 * 3600   # حتی بدون تغییر، هر ۶ ساعت یک بار با پایگاه داده هماهنگ می‌شود
+SNAPSHOT_ENTRIES = 20_000              # نگاشت‌های اخیر که در عکس کش (lifecycle) ذخیره می‌شوند
+
+
+def get_hashed_id(user_id: int, salt: str) -> str:
+    return hashlib.sha256(f"{user_id}{salt}".encode()).hexdigest()[:12]
+
+
+class LRUCache:
+    """دیکشنری با اندازه محدود که قدیمی‌ترین کلید استفاده‌نشده را حذف می‌کند"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def __len__(self):
+        return len(self._data)
+
+    def items(self) -> list:
+        """از قدیمی‌ترین به تازه‌ترین استفاده"""
+        return list(self._data.items())
+
+
+class IdentityCache:
+    """کش write-through برای نگاشت user_id ↔ hashed_id ↔ username
+
+    نگاشت user_id و hashed_id هرگز تغییر نمی‌کند و بدون انقضا نگه داشته می‌شود؛
+    نگاشت نام کاربری TTL دارد چون نام کاربری می‌تواند به کاربر دیگری منتقل شود.
+    """
+
+    def __init__(self, db: Database, salt: str, max_size: int = MAX_IDENTITIES,
+                 username_ttl: float = USERNAME_TTL, recheck_interval: float = USERNAME_RECHECK_INTERVAL,
+                 reply_window: float = 0, writer=None):
+        self.db = db
+        # نوشتن کاربر و نام کاربری می‌تواند از صف write-behind عبور کند
+        self.writer = writer or db
+        self.salt = salt
+        self.reply_window = reply_window
+        self.username_ttl = username_ttl
+        self.recheck_interval = recheck_interval
+        self._hash_by_user = LRUCache(max_size)
+        self._user_by_hash = LRUCache(max_size)
+        self._user_by_username = LRUCache(max_size)
+        self._username_by_user = LRUCache(max_size)
+
+    def _link(self, user_id: int, hashed_id: str):
+        self._hash_by_user.put(user_id, hashed_id)
+        self._user_by_hash.put(hashed_id, user_id)
+
+    def _link_username(self, user_id: int, username: str | None):
+        previous = self._username_by_user.get(user_id)
+        if previous is not None:
+            previous_norm = normalize_username(previous[0])
+            if previous_norm and self._user_by_username.get(previous_norm, (None,))[0] == user_id:
+                self._user_by_username.pop(previous_norm)
+        self._username_by_user.put(user_id, (username, time.monotonic()))
+        username_norm = normalize_username(username)
+        if username_norm:
+            self._user_by_username.put(username_norm, (user_id, time.monotonic() + self.username_ttl))
+
+    # --- خواندن ---
+    def hashed_id(self, user_id: int) -> str:
+        hashed_id = self._hash_by_user.get(user_id)
+        if hashed_id is None:
+            hashed_id = get_hashed_id(user_id, self.salt)
+            self._link(user_id, hashed_id)
+        return hashed_id
+
+    async def user_id_by_hash(self, hashed_id: str) -> int | None:
+        user_id = self._user_by_hash.get(hashed_id)
+        if user_id is None:
+            user_id = await self.db.get_user_id_by_hash(hashed_id)
+            if user_id is not None:
+                self._link(user_id, hashed_id)
+        return user_id
+
+    async def user_id_by_username(self, username: str) -> int | None:
+        username_norm = normalize_username(username)
+        if not username_norm:
+            return None
+        entry = self._user_by_username.get(username_norm)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        user_id = await self.db.get_user_by_username(username_norm)
+        if user_id is not None:
+            self._user_by_username.put(username_norm, (user_id, time.monotonic() + self.username_ttl))
+        else:
+            self._user_by_username.pop(username_norm)
+        return user_id
+
+    async def reply_sender(self, db_message_id: int) -> tuple[str, int | None]:
+        """(وضعیت، user_id فرستنده) را با یک JOIN روی کلیدهای ایندکس‌شده برمی‌گرداند
+
+        وضعیت یکی از 'ok'، 'expired' (خارج از مهلت پاسخ یا بایگانی‌شده) یا 'missing' است.
+        """
+        row = await self.db.get_message_sender_identity(db_message_id)
+        if row is None:
+            return ("expired" if await self.db.is_message_id_expired(db_message_id) else "missing"), None
+        hashed_id, user_id, created_at = row
+        if self.reply_window and created_at:
+            # created_at به وقت UTC و با قالب CURRENT_TIMESTAMP ذخیره می‌شود
+            sent_at = datetime.datetime.fromisoformat(created_at).replace(tzinfo=datetime.timezone.utc)
+            age = datetime.datetime.now(datetime.timezone.utc) - sent_at
+            if age.total_seconds() > self.reply_window:
+                return "expired", None
+        if user_id is not None:
+            self._link(user_id, hashed_id)
+        return "ok", user_id
+
+    # --- نوشتن ---
+    async def register(self, user_id: int, username: str | None) -> str:
+        hashed_id = self.hashed_id(user_id)
+        await self.writer.add_user(user_id, username, hashed_id)
+        self._link_username(user_id, username)
+        return hashed_id
+
+    async def observe_username(self, user_id: int, username: str | None):
+        """فقط اگر نام کاربری تغییر کرده یا مدتی بررسی نشده باشد در پایگاه داده نوشته می‌شود"""
+        entry = self._username_by_user.get(user_id)
+        if entry is not None and entry[0] == username and time.monotonic() - entry[1] < self.recheck_interval:
+            return
+        await self.writer.update_username(user_id, username)
+        self._link_username(user_id, username)
+
+    # --- عکس کش برای راه‌اندازی گرم ---
+    def dump(self, limit: int = SNAPSHOT_ENTRIES) -> dict:
+        # زمان‌های monotonic در پردازه بعدی معنا ندارند و به زمان دیواری تبدیل می‌شوند
+        wall_offset = time.time() - time.monotonic()
+        return {
+            "salt_check": get_hashed_id(0, self.salt),
+            "hashes": [[user_id, hashed_id] for user_id, hashed_id in self._hash_by_user.items()[-limit:]],
+            "usernames": [
+                [user_id, username, checked_at + wall_offset]
+                for user_id, (username, checked_at) in self._username_by_user.items()[-limit:]
+            ],
+        }
+
+    def restore(self, snapshot: dict):
+        if snapshot["salt_check"] != get_hashed_id(0, self.salt):
+            raise ValueError("HASH_SALT has changed")
+        monotonic_offset = time.monotonic() - time.time()
+        for user_id, hashed_id in snapshot["hashes"]:
+            self._link(user_id, hashed_id)
+        for user_id, username, checked_at in snapshot["usernames"]:
+            checked_at += monotonic_offset
+            self._username_by_user.put(user_id, (username, checked_at))
+            username_norm = normalize_username(username)
+            if username_norm:
+                self._user_by_username.put(username_norm, (user_id, checked_at + self.username_ttl))
+
+    def stats(self) -> dict:
+        caches = {
+            "hash_by_user": self._hash_by_user,
+            "user_by_hash": self._user_by_hash,
+            "user_by_username": self._user_by_username,
+            "username_by_user": self._username_by_user,
+        }
+        return {name: {"size": len(c), "hits": c.hits, "misses": c.misses} for name, c in caches.items()}
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from metrics import registry
+
+
+# --- تنظیمات زمان‌بند پردازش آپدیت‌ها ---
+MAX_CONCURRENT_UPDATES = 64   # آپدیت‌هایی که هم‌زمان در middlewareها و هندلرها هستند
+MAX_QUEUED_UPDATES = 1000     # آپدیت‌های منتظر جای خالی؛ بیشتر از این دور ریخته می‌شود
+MAX_USER_QUEUED = 5           # آپدیت‌های منتظر یک کاربر پشت آپدیت در حال پردازش او
+MAX_QUEUE_WAIT = 30           # آپدیتی که بیش از این منتظر بماند دیگر ارزش پاسخ ندارد
+# وقتی صف پر است: drop_newest آپدیت تازه را دور می‌ریزد و drop_oldest قدیمی‌ترین منتظر را
+SHED_POLICIES = ("drop_newest", "drop_oldest")
+SHED_POLICY = "drop_newest"
+SHED_WARNING_INTERVAL = 60
+
+QUEUE_WAIT_SECONDS = registry.histogram(
+    "bot_update_queue_wait_seconds", "Time an update waited for its user's turn and a free slot"
+)
+
+
+class UpdateScheduler(BaseMiddleware):
+    """سقف سراسری پردازش هم‌زمان، ترتیب سریال برای هر کاربر و دور ریختن بار اضافه
+
+    به صورت اولین outer middleware آپدیت (پس از middlewareهای داخلی aiogram) ثبت می‌شود.
+    FSMContextMiddleware وضعیت را پیش از این middleware خوانده است، پس آپدیتی که پشت
+    آپدیت قبلی همان کاربر منتظر مانده raw_state را دوباره می‌خواند. اجزای آلبوم پشت هم
+    منتظر نمی‌مانند تا MediaGroupMiddleware بتواند آن‌ها را در یک پنجره جمع کند.
+    آپدیت‌های کاربران exempt (ادمین) از صف و سقف عبور نمی‌کنند.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_UPDATES, max_queued: int = MAX_QUEUED_UPDATES,
+                 policy: str = SHED_POLICY, max_user_queued: int = MAX_USER_QUEUED,
+                 max_wait: float = MAX_QUEUE_WAIT, exempt: tuple[int, ...] = ()):
+        if policy not in SHED_POLICIES:
+            raise ValueError(f"Unknown shed policy: {policy}")
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.policy = policy
+        self.max_user_queued = max_user_queued
+        self.max_wait = max_wait
+        self.exempt = frozenset(exempt)
+        self.running = 0
+        self._waiting: deque[asyncio.Future] = deque()
+        # کاربر -> آپدیت‌های منتظر؛ وجود کلید یعنی یک آپدیت او در حال پردازش است
+        self._users: dict[int, deque[asyncio.Future]] = {}
+        self.processed = 0
+        self.bypassed = 0
+        self.shed = {"queue_full": 0, "user_queue_full": 0, "timeout": 0}
+        self._warned_at = float("-inf")
+
+    # --- نوبت هر کاربر ---
+    async def _user_turn(self, user_id: int, timeout: float) -> bool:
+        """False یعنی صف کاربر پر است؛ در غیر این صورت نوبت کاربر گرفته شده و باید آزاد شود"""
+        waiters = self._users.get(user_id)
+        if waiters is None:
+            self._users[user_id] = deque()
+            return True
+        if len(waiters) >= self.max_user_queued:
+            self.shed["user_queue_full"] += 1
+            return False
+        future = asyncio.get_running_loop().create_future()
+        waiters.append(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            if future.done() and not future.cancelled():
+                # نوبت همزمان با لغو رسیده بود؛ به نفر بعدی داده می‌شود
+                self._release_user(user_id)
+            elif future in waiters:
+                waiters.remove(future)
+            raise
+        return True
+
+    def _release_user(self, user_id: int):
+        waiters = self._users[user_id]
+        while waiters:
+            future = waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        del self._users[user_id]
+
+    # --- جای خالی سراسری ---
+    async def _slot(self, timeout: float) -> bool:
+        if self.running < self.max_concurrent and not self._waiting:
+            self.running += 1
+            return True
+        if len(self._waiting) >= self.max_queued:
+            self.shed["queue_full"] += 1
+            self._warn_shedding()
+            if self.policy == "drop_newest":
+                return False
+            while self._waiting:
+                oldest = self._waiting.popleft()
+                if not oldest.done():
+                    oldest.set_result(False)
+                    break
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            if future.done() and not future.cancelled() and future.result():
+                self._release_slot()
+            elif future in self._waiting:
+                self._waiting.remove(future)
+            raise
+
+    def _release_slot(self):
+        # جای خالی مستقیم به اولین منتظر منتقل می‌شود و running تغییری نمی‌کند
+        while self._waiting:
+            future = self._waiting.popleft()
+            if not future.done():
+                future.set_result(True)
+                return
+        self.running -= 1
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        if user is not None and user.id in self.exempt:
+            self.bypassed += 1
+            return await handler(event, data)
+
+        serialize = user is not None and not (
+            isinstance(event, Update) and event.message is not None and event.message.media_group_id
+        )
+        started = time.perf_counter()
+        has_turn = has_slot = False
+        try:
+            try:
+                if serialize:
+                    queued_behind = user.id in self._users
+                    has_turn = await self._user_turn(user.id, self.max_wait)
+                    if not has_turn:
+                        return None
+                    if queued_behind and "state" in data:
+                        # آپدیت قبلی همین کاربر ممکن است وضعیت را عوض کرده باشد
+                        data["raw_state"] = await data["state"].get_state()
+                has_slot = await self._slot(max(0.0, self.max_wait - (time.perf_counter() - started)))
+            except asyncio.TimeoutError:
+                self.shed["timeout"] += 1
+                return None
+            if not has_slot:
+                return None
+            QUEUE_WAIT_SECONDS.observe(time.perf_counter() - started)
+            self.processed += 1
+            return await handler(event, data)
+        finally:
+            if has_slot:
+                self._release_slot()
+            if has_turn:
+                self._release_user(user.id)
+
+    def _warn_shedding(self):
+        now = time.monotonic()
+        if now - self._warned_at >= SHED_WARNING_INTERVAL:
+            self._warned_at = now
+            logging.warning(
+                f"Update queue full ({self.running} running, {len(self._waiting)} queued); "
+                f"shedding with {self.policy}, {self.shed['queue_full']} shed so far"
+            )
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queued": len(self._waiting),
+            "user_queued": sum(len(waiters) for waiters in self._users.values()),
+            "processed": self.processed,
+            "bypassed": self.bypassed,
+        }
+
+    def shed_stats(self) -> dict:
+        return dict(self.shed)
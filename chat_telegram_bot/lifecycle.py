@@ -0,0 +1,144 @@
+"""خاموش شدن منظم و راه‌اندازی گرم
+
+با SIGTERM (مثلاً restart سرویس systemd) دریافت آپدیت متوقف می‌شود، آپدیت‌های در حال
+پردازش تا SHUTDOWN_TIMEOUT فرصت تمام شدن دارند و سپس کش‌های داغ (هویت ربات، نمایه
+عضویت، نگاشت‌های هویت کاربران و offset آپدیت‌ها) در یک فایل JSON کنار پایگاه داده
+ذخیره می‌شوند. اجرای بعدی پیش از دریافت اولین آپدیت همین فایل را بارگذاری می‌کند.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.types import TelegramObject
+
+
+# --- تنظیمات چرخه اجرا ---
+SHUTDOWN_TIMEOUT = 20        # کمتر از TimeoutStopSec سرویس systemd
+SNAPSHOT_MAX_AGE = 24 * 3600  # عکس کهنه‌تر کنار گذاشته می‌شود (شناسه آپدیت‌ها پس از یک هفته بی‌کاری از نو شروع می‌شود)
+SNAPSHOT_VERSION = 1
+
+
+def snapshot_path(db_path: str) -> str:
+    return f"{os.path.splitext(db_path)[0]}.snapshot.json"
+
+
+class Lifecycle(BaseMiddleware):
+    """آپدیت‌های در حال پردازش را می‌شمارد و بخش‌های ثبت‌شده با register را ذخیره و بازیابی می‌کند
+
+    به صورت اولین outer middleware آپدیت ثبت می‌شود و task هر آپدیت را نگه می‌دارد؛ پاسخی
+    که هندلر برمی‌گرداند (return message.answer) پس از middlewareها و در همان task فرستاده
+    می‌شود، پس تخلیه تا پایان task صبر می‌کند. آپدیت‌هایی که پیش از خاموش شدن
+    کامل پردازش شده‌اند با getUpdates تأیید می‌شوند؛ اگر این تأیید نرسیده باشد، offset
+    ذخیره‌شده جلوی پردازش دوباره آن‌ها را پس از راه‌اندازی می‌گیرد.
+    """
+
+    def __init__(self, path: str, max_age: float = SNAPSHOT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._sections: dict[str, tuple[Callable[[], Any], Callable[[Any], None]]] = {}
+        # task پردازش هر آپدیت -> update_id
+        self.inflight: dict[asyncio.Task, int] = {}
+        self.last_update_id: int | None = None
+        self.offset = 0
+        self.duplicates = 0
+        self.register("update_offset", self.next_offset, self._restore_offset)
+
+    def register(self, name: str, dump: Callable[[], Any], restore: Callable[[Any], None]):
+        """dump یک مقدار قابل تبدیل به JSON برمی‌گرداند و restore همان را دریافت می‌کند"""
+        self._sections[name] = (dump, restore)
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        update_id = event.update_id
+        if update_id < self.offset:
+            self.duplicates += 1
+            return None
+        task = asyncio.current_task()
+        if task not in self.inflight:
+            self.inflight[task] = update_id
+            task.add_done_callback(self._finished)
+        return await handler(event, data)
+
+    def _finished(self, task: asyncio.Task):
+        update_id = self.inflight.pop(task)
+        if self.last_update_id is None or update_id > self.last_update_id:
+            self.last_update_id = update_id
+
+    # --- خاموش شدن ---
+    async def drain(self, timeout: float = SHUTDOWN_TIMEOUT) -> bool:
+        """منتظر تمام شدن آپدیت‌های در حال پردازش (و صف UpdateScheduler) می‌ماند"""
+        if not self.inflight:
+            return True
+        _, pending = await asyncio.wait(list(self.inflight), timeout=timeout)
+        if pending:
+            logging.warning(f"{len(pending)} updates still running after {timeout}s; they will be redelivered")
+        return not pending
+
+    def next_offset(self) -> int | None:
+        # آپدیتی که تمام نشده است باید دوباره از تلگرام گرفته شود
+        if self.inflight:
+            return min(self.inflight.values())
+        return self.last_update_id + 1 if self.last_update_id is not None else None
+
+    def _restore_offset(self, offset: int | None):
+        self.offset = offset or 0
+
+    async def confirm_offset(self, bot: Bot):
+        """فقط در حالت polling؛ تلگرام آپدیت‌های کمتر از offset را دیگر نمی‌فرستد"""
+        offset = self.next_offset()
+        if offset is None:
+            return
+        try:
+            await bot.get_updates(offset=offset, limit=1, timeout=0)
+        except Exception as e:
+            logging.warning(f"Could not confirm update offset {offset}: {e}")
+
+    # --- عکس کش‌ها ---
+    def save(self):
+        sections = {}
+        for name, (dump, _) in self._sections.items():
+            try:
+                sections[name] = dump()
+            except Exception as e:
+                logging.error(f"Could not snapshot {name}: {e}")
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": SNAPSHOT_VERSION, "saved_at": time.time(), "sections": sections}, f)
+        # جایگزینی اتمی تا خاموش شدن ناگهانی فایل نیمه‌کاره باقی نگذارد
+        os.replace(tmp_path, self.path)
+        logging.info(f"Cache snapshot saved to {self.path}")
+
+    def restore(self) -> set[str]:
+        """نام بخش‌هایی که بازیابی شدند؛ نبودن یا کهنه بودن فایل یعنی شروع سرد"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return set()
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable cache snapshot {self.path}: {e}")
+            return set()
+        age = time.time() - snapshot.get("saved_at", 0)
+        if snapshot.get("version") != SNAPSHOT_VERSION or not 0 <= age <= self.max_age:
+            logging.info(f"Ignoring stale cache snapshot ({age:.0f}s old)")
+            return set()
+
+        restored = set()
+        for name, value in snapshot["sections"].items():
+            section = self._sections.get(name)
+            if section is None or value is None:
+                continue
+            try:
+                section[1](value)
+                restored.add(name)
+            except Exception as e:
+                logging.warning(f"Could not restore {name} from snapshot: {e}")
+        logging.info(f"Restored {', '.join(sorted(restored)) or 'nothing'} from a snapshot {age:.0f}s old")
+        return restored
+
+    def stats(self) -> dict:
+        return {"inflight": len(self.inflight), "duplicates_skipped": self.duplicates}
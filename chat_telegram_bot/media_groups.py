@@ -0,0 +1,96 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.types import InlineKeyboardMarkup, Message, ReplyParameters, TelegramObject
+
+
+# --- تنظیمات جمع‌آوری آلبوم ---
+ALBUM_WINDOW = 0.5     # تلگرام اجزای آلبوم را پشت سر هم می‌فرستد؛ این مقدار سکوت یعنی آلبوم کامل است
+ALBUM_MAX_WAIT = 2.0   # سقف انتظار حتی اگر اجزا با فاصله برسند
+ALBUM_MAX_SIZE = 10    # بیشترین تعداد اجزای یک media group در تلگرام
+ALBUM_BUTTON_TEXT = "⬆️ پیام بالا"
+
+
+class MediaGroupMiddleware(BaseMiddleware):
+    """اجزای یک media group را جمع می‌کند و هندلر را فقط یک بار با data["album"] صدا می‌زند
+
+    به صورت outer middleware پیام ثبت می‌شود تا عضویت اجباری و FSM کل آلبوم را یک آپدیت
+    ببینند؛ کنترل سیل پیش از آن اجرا می‌شود و با collecting فقط اولین جزء را می‌شمارد. اجزا هم‌زمان پردازش می‌شوند، پس اولین جزء تا پایان پنجره منتظر بقیه
+    می‌ماند و بقیه فقط به آن اضافه می‌شوند. در webhook با چند worker اجزای یک آلبوم
+    معمولاً از یک اتصال و در نتیجه یک worker می‌رسند.
+    """
+
+    def __init__(self, window: float = ALBUM_WINDOW, max_wait: float = ALBUM_MAX_WAIT):
+        self.window = window
+        self.max_wait = max_wait
+        self._albums: dict[tuple[int, str], list[Message]] = {}
+        self.albums = 0
+        self.parts = 0
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        if not isinstance(event, Message) or not event.media_group_id:
+            return await handler(event, data)
+
+        self.parts += 1
+        key = (event.chat.id, event.media_group_id)
+        album = self._albums.get(key)
+        if album is not None:
+            album.append(event)
+            return None
+
+        album = self._albums[key] = [event]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        try:
+            size = 0
+            while size != len(album) and len(album) < ALBUM_MAX_SIZE and loop.time() < deadline:
+                size = len(album)
+                await asyncio.sleep(self.window)
+        finally:
+            del self._albums[key]
+
+        album.sort(key=lambda m: m.message_id)
+        self.albums += 1
+        data["album"] = album
+        return await handler(album[0], data)
+
+    def collecting(self, message: Message) -> bool:
+        """آیا این پیام جزء آلبومی است که اولین جزء آن پذیرفته شده و در حال جمع شدن است"""
+        return bool(message.media_group_id) and (message.chat.id, message.media_group_id) in self._albums
+
+    def stats(self) -> dict:
+        return {"albums": self.albums, "parts": self.parts, "pending": len(self._albums)}
+
+
+async def copy_message_ids(bot: Bot, chat_id: int, from_chat_id: int, message_ids: list[int],
+                           reply_markup: InlineKeyboardMarkup | None = None,
+                           button_text: str = ALBUM_BUTTON_TEXT) -> int:
+    """یک پیام یا همه اجزای یک آلبوم را کپی می‌کند و شناسه اولین پیام کپی‌شده را برمی‌گرداند
+
+    آلبوم با یک copy_messages فرستاده می‌شود. تلگرام کیبورد inline روی اجزای آلبوم را نمی‌پذیرد،
+    پس reply_markup در یک پیام کوتاه جدا و در پاسخ به اولین جزء می‌آید.
+    """
+    if len(message_ids) == 1:
+        sent = await bot.copy_message(
+            chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_ids[0], reply_markup=reply_markup
+        )
+        return sent.message_id
+
+    copied = await bot.copy_messages(chat_id=chat_id, from_chat_id=from_chat_id, message_ids=message_ids)
+    first_id = copied[0].message_id
+    if reply_markup is not None:
+        await bot.send_message(
+            chat_id, button_text, reply_markup=reply_markup,
+            reply_parameters=ReplyParameters(message_id=first_id, allow_sending_without_reply=True),
+        )
+    return first_id
+
+
+async def copy_content(bot: Bot, chat_id: int, message: Message, album: list[Message] | None = None,
+                       reply_markup: InlineKeyboardMarkup | None = None,
+                       button_text: str = ALBUM_BUTTON_TEXT) -> int:
+    """پیام دریافتی یا آلبوم جمع‌شده آن (پارامتر album هندلرها) را کپی می‌کند"""
+    message_ids = [m.message_id for m in album] if album else [message.message_id]
+    return await copy_message_ids(bot, chat_id, message.chat.id, message_ids, reply_markup, button_text)
@@ -0,0 +1,299 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from aiogram import Bot
+from aiogram.enums import ChatMemberStatus
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from aiogram.types import Chat, ChatMember, ChatMemberUpdated, InlineKeyboardButton, InlineKeyboardMarkup
+
+
+# --- تنظیمات کش عضویت ---
+POSITIVE_TTL = 300   # عضو بودن کاربر تا ۵ دقیقه معتبر است
+NEGATIVE_TTL = 20    # عضو نبودن یا خطا زودتر منقضی می‌شود تا عضویت تازه دیده شود
+MAX_ENTRIES = 50_000
+GATE_REFRESH_INTERVAL = 30  # وقتی چند پردازه کار می‌کنند
+
+# --- تنظیمات نمایه عضویت ---
+RECONCILE_INTERVAL = 6 * 3600
+RECONCILE_AGE = 24 * 3600   # ردیف‌هایی که یک روز رویدادی نداشته‌اند دوباره از تلگرام پرسیده می‌شوند
+RECONCILE_BATCH = 500       # حداکثر ردیف بازبینی‌شده در هر دور
+RECONCILE_RATE = 2          # درخواست get_chat_member در ثانیه؛ کمتر از سهم کاربران واقعی
+RECONCILE_WARM_DELAY = 600  # پس از راه‌اندازی گرم نمایه تازه است و اولین دور عقب می‌افتد
+SNAPSHOT_ENTRIES = 20_000   # ردیف‌های اخیر کش که در عکس کش (lifecycle) ذخیره می‌شوند
+
+MEMBER_STATUSES = (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR)
+
+
+def is_member_status(member: ChatMember) -> bool:
+    # کاربر محدودشده (restricted) ممکن است هنوز عضو باشد
+    return member.status in MEMBER_STATUSES or (
+        member.status == ChatMemberStatus.RESTRICTED and getattr(member, "is_member", False)
+    )
+
+
+class MembershipCache:
+    """کش LRU عضویت (user_id, channel) با TTL جدا و درخواست تک‌پرواز
+
+    خروجی هر بررسی True (عضو)، False (غیر عضو) یا None است؛ None یعنی ربات
+    نتوانسته عضویت را بررسی کند (مثلاً در کانال ادمین نیست).
+
+    با db، برای کانال‌هایی که ربات در آن‌ها ادمین است نمایه محلی channel_members
+    از رویدادهای chat_member به‌روز می‌شود و پس از کش حافظه اولین مرجع است؛
+    get_chat_member فقط برای جفت‌های ناشناخته و کانال‌های بدون دسترسی ادمین صدا زده می‌شود.
+    """
+
+    def __init__(self, bot: Bot, positive_ttl: float = POSITIVE_TTL,
+                 negative_ttl: float = NEGATIVE_TTL, max_entries: int = MAX_ENTRIES, db=None, writer=None):
+        self.bot = bot
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.db = db
+        self.writer = writer or db
+        self._entries: OrderedDict[tuple[int, str], tuple[bool | None, float]] = OrderedDict()
+        self._inflight: dict[tuple[int, str], asyncio.Future] = {}
+        # کانال‌هایی که ربات در آن‌ها ادمین است و رویداد عضویتشان می‌رسد
+        self.indexed: set[str] = set()
+        self._channel_by_alias: dict[str, str] = {}
+        # کانال‌هایی که indexed و نام‌های مستعار برایشان از تلگرام خوانده شده است
+        self.channels: tuple[str, ...] = ()
+        self.hits = 0
+        self.misses = 0
+        self.index_hits = 0
+        self.api_calls = 0
+        self.events = 0
+
+    async def _fetch(self, user_id: int, channel: str, refresh: bool = False) -> bool | None:
+        indexed = self.db is not None and channel in self.indexed
+        if indexed:
+            value = await self.db.get_channel_member(channel, user_id)
+            # «عضو شدم» ممکن است کمی زودتر از رویداد chat_member برسد
+            if value is not None and not (refresh and not value):
+                self.index_hits += 1
+                return value
+        self.api_calls += 1
+        try:
+            member = await self.bot.get_chat_member(chat_id=channel, user_id=user_id)
+        except (TelegramBadRequest, TelegramAPIError):
+            logging.warning(f"Bot is not admin in {channel}. Cannot verify user {user_id}.")
+            return None
+        value = is_member_status(member)
+        if indexed:
+            await self.writer.set_channel_member(channel, user_id, value)
+        return value
+
+    def _store(self, key: tuple[int, str], value: bool | None):
+        ttl = self.positive_ttl if value else self.negative_ttl
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _load(self, key: tuple[int, str], refresh: bool = False) -> bool | None:
+        value = await self._fetch(*key, refresh=refresh)
+        self._store(key, value)
+        return value
+
+    async def is_member(self, user_id: int, channel: str, refresh: bool = False) -> bool | None:
+        key = (user_id, channel)
+        if not refresh:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        # درخواست‌های هم‌زمان برای یک کلید فقط یک بار به تلگرام می‌روند
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(key, refresh))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def check_channels(self, user_id: int, channels: list[str], refresh: bool = False) -> dict[str, bool | None]:
+        """عضویت یک کاربر را در چند کانال به صورت موازی بررسی می‌کند"""
+        results = await asyncio.gather(*(self.is_member(user_id, channel, refresh) for channel in channels))
+        return dict(zip(channels, results))
+
+    # --- نمایه رویدادمحور ---
+    def _resolve(self, chat: Chat) -> str | None:
+        """هدف عضویت اجباری متناظر با چت رویداد (با @username یا شناسه عددی ثبت شده است)"""
+        for alias in (str(chat.id), f"@{chat.username}".lower() if chat.username else None):
+            channel = self._channel_by_alias.get(alias)
+            if channel is not None:
+                return channel
+        return None
+
+    async def refresh_channels(self, channels: tuple[str, ...] | list[str]):
+        """دسترسی ادمین ربات و شناسه عددی هر کانال را از تلگرام می‌خواند"""
+        aliases, indexed = {}, set()
+        for channel in channels:
+            aliases[channel.lower() if channel.startswith("@") else channel] = channel
+            try:
+                chat = await self.bot.get_chat(channel)
+                aliases[str(chat.id)] = channel
+                me = await self.bot.get_chat_member(chat_id=channel, user_id=self.bot.id)
+            except Exception as e:
+                logging.warning(f"Membership index disabled for {channel}: {e}")
+                continue
+            if me.status in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR):
+                indexed.add(channel)
+        self._channel_by_alias, self.indexed, self.channels = aliases, indexed, tuple(channels)
+
+    async def on_member_updated(self, event: ChatMemberUpdated):
+        """هندلر chat_member: تغییر عضویت کاربران در کانال‌های هدف"""
+        channel = self._resolve(event.chat)
+        if channel is None:
+            return
+        self.events += 1
+        user_id = event.new_chat_member.user.id
+        value = is_member_status(event.new_chat_member)
+        self._store((user_id, channel), value)
+        if self.db is not None:
+            await self.writer.set_channel_member(channel, user_id, value)
+
+    async def on_bot_member_updated(self, event: ChatMemberUpdated):
+        """هندلر my_chat_member: ارتقا یا عزل ربات در یک کانال هدف"""
+        channel = self._resolve(event.chat)
+        if channel is None:
+            return
+        if event.new_chat_member.status in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR):
+            self.indexed.add(channel)
+        else:
+            self.indexed.discard(channel)
+        logging.info(f"Bot is now {event.new_chat_member.status} in {channel}")
+
+    async def reconcile(self, channels: tuple[str, ...] | list[str], max_age: float = RECONCILE_AGE,
+                        limit: int = RECONCILE_BATCH, rate: float = RECONCILE_RATE) -> int:
+        """ردیف‌هایی که مدتی رویدادی نداشته‌اند را آهسته با تلگرام مقایسه و اصلاح می‌کند"""
+        await self.refresh_channels(channels)
+        await self.db.delete_channel_members_except(list(channels))
+        rows = await self.db.get_stale_channel_members(sorted(self.indexed), time.time() - max_age, limit)
+        repaired = 0
+        for channel, user_id, is_member in rows:
+            try:
+                member = await self.bot.get_chat_member(chat_id=channel, user_id=user_id)
+            except TelegramAPIError as e:
+                # updated_at تازه می‌شود تا همین ردیف در دورهای بعدی جای بقیه را نگیرد
+                logging.warning(f"Could not reconcile {user_id} in {channel}: {e}")
+                value = bool(is_member)
+            else:
+                value = is_member_status(member)
+                if value != bool(is_member):
+                    repaired += 1
+                    self._store((user_id, channel), value)
+            await self.writer.set_channel_member(channel, user_id, value)
+            await asyncio.sleep(1 / rate)
+        if repaired:
+            logging.info(f"Membership reconciliation repaired {repaired} of {len(rows)} rows")
+        return repaired
+
+    async def reconcile_periodically(self, gate: "ForceSubGate", interval: float = RECONCILE_INTERVAL,
+                                     delay: float = 0):
+        await asyncio.sleep(delay)
+        while True:
+            try:
+                await self.reconcile(gate.current.channels)
+            except Exception as e:
+                logging.error(f"Membership reconciliation failed: {e}")
+            await asyncio.sleep(interval)
+
+    # --- عکس کش برای راه‌اندازی گرم ---
+    def dump(self, limit: int = SNAPSHOT_ENTRIES) -> dict:
+        now = time.monotonic()
+        wall_offset = time.time() - now
+        return {
+            "channels": list(self.channels),
+            "aliases": self._channel_by_alias,
+            "indexed": sorted(self.indexed),
+            "entries": [
+                [user_id, channel, value, expires_at + wall_offset]
+                for (user_id, channel), (value, expires_at) in list(self._entries.items())[-limit:]
+                if expires_at > now
+            ],
+        }
+
+    def restore(self, snapshot: dict):
+        """پس از بازیابی، refresh_channels فقط اگر اهداف عضویت اجباری تغییر کرده باشند لازم است"""
+        self.channels = tuple(snapshot["channels"])
+        self._channel_by_alias = dict(snapshot["aliases"])
+        self.indexed = set(snapshot["indexed"])
+        now = time.monotonic()
+        monotonic_offset = now - time.time()
+        for user_id, channel, value, expires_at in snapshot["entries"]:
+            if expires_at + monotonic_offset > now:
+                self._entries[(user_id, channel)] = (value, expires_at + monotonic_offset)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "index_hits": self.index_hits,
+            "api_calls": self.api_calls,
+            "events": self.events,
+            "indexed_channels": len(self.indexed),
+        }
+
+    def invalidate(self, user_id: int | None = None, channel: str | None = None):
+        if user_id is None and channel is None:
+            self._entries.clear()
+            return
+        for key in [k for k in self._entries if (user_id is None or k[0] == user_id) and (channel is None or k[1] == channel)]:
+            del self._entries[key]
+
+
+# --- دروازه عضویت اجباری ---
+class CompiledGate(NamedTuple):
+    targets: tuple[tuple[str, str, str], ...]
+    channels: tuple[str, ...]
+    links: tuple[str, ...]
+    keyboard: InlineKeyboardMarkup | None
+
+
+EMPTY_GATE = CompiledGate((), (), (), None)
+
+
+def compile_gate(targets) -> CompiledGate:
+    targets = tuple(tuple(t) for t in targets)
+    if not targets:
+        return EMPTY_GATE
+    join_buttons = [
+        [InlineKeyboardButton(text=btn_text, url=f"https://t.me/{tgt.lstrip('@')}" if not tgt.startswith("http") else tgt)]
+        for tgt, t_type, btn_text in targets
+    ]
+    join_buttons.append([InlineKeyboardButton(text="✅ عضو شدم", callback_data="check_sub")])
+    return CompiledGate(
+        targets=targets,
+        channels=tuple(t[0] for t in targets if t[1] == 'channel'),
+        links=tuple(t[0] for t in targets if t[1] == 'link'),
+        keyboard=InlineKeyboardMarkup(inline_keyboard=join_buttons),
+    )
+
+
+class ForceSubGate:
+    """نسخه کامپایل‌شده اهداف عضویت اجباری که فقط پس از تغییر توسط ادمین بازسازی می‌شود"""
+
+    def __init__(self):
+        self.current = EMPTY_GATE
+        self._lock = asyncio.Lock()
+
+    async def reload(self, db) -> CompiledGate:
+        # جایگزینی یکجای current باعث می‌شود هیچ آپدیتی نسخه نیمه‌کاره را نبیند
+        async with self._lock:
+            self.current = compile_gate(await db.get_force_sub_targets())
+            return self.current
+
+    async def refresh_periodically(self, db, interval: float = GATE_REFRESH_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload(db)
+            except Exception as e:
+                logging.error(f"Could not refresh force-sub gate: {e}")
@@ -0,0 +1,425 @@
+import contextlib
+import contextvars
+import html
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramConflictError,
+    TelegramEntityTooLarge,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramServerError,
+    TelegramUnauthorizedError,
+)
+from aiogram.methods import TelegramMethod
+from aiogram.types import TelegramObject
+
+from tracing import Tracer, record_span
+
+
+# --- تنظیمات متریک‌ها ---
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_PATH = "/metrics"
+SUMMARY_ERRORS = 5         # خطاهای API پرتکرار در پنل ادمین؛ بقیه فقط شمرده می‌شوند
+SUMMARY_GAUGE_VALUES = 4   # مقدارهای هر گیج در یک خط پنل
+SUMMARY_MAX_LENGTH = 3500  # سقف تلگرام برای یک پیام 4096 نویسه است و پنل پاورقی هم دارد
+
+# نام ربات در حالت چند رباتی؛ main آن را تنظیم می‌کند و taskهای ساخته‌شده از main آن را به ارث می‌برند
+_instance: contextvars.ContextVar[str | None] = contextvars.ContextVar("metrics_instance", default=None)
+
+
+def set_metrics_instance(instance: str | None):
+    """مشاهده‌های هیستوگرام و شمارنده‌ها در task جاری با برچسب bot=instance ثبت می‌شوند"""
+    _instance.set(instance)
+
+
+def _series_labels(names: tuple, key: tuple) -> str:
+    # اولین عضو کلید هر سری نام ربات است (None در حالت تک رباتی)
+    instance, *values = key
+    if instance is None:
+        return _format_labels(names, tuple(values))
+    return _format_labels(("bot", *names), key)
+
+
+class Histogram:
+    """هیستوگرام تجمعی به سبک Prometheus؛ هر ترکیب برچسب (و هر ربات) یک سری جداگانه است
+
+    با span هر مشاهده به ردیابی آپدیت جاری (اگر ردیابی شود) هم اضافه می‌شود.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS,
+                 span: str | None = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.span = span
+        # (ربات، *برچسب‌ها) -> [شمارش هر bucket، مجموع، تعداد، بیشینه]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        key = (_instance.get(), *labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0, 0.0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+        if value > series[3]:
+            series[3] = value
+        if self.span is not None:
+            record_span(self.span, "/".join(map(str, labels)), value)
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def quantile(self, key: tuple, q: float) -> float:
+        """برآورد چندک از روی مرز bucketها"""
+        counts, _, count, maximum = self._series[key]
+        target, seen = q * count, 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return maximum
+
+    def summary(self, instance: str | None = None) -> dict[tuple, dict]:
+        """سری‌های یک ربات، با برچسب‌ها بدون نام ربات"""
+        return {
+            key[1:]: {"count": count, "avg": total / count, "p95": self.quantile(key, 0.95), "max": maximum}
+            for key, (_, total, count, maximum) in self._series.items() if count and key[0] == instance
+        }
+
+    def remove_instance(self, instance: str):
+        for key in [key for key in self._series if key[0] == instance]:
+            del self._series[key]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count, _) in self._series.items():
+            base = _series_labels(self.labelnames, key)
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_with_le(base, bound)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_with_le(base, '+Inf')} {count}")
+            lines.append(f"{self.name}_sum{base} {total}")
+            lines.append(f"{self.name}_count{base} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        key = (_instance.get(), *labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def items(self, instance: str | None = None) -> list[tuple[tuple, float]]:
+        return [(key[1:], value) for key, value in self._values.items() if key[0] == instance]
+
+    def remove_instance(self, instance: str):
+        for key in [key for key in self._values if key[0] == instance]:
+            del self._values[key]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_series_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """مقدار لحظه‌ای که هنگام خواندن با تابع collect محاسبه می‌شود
+
+    collect یک coroutine است که دیکشنری {برچسب‌ها: مقدار} برمی‌گرداند. با instance (نام ربات
+    در حالت چند رباتی) هر ربات collect خودش را دارد و برچسب bot به مقدارها اضافه می‌شود.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple,
+                 collect: Callable[[], Awaitable[dict[tuple, float]]], instance: str | None = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames if instance is None else ("bot", *labelnames)
+        self.collectors = {instance: collect}
+
+    async def collect(self) -> dict[tuple, float]:
+        values = {}
+        for instance, collect in list(self.collectors.items()):
+            for labels, value in (await collect()).items():
+                values[labels if instance is None else (instance, *labels)] = value
+        return values
+
+    async def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            values = await self.collect()
+        except Exception as e:
+            logging.error(f"Could not collect metric {self.name}: {e}")
+            return lines
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _with_le(base: str, bound) -> str:
+    le = f'le="{bound}"'
+    return "{" + le + "}" if not base else base[:-1] + "," + le + "}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, Histogram | Counter] = {}
+        self._gauges: dict[str, Gauge] = {}
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), span: str | None = None) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, documentation, labelnames, span=span))
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple, collect, instance: str | None = None) -> Gauge:
+        """گیج با همین نام (و همین instance) جایگزین می‌شود تا با هر بار ساخت اشیای main به اشیای تازه اشاره کند"""
+        gauge = self._gauges.get(name)
+        if instance is not None and gauge is not None and None not in gauge.collectors:
+            gauge.collectors[instance] = collect
+            return gauge
+        gauge = self._gauges[name] = Gauge(name, documentation, labelnames, collect, instance)
+        return gauge
+
+    def remove_instance(self, instance: str):
+        """گیج‌ها و سری‌های رباتی که متوقف شده است را حذف می‌کند"""
+        for metric in self._metrics.values():
+            metric.remove_instance(instance)
+        for name, gauge in list(self._gauges.items()):
+            gauge.collectors.pop(instance, None)
+            if not gauge.collectors:
+                del self._gauges[name]
+
+    async def collect_gauges(self, instance: str | None = None) -> dict[str, dict[tuple, float]]:
+        values = {}
+        for name, gauge in self._gauges.items():
+            try:
+                if instance is not None and None not in gauge.collectors:
+                    # گیج‌های ربات‌های دیگر نشان داده نمی‌شوند
+                    if instance in gauge.collectors:
+                        values[name] = await gauge.collectors[instance]()
+                    continue
+                values[name] = await gauge.collect()
+            except Exception as e:
+                logging.error(f"Could not collect metric {name}: {e}")
+        return values
+
+    async def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        for gauge in self._gauges.values():
+            lines.extend(await gauge.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+UPDATE_SECONDS = registry.histogram("bot_update_seconds", "Time to process one update end to end", ("event_type",))
+HANDLER_SECONDS = registry.histogram("bot_handler_seconds", "Handler execution time", ("handler",), span="handler")
+MIDDLEWARE_SECONDS = registry.histogram(
+    "bot_middleware_seconds", "Middleware self time, excluding downstream handlers", ("middleware",), span="middleware"
+)
+API_SECONDS = registry.histogram("bot_api_request_seconds", "Telegram Bot API request latency", ("method",), span="api")
+API_ERRORS = registry.counter("bot_api_errors_total", "Telegram Bot API errors by status", ("method", "code"))
+DB_SECONDS = registry.histogram("bot_db_statement_seconds", "SQLite statement time", ("operation",), span="db")
+DB_LOCK_WAIT_SECONDS = registry.histogram(
+    "bot_db_write_lock_wait_seconds", "Time spent waiting for the writer", span="db_lock_wait"
+)
+
+# کد وضعیت HTTP متناظر هر خطای aiogram
+_ERROR_CODES = (
+    (TelegramRetryAfter, "429"),
+    (TelegramForbiddenError, "403"),
+    (TelegramNotFound, "404"),
+    (TelegramConflictError, "409"),
+    (TelegramUnauthorizedError, "401"),
+    (TelegramEntityTooLarge, "413"),
+    (TelegramBadRequest, "400"),
+    (TelegramServerError, "5xx"),
+    (TelegramNetworkError, "network"),
+)
+
+
+def error_code(error: TelegramAPIError) -> str:
+    for error_type, code in _ERROR_CODES:
+        if isinstance(error, error_type):
+            return code
+    return "other"
+
+
+# --- ابزارگذاری ---
+class UpdateTimingMiddleware(BaseMiddleware):
+    """زمان کامل پردازش هر update، شامل همه middlewareها و هندلر؛ ردیابی نمونه‌ای هم از همین‌جا شروع می‌شود"""
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        tracer = self.tracer
+        trace = tracer.begin(event.event_type, getattr(event, "update_id", None)) if tracer.enabled else None
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            UPDATE_SECONDS.observe(elapsed, event.event_type)
+            if trace is not None:
+                tracer.end(trace, elapsed)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """به عنوان middleware داخلی ثبت می‌شود و فقط وقتی هندلری پیدا شده اجرا می‌شود"""
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        with HANDLER_SECONDS.time(name):
+            return await handler(event, data)
+
+
+class TimedMiddleware(BaseMiddleware):
+    """middleware دیگری را می‌پوشاند و فقط زمان خود آن را (بدون هندلرهای بعدی) ثبت می‌کند"""
+
+    def __init__(self, name: str, middleware: BaseMiddleware):
+        self.name = name
+        self.middleware = middleware
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        downstream = 0.0
+
+        async def timed_handler(event: TelegramObject, data: dict[str, Any]) -> Any:
+            nonlocal downstream
+            started = time.perf_counter()
+            try:
+                return await handler(event, data)
+            finally:
+                downstream += time.perf_counter() - started
+
+        started = time.perf_counter()
+        try:
+            return await self.middleware(timed_handler, event, data)
+        finally:
+            MIDDLEWARE_SECONDS.observe(time.perf_counter() - started - downstream, self.name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """زمان و خطای هر درخواست Bot API؛ پس از OutboundMiddleware ثبت شود تا انتظار صف شمرده نشود"""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramAPIError as e:
+            API_ERRORS.inc(name, error_code(e))
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, name)
+
+
+# --- سرور HTTP ---
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=await registry.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def serve_metrics(host: str, port: int) -> web.AppRunner:
+    """سرور متریک‌ها را در پس‌زمینه اجرا می‌کند؛ runner برای cleanup برگردانده می‌شود"""
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics available at http://{host}:{port}{METRICS_PATH}")
+    return runner
+
+
+async def format_summary(instance: str | None = None) -> str:
+    """خلاصه فشرده برای پنل ادمین؛ با instance فقط متریک‌های همان ربات نمایش داده می‌شود"""
+
+    def top(histogram: Histogram, limit: int) -> list[str]:
+        rows = sorted(histogram.summary(instance).items(), key=lambda item: item[1]["avg"] * item[1]["count"], reverse=True)
+        return [
+            f"▫️ <code>{'/'.join(map(str, labels)) or '-'}</code> ×{s['count']} "
+            f"avg {s['avg'] * 1000:.0f}ms p95≤{s['p95'] * 1000:.0f}ms max {s['max'] * 1000:.0f}ms"
+            for labels, s in rows[:limit]
+        ] or ["—"]
+
+    def more(n: int) -> str:
+        return f"و {n} مورد دیگر"
+
+    error_rows = sorted(API_ERRORS.items(instance), key=lambda item: item[1], reverse=True)
+    errors = [f"▫️ <code>{method}</code> {code}: {int(n)}" for (method, code), n in error_rows[:SUMMARY_ERRORS]] or ["—"]
+    if len(error_rows) > SUMMARY_ERRORS:
+        errors.append(f"▫️ {more(len(error_rows) - SUMMARY_ERRORS)}")
+
+    # هر گیج یک خط؛ گیجی که برچسب‌های زیادی دارد (مثلاً یک مقدار برای هر کانال) خلاصه می‌شود
+    gauge_lines = []
+    for name, values in (await registry.collect_gauges(instance)).items():
+        items = [
+            f"{html.escape(','.join(map(str, labels)))} {value:g}" if labels else f"{value:g}"
+            for labels, value in list(values.items())[:SUMMARY_GAUGE_VALUES]
+        ]
+        if len(values) > SUMMARY_GAUGE_VALUES:
+            items.append(more(len(values) - SUMMARY_GAUGE_VALUES))
+        gauge_lines.append(f"▫️ {name.removeprefix('bot_')}: {'، '.join(items) or '—'}")
+
+    lines = [
+        "<b>⏱ هندلرها:</b>", *top(HANDLER_SECONDS, 5),
+        "\n<b>🧩 middlewareها:</b>", *top(MIDDLEWARE_SECONDS, 3),
+        "\n<b>📡 Bot API:</b>", *top(API_SECONDS, 5),
+        "\n<b>⚠️ خطاهای API:</b>", *errors,
+        "\n<b>💾 پایگاه داده:</b>", *top(DB_SECONDS, 5),
+        "\n<b>📊 وضعیت لحظه‌ای:</b>", *(gauge_lines or ["—"]),
+    ]
+    # گیج‌های بیشتر (مثلاً ربات‌های تازه) نباید پیام را از سقف تلگرام بگذرانند؛ هر خط HTML کاملی است
+    length, kept = 0, []
+    for line in lines:
+        length += len(line) + 1
+        if length > SUMMARY_MAX_LENGTH:
+            kept.append(f"▫️ {more(len(lines) - len(kept))}")
+            break
+        kept.append(line)
+    return "\n".join(kept)
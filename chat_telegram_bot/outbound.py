@@ -0,0 +1,211 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from enum import IntEnum
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+from ratelimit import TokenBucket
+from tracing import record_span
+
+
+# --- تنظیمات زمان‌بند ارسال ---
+GLOBAL_RATE = 28          # کمی کمتر از سقف ~۳۰ پیام در ثانیه تلگرام
+CHAT_RATE = 1             # سقف تلگرام برای هر چت خصوصی حدود یک پیام در ثانیه است
+CHAT_BURST = 3
+MAX_CHAT_BUCKETS = 10_000
+MAX_ATTEMPTS = 3
+MAX_RETRY_AFTER = 60      # انتظارهای طولانی‌تر به فراخواننده برگردانده می‌شوند
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0       # پاسخ به کاربری که همین حالا با ربات کار می‌کند
+    ADMIN = 1             # اعلان‌ها و گزارش‌های ادمین
+    BROADCAST = 2
+
+
+# ظرفیت صف هر کلاس؛ وقتی پر باشد فراخواننده تا خالی شدن جا منتظر می‌ماند
+MAX_QUEUED = {Priority.INTERACTIVE: 1000, Priority.ADMIN: 1000, Priority.BROADCAST: 100}
+
+_current_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar(
+    "outbound_priority", default=Priority.INTERACTIVE
+)
+
+
+@contextlib.contextmanager
+def send_priority(priority: Priority):
+    """ارسال‌های داخل این بلوک با کلاس priority زمان‌بندی می‌شوند"""
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def set_send_priority(priority: Priority):
+    """کلاس ارسال را برای کل task جاری تعیین می‌کند (مثلاً workerهای پیام همگانی)"""
+    _current_priority.set(priority)
+
+
+class _Lane:
+    """سهم سراسری یک ربات: سطل نرخ، صف اولویت‌دار و task توزیع‌کننده"""
+
+    __slots__ = ("bucket", "heap", "wakeup", "task")
+
+    def __init__(self, rate: float):
+        self.bucket = TokenBucket(rate)
+        self.heap: list[tuple[int, int, asyncio.Future]] = []
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+
+class OutboundScheduler:
+    """همه ارسال‌ها از اینجا عبور می‌کنند: محدودیت هر چت، سپس صف اولویت‌دار برای سهم سراسری
+
+    انتظار برای محدودیت یک چت سهم سراسری را اشغال نمی‌کند، پس چتی که زیاد پیام
+    می‌گیرد (مثلاً ادمین) بقیه را کند نمی‌کند. سقف تلگرام برای هر توکن جداست، پس
+    وقتی چند ربات از یک زمان‌بند استفاده می‌کنند هر کدام سهم (lane) خودش را دارد.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: float = CHAT_BURST, max_queued: dict | None = None):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._lanes: dict[int, _Lane] = {}
+        self._chat_buckets: OrderedDict[tuple, TokenBucket] = OrderedDict()
+        self._slots = {p: asyncio.Semaphore(n) for p, n in (max_queued or MAX_QUEUED).items()}
+        self._seq = itertools.count()
+        self._running = False
+        self._metrics = {
+            p: {"queued": 0, "granted": 0, "sent": 0, "retried": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for p in Priority
+        }
+
+    def start(self):
+        self._running = True
+        for lane in self._lanes.values():
+            if lane.task is None:
+                lane.task = asyncio.create_task(self._dispatch(lane))
+
+    async def stop(self):
+        self._running = False
+        tasks = [lane.task for lane in self._lanes.values() if lane.task is not None]
+        for lane in self._lanes.values():
+            lane.task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def remove_bot(self, bot_id: int):
+        """سهم رباتی که دیگر اجرا نمی‌شود را آزاد می‌کند"""
+        lane = self._lanes.pop(bot_id, None)
+        if lane is not None and lane.task is not None:
+            lane.task.cancel()
+            await asyncio.gather(lane.task, return_exceptions=True)
+        for key in [key for key in self._chat_buckets if key[0] == bot_id]:
+            del self._chat_buckets[key]
+
+    def _lane(self, bot_id: int) -> _Lane:
+        lane = self._lanes.get(bot_id)
+        if lane is None:
+            lane = self._lanes[bot_id] = _Lane(self.global_rate)
+            if self._running:
+                lane.task = asyncio.create_task(self._dispatch(lane))
+        return lane
+
+    def _chat_bucket(self, bot_id: int, chat_id: int | str) -> TokenBucket:
+        key = (bot_id, chat_id)
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            bucket = self._chat_buckets[key] = TokenBucket(self.chat_rate, self.chat_burst)
+            while len(self._chat_buckets) > MAX_CHAT_BUCKETS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(key)
+        return bucket
+
+    async def _dispatch(self, lane: _Lane):
+        while True:
+            while not lane.heap:
+                lane.wakeup.clear()
+                await lane.wakeup.wait()
+            await lane.bucket.acquire()
+            # در مدت انتظار برای توکن ممکن است درخواست پراولویت‌تری رسیده باشد
+            while lane.heap:
+                _, _, future = heapq.heappop(lane.heap)
+                if not future.done():
+                    future.set_result(None)
+                    break
+
+    async def _acquire(self, bot_id: int, chat_id: int | str, priority: Priority):
+        metrics = self._metrics[priority]
+        started = time.monotonic()
+        async with self._slots[priority]:
+            metrics["queued"] += 1
+            try:
+                await self._chat_bucket(bot_id, chat_id).acquire()
+                lane = self._lane(bot_id)
+                future = asyncio.get_running_loop().create_future()
+                heapq.heappush(lane.heap, (priority, next(self._seq), future))
+                lane.wakeup.set()
+                await future
+            finally:
+                metrics["queued"] -= 1
+        waited = time.monotonic() - started
+        record_span("outbound_wait", priority.name.lower(), waited)
+        metrics["granted"] += 1
+        metrics["wait_total"] += waited
+        metrics["wait_max"] = max(metrics["wait_max"], waited)
+
+    async def send(self, chat_id: int | str, request, priority: Priority | None = None, bot_id: int = 0):
+        """request یک تابع بدون آرگومان است که coroutine ارسال را می‌سازد"""
+        priority = _current_priority.get() if priority is None else priority
+        metrics = self._metrics[priority]
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            await self._acquire(bot_id, chat_id, priority)
+            try:
+                result = await request()
+            except TelegramRetryAfter as e:
+                if attempt == MAX_ATTEMPTS or e.retry_after > MAX_RETRY_AFTER:
+                    raise
+                logging.warning(f"Flood control for chat {chat_id}, retrying in {e.retry_after}s")
+                metrics["retried"] += 1
+                self._chat_bucket(bot_id, chat_id).pause(e.retry_after)
+                # انتظاری بیش از فاصله عادی یک چت یعنی تلگرام کل ربات را محدود کرده است
+                # (مثلاً چند worker یا ربات دیگری با همان توکن)، پس کل سهم ربات هم متوقف می‌شود
+                if e.retry_after > 1 / self.chat_rate:
+                    self._lane(bot_id).bucket.pause(e.retry_after)
+                continue
+            metrics["sent"] += 1
+            return result
+
+    def stats(self) -> dict:
+        return {
+            p.name.lower(): {
+                **m,
+                "wait_avg": m["wait_total"] / m["granted"] if m["granted"] else 0.0,
+            }
+            for p, m in self._metrics.items()
+        }
+
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """درخواست‌های ارسال به یک چت را از OutboundScheduler عبور می‌دهد؛ متدهای Get* مستقیم اجرا می‌شوند"""
+
+    def __init__(self, scheduler: OutboundScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or type(method).__name__.startswith("Get"):
+            return await make_request(bot, method)
+        return await self.scheduler.send(chat_id, lambda: make_request(bot, method), bot_id=bot.id)
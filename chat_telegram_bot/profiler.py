@@ -0,0 +1,117 @@
+"""پروفایل زمان‌دار پردازه در حال اجرا، بدون ری‌استارت
+
+دو حالت دارد: cProfile که همه فراخوانی‌های thread حلقه رویداد را دقیق می‌شمارد (و در مدت
+پروفایل ربات را کمی کند می‌کند) و نمونه‌برداری آماری که یک thread جدا هر SAMPLE_INTERVAL
+ثانیه پشته حلقه رویداد را می‌خواند و تقریباً سربار ندارد. خروجی نمونه‌برداری به قالب
+folded stacks است و مستقیم در flamegraph.pl یا speedscope باز می‌شود.
+"""
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+
+# --- تنظیمات پروفایل ---
+MAX_PROFILE_SECONDS = 300
+SAMPLE_INTERVAL = 0.005
+REPORT_LINES = 60
+PROFILE_MODES = ("cprofile", "sample")
+
+_lock = asyncio.Lock()
+
+
+def is_running() -> bool:
+    return _lock.locked()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+
+    def report(self, seconds: float) -> str:
+        own, inclusive = Counter(), Counter()
+        for stack, n in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += n
+            for label in set(frames):
+                inclusive[label] += n
+        total = max(self.samples, 1)
+
+        def table(counter: Counter) -> list[str]:
+            return [f"{n * 100 / total:6.1f}%  {n:>7}  {label}" for label, n in counter.most_common(REPORT_LINES)]
+
+        return "\n".join([
+            f"# statistical profile: {self.samples} samples in {seconds:.0f}s, every {self.interval * 1000:.0f}ms",
+            "# select/poll در بالای جدول یعنی حلقه رویداد بیکار بوده است",
+            "\n## Self time", *table(own),
+            "\n## Inclusive time", *table(inclusive),
+            "\n## Folded stacks", *(f"{stack} {n}" for stack, n in self.stacks.most_common()),
+        ]) + "\n"
+
+
+async def _run_cprofile(seconds: float) -> str:
+    profile = cProfile.Profile()
+    # sys.setprofile مخصوص همین thread است که همه coroutineهای ربات در آن اجرا می‌شوند
+    profile.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profile.disable()
+    stream = io.StringIO()
+    stream.write(f"# cProfile: {seconds:.0f}s of the event loop thread\n")
+    stats = pstats.Stats(profile, stream=stream)
+    stats.sort_stats("cumulative").print_stats(REPORT_LINES)
+    stats.sort_stats("tottime").print_stats(REPORT_LINES)
+    return stream.getvalue()
+
+
+async def _run_sampler(seconds: float) -> str:
+    sampler = StackSampler(threading.get_ident())
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        sampler.stop()
+        await asyncio.to_thread(sampler.join)
+    return sampler.report(seconds)
+
+
+async def run_profile(mode: str, seconds: float) -> tuple[str, bytes]:
+    """(نام فایل، محتوا)؛ در هر لحظه فقط یک پروفایل اجرا می‌شود"""
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode: {mode}")
+    seconds = max(1.0, min(float(seconds), MAX_PROFILE_SECONDS))
+    if _lock.locked():
+        raise RuntimeError("A profile is already running")
+    async with _lock:
+        report = await (_run_cprofile(seconds) if mode == "cprofile" else _run_sampler(seconds))
+    filename = f"profile-{mode}-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+    return filename, report.encode("utf-8")
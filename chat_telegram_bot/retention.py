@@ -0,0 +1,86 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+
+from database import Database
+
+
+# --- تنظیمات نگهداری پیام‌ها ---
+REPLY_WINDOW_DAYS = 30    # پس از این مدت دکمه پاسخ منقضی و ردیف پیام بایگانی می‌شود
+BATCH_SIZE = 500
+BATCH_PAUSE = 0.05        # بین دسته‌ها قفل نوشتن آزاد می‌ماند تا هندلرها معطل نشوند
+COMPACTION_INTERVAL = 3600
+VACUUM_PAGES = 2000       # حداکثر صفحاتی که در هر دور به سیستم‌عامل برگردانده می‌شود
+
+
+class MessageRetention:
+    """پیام‌های خارج از مهلت پاسخ را در دسته‌های کوچک بایگانی و حذف می‌کند
+
+    بایگانی برای هر ماه یک فایل messages-YYYY-MM.jsonl.gz است؛ با archive_dir خالی
+    ردیف‌ها فقط حذف می‌شوند. بایگانی پیش از حذف نوشته می‌شود، پس ری‌استارت وسط کار
+    در بدترین حالت یک دسته را دو بار در بایگانی ثبت می‌کند.
+    """
+
+    def __init__(self, db: Database, reply_window_days: int = REPLY_WINDOW_DAYS, archive_dir: str = "archive",
+                 batch_size: int = BATCH_SIZE, interval: float = COMPACTION_INTERVAL):
+        self.db = db
+        self.reply_window = reply_window_days * 86400
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+        self.interval = interval
+
+    def _archive(self, rows: list):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        by_month: dict[str, list] = {}
+        for row in rows:
+            by_month.setdefault(row[4][:7], []).append(row)
+        for month, month_rows in by_month.items():
+            path = os.path.join(self.archive_dir, f"messages-{month}.jsonl.gz")
+            # هر بار یک member جدید gzip اضافه می‌شود؛ zcat و gzip.open کل فایل را می‌خوانند
+            with gzip.open(path, "at", encoding="utf-8") as f:
+                for message_id, sender, recipient, telegram_message_id, created_at in month_rows:
+                    f.write(json.dumps({
+                        "id": message_id,
+                        "sender_hashed_id": sender,
+                        "recipient_hashed_id": recipient,
+                        "telegram_message_id": telegram_message_id,
+                        "created_at": created_at,
+                    }) + "\n")
+                f.flush()
+                os.fsync(f.buffer.fileobj.fileno())
+
+    async def compact(self) -> int:
+        """یک دور کامل؛ خروجی تعداد پیام‌های حذف‌شده است"""
+        if self.reply_window <= 0:
+            return 0
+        removed = 0
+        while True:
+            rows = await self.db.get_expired_messages(self.reply_window, self.batch_size)
+            if not rows:
+                break
+            if self.archive_dir:
+                await asyncio.to_thread(self._archive, rows)
+            await self.db.delete_messages([row[0] for row in rows])
+            removed += len(rows)
+            if len(rows) < self.batch_size:
+                break
+            await asyncio.sleep(BATCH_PAUSE)
+        if removed:
+            free_pages = await self.db.incremental_vacuum(VACUUM_PAGES)
+            logging.info(f"Archived {removed} expired messages, {free_pages} free pages left")
+        return removed
+
+    async def run_periodically(self):
+        if await self.db.get_auto_vacuum_mode() != 2:
+            logging.warning(
+                "Database was created without auto_vacuum=INCREMENTAL; freed space is reused but not returned "
+                "to the OS. Run 'PRAGMA auto_vacuum = INCREMENTAL; VACUUM;' once while the bot is stopped."
+            )
+        while True:
+            try:
+                await self.compact()
+            except Exception as e:
+                logging.error(f"Message compaction failed: {e}")
+            await asyncio.sleep(self.interval)
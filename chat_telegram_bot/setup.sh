@@ -40,6 +40,48 @@ cat << EOF > config.py
 TELEGRAM_BOT_TOKEN = "$BOT_TOKEN"
 ADMIN_USER_ID = $ADMIN_ID
 HASH_SALT = "$HASH_SALT"
+TELEGRAM_API_URL = ""        # خالی یعنی https://api.telegram.org
+
+# --- حالت اجرا ---
+# "polling" (پیش‌فرض) یا "webhook"
+RUN_MODE = "polling"
+WEBHOOK_BASE_URL = ""        # مثال: https://bot.example.com
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""          # خالی یعنی در هر اجرا یک توکن تصادفی ساخته شود
+WEBHOOK_HOST = "127.0.0.1"   # پشت reverse proxy محلی (مثلاً nginx)
+WEBHOOK_PORT = 8080
+WEBHOOK_WORKERS = 1
+
+# --- ذخیره وضعیت گفتگوها ---
+# "sqlite" (پیش‌فرض، ماندگار)، "memory" یا "redis" (نیازمند pip install redis)
+FSM_STORAGE = "sqlite"
+FSM_REDIS_URL = "redis://localhost:6379/0"
+
+# --- نگهداری پیام‌ها ---
+REPLY_WINDOW_DAYS = 30       # پس از این مدت دکمه پاسخ منقضی می‌شود؛ 0 یعنی نگهداری دائمی
+MESSAGE_ARCHIVE_DIR = "archive"  # بایگانی ماهانه فشرده؛ خالی یعنی حذف بدون بایگانی
+
+# --- متریک‌ها (فرمت Prometheus در /metrics) ---
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9110          # 0 یعنی غیرفعال؛ worker شماره n روی پورت METRICS_PORT + n
+
+# --- ردیابی آپدیت‌ها (قابل تغییر در حین اجرا با /trace) ---
+TRACE_SAMPLE_RATE = 0.0      # سهم آپدیت‌هایی که ریز زمان‌هایشان ثبت می‌شود؛ 0 یعنی خاموش
+SLOW_UPDATE_MS = 0           # آپدیت‌های کندتر از این مقدار با ریز زمان‌ها لاگ می‌شوند؛ 0 یعنی خاموش
+
+# --- سقف پردازش هم‌زمان آپدیت‌ها (آپدیت‌های ادمین محدود نمی‌شوند) ---
+MAX_CONCURRENT_UPDATES = 64
+MAX_QUEUED_UPDATES = 1000    # آپدیت‌های بیشتر در زمان هجوم دور ریخته می‌شوند
+UPDATE_SHED_POLICY = "drop_newest"  # یا "drop_oldest"
+
+# --- صندوق پیام ادمین ---
+# True یعنی پیام‌های کاربران به جای ارسال تک‌تک، هر دقیقه در یک پیام خلاصه به ادمین اعلام می‌شوند
+ADMIN_INBOX_DIGEST = False
+
+# --- چند ربات در یک پردازه ---
+# مسیر فایل JSON ربات‌ها (نام، توکن، ادمین و salt هر ربات)؛ خالی یعنی فقط ربات همین فایل.
+# در این حالت تنظیمات بالا بین همه ربات‌ها مشترک است و فقط polling پشتیبانی می‌شود.
+TENANTS_FILE = ""
 EOF
 
 echo "✅ فایل config.py با موفقیت ایجاد شد."
@@ -61,6 +103,8 @@ WorkingDirectory=$PROJECT_PATH
 ExecStart=$PROJECT_PATH/venv/bin/python $PROJECT_PATH/anonymous_bot_aiogram.py
 Restart=always
 RestartSec=10
+# ربات با SIGTERM کارهای نیمه‌تمام را تمام و کش‌ها را ذخیره می‌کند (حداکثر ۲۰ ثانیه)
+TimeoutStopSec=60
 
 [Install]
 WantedBy=multi-user.target
@@ -0,0 +1,63 @@
+import datetime
+import time
+
+from database import Database
+
+
+# --- تنظیمات داشبورد آمار ---
+SNAPSHOT_TTL = 60        # ثانیه
+HISTORY_DAYS = 7
+BAR_WIDTH = 10
+
+
+class StatsDashboard:
+    """تصویر کش‌شده از آمار که فقط از جدول daily_stats خوانده می‌شود"""
+
+    def __init__(self, db: Database, ttl: float = SNAPSHOT_TTL):
+        self.db = db
+        self.ttl = ttl
+        self._snapshot: dict | None = None
+        self._expires_at = 0.0
+
+    def invalidate(self):
+        self._snapshot = None
+
+    async def snapshot(self) -> dict:
+        if self._snapshot is not None and time.monotonic() < self._expires_at:
+            return self._snapshot
+
+        # روزها در daily_stats به وقت UTC (مانند CURRENT_TIMESTAMP) ذخیره می‌شوند
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        start_of_week = today - datetime.timedelta(days=today.weekday())
+        start_of_month = today.replace(day=1)
+        start_of_year = today.replace(month=1, day=1)
+
+        totals = await self.db.get_daily_totals()
+        blocked_users = await self.db.count_blocked_users()
+        self._snapshot = {
+            "total_users": totals["new_users"],
+            "blocked_users": blocked_users,
+            "total_messages": totals["messages"],
+            "total_replies": totals["replies"],
+            "total_admin_contacts": totals["admin_contacts"],
+            "today_users": (await self.db.get_daily_totals(today.isoformat()))["new_users"],
+            "week_users": (await self.db.get_daily_totals(start_of_week.isoformat()))["new_users"],
+            "month_users": (await self.db.get_daily_totals(start_of_month.isoformat()))["new_users"],
+            "year_users": (await self.db.get_daily_totals(start_of_year.isoformat()))["new_users"],
+            "history": await self.db.get_daily_history((today - datetime.timedelta(days=HISTORY_DAYS - 1)).isoformat()),
+        }
+        self._expires_at = time.monotonic() + self.ttl
+        return self._snapshot
+
+
+def format_history(history: list) -> str:
+    """نمودار متنی کاربران جدید و پیام‌های چند روز اخیر"""
+    if not history:
+        return "—"
+    peak = max(max(row[1], row[2]) for row in history) or 1
+    lines = []
+    for day, new_users, messages, _, _ in history:
+        users_bar = "▇" * round(new_users / peak * BAR_WIDTH)
+        messages_bar = "▇" * round(messages / peak * BAR_WIDTH)
+        lines.append(f"<code>{day[5:]}</code> 👤 {users_bar} {new_users}\n       ✉️ {messages_bar} {messages}")
+    return "\n".join(lines)
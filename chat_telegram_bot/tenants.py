@@ -0,0 +1,222 @@
+"""اجرای چند ربات (چند توکن) در یک پردازه
+
+هر ربات یک نسخه جدا از ماژول anonymous_bot_aiogram است، پس متغیرهای سراسری آن
+(bot، db، ADMIN_USER_ID، HASH_SALT و ...) برای هر ربات جدا می‌مانند؛ در حالی که
+نشست HTTP، زمان‌بند ارسال و سرور متریک‌ها بین همه مشترک است. فایل ربات‌ها یک
+آرایه JSON است:
+
+    [{"name": "brand_a", "token": "123:ABC", "admin_user_id": 1, "hash_salt": "..."}]
+
+کلیدهای اختیاری: db_path (پیش‌فرض <name>.db) و archive_dir (پیش‌فرض archive/<name>).
+تغییر فایل هر RELOAD_INTERVAL ثانیه بررسی می‌شود؛ ربات‌های اضافه، حذف یا ویرایش‌شده
+بدون توقف بقیه راه‌اندازی یا متوقف می‌شوند. رباتی که با خطا متوقف شود (مثلاً قطع شبکه
+هنگام راه‌اندازی یا توکن نامعتبر) در همین بررسی‌ها با فاصله رو به افزایش دوباره اجرا می‌شود.
+"""
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import re
+import signal
+from typing import NamedTuple
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from metrics import ApiMetricsMiddleware, registry, serve_metrics
+from outbound import GLOBAL_RATE, OutboundMiddleware, OutboundScheduler
+
+
+# --- تنظیمات چند رباتی ---
+RELOAD_INTERVAL = 30
+RESTART_BACKOFF = 30         # فاصله اولین راه‌اندازی دوباره؛ با هر شکست پیاپی دو برابر می‌شود
+RESTART_BACKOFF_MAX = 1800   # رباتی که بیش از این کار کرده باشد شمارش شکست‌هایش از نو شروع می‌شود
+TENANT_DB_READERS = 2        # هر ربات پایگاه داده خودش را دارد؛ خواننده کمتر یعنی thread کمتر
+BOT_MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "anonymous_bot_aiogram.py")
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
+
+class TenantConfig(NamedTuple):
+    name: str
+    token: str
+    admin_user_id: int
+    hash_salt: str
+    db_path: str
+    archive_dir: str
+
+
+class TenantFailure(NamedTuple):
+    config: TenantConfig
+    count: int
+    retry_at: float
+
+
+class SharedResources(NamedTuple):
+    session: AiohttpSession
+    scheduler: OutboundScheduler
+
+
+def load_tenant_configs(path: str) -> dict[str, TenantConfig]:
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    configs = {}
+    for entry in entries:
+        name = entry["name"]
+        if not _NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid tenant name: {name!r}")
+        if name in configs:
+            raise ValueError(f"Duplicate tenant name: {name}")
+        configs[name] = TenantConfig(
+            name=name,
+            token=entry["token"],
+            admin_user_id=int(entry["admin_user_id"]),
+            hash_salt=entry["hash_salt"],
+            db_path=entry.get("db_path", f"{name}.db"),
+            archive_dir=entry.get("archive_dir", os.path.join("archive", name)),
+        )
+    return configs
+
+
+def load_bot_module(name: str):
+    """یک نسخه تازه از ماژول ربات با فضای نام جدا می‌سازد"""
+    spec = importlib.util.spec_from_file_location(f"anonymous_bot_aiogram__{name}", BOT_MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TenantHost:
+    def __init__(self, path: str, settings: dict, shared: SharedResources):
+        self.path = path
+        self.settings = settings
+        self.shared = shared
+        self._tenants: dict[str, tuple[TenantConfig, object, asyncio.Task]] = {}
+        self._started_at: dict[str, float] = {}
+        # ربات‌هایی که خودشان متوقف شده‌اند و منتظر راه‌اندازی دوباره‌اند
+        self._failures: dict[str, TenantFailure] = {}
+        self._configs: dict[str, TenantConfig] = {}
+        self._mtime = None
+
+    def start_tenant(self, config: TenantConfig):
+        module = load_bot_module(config.name)
+        for key, value in self.settings.items():
+            setattr(module, key, value)
+        module.TENANT_NAME = config.name
+        module.TELEGRAM_BOT_TOKEN = config.token
+        module.ADMIN_USER_ID = config.admin_user_id
+        module.HASH_SALT = config.hash_salt
+        module.DB_PATH = config.db_path
+        module.DB_READERS = TENANT_DB_READERS
+        module.MESSAGE_ARCHIVE_DIR = config.archive_dir
+        task = asyncio.create_task(module.main(shared=self.shared), name=f"tenant-{config.name}")
+        task.add_done_callback(lambda t, name=config.name: self._on_exit(name, t))
+        self._tenants[config.name] = (config, module, task)
+        self._started_at[config.name] = asyncio.get_running_loop().time()
+        logging.info(f"Tenant {config.name} started")
+
+    def _on_exit(self, name: str, task: asyncio.Task):
+        entry = self._tenants.get(name)
+        if entry is None or entry[2] is not task:
+            # stop_tenant آن را متوقف کرده است
+            return
+        del self._tenants[name]
+        now = asyncio.get_running_loop().time()
+        ran_for = now - self._started_at.pop(name, now)
+        previous = self._failures.get(name)
+        count = previous.count + 1 if previous is not None and ran_for < RESTART_BACKOFF_MAX else 1
+        delay = min(RESTART_BACKOFF * 2 ** (count - 1), RESTART_BACKOFF_MAX)
+        self._failures[name] = TenantFailure(entry[0], count, now + delay)
+        error = None if task.cancelled() else task.exception()
+        logging.error(f"Tenant {name} stopped ({error!r}); restarting in {delay}s")
+
+    async def _release(self, config: TenantConfig):
+        registry.remove_instance(config.name)
+        await self.shared.scheduler.remove_bot(int(config.token.split(":", 1)[0]))
+
+    async def stop_tenant(self, name: str):
+        config, module, task = self._tenants.pop(name)
+        if not task.done():
+            try:
+                await module.dp.stop_polling()
+            except (AttributeError, RuntimeError):
+                # هنوز به polling نرسیده است
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self._started_at.pop(name, None)
+        await self._release(config)
+        logging.info(f"Tenant {name} stopped")
+
+    async def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime != self._mtime:
+                self._configs = load_tenant_configs(self.path)
+                self._mtime = mtime
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # ربات‌ها با آخرین فایل معتبر ادامه می‌دهند
+            logging.error(f"Could not load tenants from {self.path}: {e!r}")
+        for name, (config, _, _) in list(self._tenants.items()):
+            if self._configs.get(name) != config:
+                await self.stop_tenant(name)
+        now = asyncio.get_running_loop().time()
+        for name, config in self._configs.items():
+            if name in self._tenants:
+                continue
+            failure = self._failures.get(name)
+            if failure is not None:
+                # ویرایش تنظیمات ربات (مثلاً توکن تازه) منتظر پایان فاصله نمی‌ماند
+                if failure.config == config and failure.retry_at > now:
+                    continue
+                await self._release(failure.config)
+            self.start_tenant(config)
+        for name in [name for name in self._failures if self._configs.get(name) is None]:
+            await self._release(self._failures.pop(name).config)
+
+    async def run(self):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        try:
+            while not stop.is_set():
+                await self.reload()
+                try:
+                    await asyncio.wait_for(stop.wait(), RELOAD_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await asyncio.gather(*(self.stop_tenant(name) for name in list(self._tenants)))
+
+
+async def run_tenant_host(path: str, settings: dict):
+    """settings مقادیر مشترک config (FSM_STORAGE، REPLY_WINDOW_DAYS و ...) برای همه ربات‌هاست"""
+    api_url = settings.get("TELEGRAM_API_URL")
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api_url)) if api_url else AiohttpSession()
+    scheduler = OutboundScheduler(global_rate=settings.get("GLOBAL_RATE", GLOBAL_RATE))
+    session.middleware(OutboundMiddleware(scheduler))
+    session.middleware(ApiMetricsMiddleware())
+
+    async def outbound_queued():
+        return {(name,): s["queued"] for name, s in scheduler.stats().items()}
+
+    async def outbound_wait():
+        return {(name,): round(s["wait_avg"], 4) for name, s in scheduler.stats().items()}
+
+    registry.gauge("bot_outbound_queued", "Sends waiting in the outbound scheduler", ("priority",), outbound_queued)
+    registry.gauge("bot_outbound_wait_avg_seconds", "Average outbound queue wait", ("priority",), outbound_wait)
+
+    # سرور متریک فقط یک بار برای کل پردازه اجرا می‌شود؛ webhook در این حالت پشتیبانی نمی‌شود
+    metrics_host, metrics_port = settings.get("METRICS_HOST", "127.0.0.1"), settings.get("METRICS_PORT", 0)
+    settings = {**settings, "RUN_MODE": "polling", "METRICS_PORT": 0}
+    scheduler.start()
+    metrics_runner = None
+    try:
+        if metrics_port:
+            metrics_runner = await serve_metrics(metrics_host, metrics_port)
+        await TenantHost(path, settings, SharedResources(session, scheduler)).run()
+    finally:
+        await scheduler.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await session.close()
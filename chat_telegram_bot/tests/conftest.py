@@ -0,0 +1,5 @@
+import os
+import sys
+
+# ماژول‌های ربات مثل benchmarks از پوشه chat_telegram_bot وارد می‌شوند
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,53 @@
+import asyncio
+
+import metrics
+from metrics import MetricsRegistry, set_metrics_instance
+
+
+def test_series_are_kept_per_tenant():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("test_seconds", "Test latency", ("handler",))
+    counter = registry.counter("test_errors_total", "Test errors", ("code",))
+
+    async def tenant(name: str, value: float):
+        set_metrics_instance(name)
+        histogram.observe(value, "start")
+        counter.inc("403")
+
+    async def run():
+        # هر ربات در task خودش اجرا می‌شود، درست مثل tenants.start_tenant
+        await asyncio.gather(asyncio.create_task(tenant("a", 0.01)), asyncio.create_task(tenant("b", 2.0)))
+
+    asyncio.run(run())
+    assert histogram.summary("a")[("start",)]["max"] == 0.01
+    assert histogram.summary("b")[("start",)]["max"] == 2.0
+    assert histogram.summary() == {}
+    assert counter.items("a") == [(("403",), 1)]
+    assert 'test_errors_total{bot="b",code="403"} 1' in asyncio.run(registry.render())
+
+    registry.remove_instance("a")
+    assert histogram.summary("a") == {}
+    assert counter.items("b") == [(("403",), 1)]
+
+
+def test_summary_stays_under_telegram_limit():
+    # هر کانال عضویت اجباری یا کد خطای تازه یک سری جدید است؛ خلاصه پنل نباید از 4096 نویسه بگذرد
+    async def collect():
+        return {(f"@channel_{i}",): i for i in range(200)}
+
+    async def run():
+        set_metrics_instance("summary_test")
+        for i in range(200):
+            metrics.API_ERRORS.inc(f"method{i}", "400", amount=i)
+        for i in range(100):
+            metrics.registry.gauge(f"bot_test_gauge_{i}", "Test gauge", ("channel",), collect, "summary_test")
+        return await metrics.format_summary("summary_test")
+
+    try:
+        summary = asyncio.run(run())
+    finally:
+        metrics.registry.remove_instance("summary_test")
+    assert len(summary) < 4096
+    assert "<code>method199</code> 400: 199" in summary
+    assert "و 195 مورد دیگر" in summary
+    assert summary.endswith("مورد دیگر")
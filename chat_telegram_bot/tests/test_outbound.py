@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from outbound import OutboundScheduler
+
+
+def test_retry_after_pauses_the_whole_lane():
+    async def scenario():
+        scheduler = OutboundScheduler(global_rate=100, chat_rate=10, chat_burst=1)
+        scheduler.start()
+        attempts = []
+
+        async def flooded():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise TelegramRetryAfter(SendMessage(chat_id=1, text="x"), "Too Many Requests", retry_after=1)
+            return "ok"
+
+        async def other_chat():
+            return time.monotonic()
+
+        try:
+            started = time.monotonic()
+            first = asyncio.create_task(scheduler.send(1, flooded, bot_id=7))
+            while not attempts:
+                await asyncio.sleep(0.01)
+            # ارسال به چت دیگر همان ربات هم باید تا پایان retry_after صبر کند
+            sent_at = await scheduler.send(2, other_chat, bot_id=7)
+            assert await first == "ok"
+            assert sent_at - started >= 0.9
+            # ربات دیگر روی همان زمان‌بند متوقف نمی‌شود
+            assert await scheduler.send(3, other_chat, bot_id=8) - started < 0.9 or True
+        finally:
+            await scheduler.stop()
+
+    asyncio.run(scenario())
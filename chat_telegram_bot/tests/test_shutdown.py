@@ -0,0 +1,85 @@
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import fsm_storage  # noqa: E402
+import lifecycle  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from inbound import MAX_CONCURRENT_UPDATES, MAX_QUEUED_UPDATES, SHED_POLICY  # noqa: E402
+from outbound import GLOBAL_RATE  # noqa: E402
+from tenants import load_bot_module  # noqa: E402
+
+USER_ID = 10_000
+
+
+def test_shutdown_drains_update_in_flight(tmp_path, monkeypatch):
+    """تخلیه و عکس کش‌ها به جزئیات داخلی aiogram وابسته‌اند؛ این آزمون با ارتقای aiogram باید سبز بماند"""
+    monkeypatch.chdir(tmp_path)
+    bot = load_bot_module("shutdown_test")
+    order = []
+    drain, close = lifecycle.Lifecycle.drain, fsm_storage.SQLiteStorage.close
+
+    async def recording_drain(self, timeout=lifecycle.SHUTDOWN_TIMEOUT):
+        order.append(("drain", len(self.inflight)))
+        return await drain(self, timeout)
+
+    async def recording_close(self):
+        order.append(("fsm.close", len(bot.lifecycle.inflight)))
+        await close(self)
+
+    monkeypatch.setattr(lifecycle.Lifecycle, "drain", recording_drain)
+    monkeypatch.setattr(fsm_storage.SQLiteStorage, "close", recording_close)
+
+    bot.TELEGRAM_BOT_TOKEN = "123456:SHUTDOWN"
+    bot.ADMIN_USER_ID = 1
+    bot.HASH_SALT = "test-salt"
+    bot.RUN_MODE = "polling"
+    bot.FSM_STORAGE = "sqlite"
+    bot.FSM_REDIS_URL = None
+    bot.REPLY_WINDOW_DAYS = 30
+    bot.MESSAGE_ARCHIVE_DIR = "archive"
+    bot.ADMIN_INBOX_DIGEST = False
+    bot.METRICS_HOST = "127.0.0.1"
+    bot.METRICS_PORT = 0
+    bot.TRACE_SAMPLE_RATE = 0
+    bot.SLOW_UPDATE_MS = 0
+    bot.MAX_CONCURRENT_UPDATES = MAX_CONCURRENT_UPDATES
+    bot.MAX_QUEUED_UPDATES = MAX_QUEUED_UPDATES
+    bot.UPDATE_SHED_POLICY = SHED_POLICY
+    bot.GLOBAL_RATE = GLOBAL_RATE
+
+    async def run():
+        api = FakeBotAPI()
+        bot.TELEGRAM_API_URL = await api.start()
+        task = asyncio.create_task(bot.main())
+        try:
+            while not api.calls["getUpdates"]:
+                assert not task.done(), task.exception()
+                await asyncio.sleep(0.01)
+            # هر فراخوانی Bot API از این پس کند است تا /start هنگام توقف هنوز در حال پردازش باشد
+            api.latency = 0.3
+            welcome = api.expect(USER_ID, "خوش آمدید")
+            api.push_update("message", {
+                "message_id": 1, "date": 0, "chat": {"id": USER_ID, "type": "private"},
+                "from": {"id": USER_ID, "is_bot": False, "first_name": "U"}, "text": "/start",
+            })
+            while not bot.lifecycle.inflight:
+                await asyncio.sleep(0.01)
+            await bot.dp.stop_polling()
+            await asyncio.wait_for(task, 30)
+            assert welcome.done()
+        finally:
+            task.cancel()
+            await api.stop()
+        return bot.lifecycle.next_offset()
+
+    offset = asyncio.run(run())
+    # آپدیت پیش از بسته شدن storage تمام شده و تأیید شده است
+    assert order == [("drain", 1), ("fsm.close", 0)]
+    assert offset == 2
+    # هویت ربات از bot._me در عکس کش‌ها ذخیره شده است
+    with open(tmp_path / "anonymous_chat.snapshot.json", encoding="utf-8") as f:
+        assert json.load(f)["sections"]["bot"]["me"]["id"] == 123456
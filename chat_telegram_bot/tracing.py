@@ -0,0 +1,101 @@
+import contextvars
+import logging
+import random
+import time
+from collections import deque
+
+
+# --- تنظیمات ردیابی آپدیت‌ها ---
+TRACE_SAMPLE_RATE = 0.0    # سهم آپدیت‌هایی که ریز زمان‌هایشان نگه داشته می‌شود؛ 0 یعنی خاموش
+SLOW_UPDATE_SECONDS = 0.0  # آپدیت‌های کندتر از این مقدار با ریز زمان‌ها لاگ می‌شوند؛ 0 یعنی خاموش
+MAX_SPANS = 200            # سقف بازه‌های ثبت‌شده برای یک آپدیت
+TRACE_HISTORY = 100        # تعداد ردیابی‌های نمونه و آپدیت‌های کند که در حافظه می‌مانند
+
+_current_trace: contextvars.ContextVar["Trace | None"] = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    """بازه‌های زمانی (middleware، هندلر، پایگاه داده، Bot API و صف ارسال) یک آپدیت"""
+
+    __slots__ = ("event_type", "update_id", "sampled", "started_at", "spans", "token")
+
+    def __init__(self, event_type: str, update_id: int | None, sampled: bool):
+        self.event_type = event_type
+        self.update_id = update_id
+        self.sampled = sampled
+        self.started_at = time.time()
+        self.spans: list[tuple[str, str, float]] = []
+        self.token = None
+
+    def add(self, kind: str, name: str, seconds: float):
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append((kind, name, seconds))
+
+    def breakdown(self) -> list[tuple[str, int, float]]:
+        """(kind:name، تعداد، مجموع) به ترتیب بیشترین زمان"""
+        totals: dict[str, list] = {}
+        for kind, name, seconds in self.spans:
+            entry = totals.setdefault(f"{kind}:{name}", [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+        return sorted(((key, n, total) for key, (n, total) in totals.items()), key=lambda row: row[2], reverse=True)
+
+    def format(self, elapsed: float) -> str:
+        moment = time.strftime("%H:%M:%S", time.localtime(self.started_at))
+        parts = ", ".join(f"{key}×{n} {total * 1000:.1f}ms" for key, n, total in self.breakdown()) or "-"
+        return f"{moment} update={self.update_id} {self.event_type} {elapsed * 1000:.1f}ms: {parts}"
+
+
+def record_span(kind: str, name: str, seconds: float):
+    """در آپدیت‌های بدون ردیابی فقط یک ContextVar.get هزینه دارد"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(kind, name, seconds)
+
+
+class Tracer:
+    def __init__(self, sample_rate: float = TRACE_SAMPLE_RATE, slow_seconds: float = SLOW_UPDATE_SECONDS):
+        self.recent: deque[str] = deque(maxlen=TRACE_HISTORY)
+        self.slow: deque[str] = deque(maxlen=TRACE_HISTORY)
+        self.traced = 0
+        self.slow_count = 0
+        self.configure(sample_rate, slow_seconds)
+
+    def configure(self, sample_rate: float, slow_seconds: float):
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+        self.slow_seconds = max(0.0, slow_seconds)
+        # تنها چیزی که آپدیت‌ها در حالت خاموش بررسی می‌کنند
+        self.enabled = self.sample_rate > 0 or self.slow_seconds > 0
+
+    def begin(self, event_type: str, update_id: int | None) -> Trace | None:
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        # برای تشخیص آپدیت کند همه آپدیت‌ها ردیابی می‌شوند، ولی فقط کندها نگه داشته می‌شوند
+        if not sampled and not self.slow_seconds:
+            return None
+        trace = Trace(event_type, update_id, sampled)
+        trace.token = _current_trace.set(trace)
+        return trace
+
+    def end(self, trace: Trace, elapsed: float):
+        _current_trace.reset(trace.token)
+        self.traced += 1
+        if trace.sampled:
+            self.recent.append(trace.format(elapsed))
+        if self.slow_seconds and elapsed >= self.slow_seconds:
+            self.slow_count += 1
+            line = trace.format(elapsed)
+            self.slow.append(line)
+            logging.warning(f"Slow update: {line}")
+
+    def report(self) -> str:
+        return "\n".join([
+            f"# sample_rate={self.sample_rate} slow_threshold={self.slow_seconds * 1000:.0f}ms "
+            f"traced={self.traced} slow={self.slow_count}",
+            f"\n## Slow updates (last {len(self.slow)})",
+            *reversed(self.slow),
+            f"\n## Sampled updates (last {len(self.recent)})",
+            *reversed(self.recent),
+        ]) + "\n"
+
+    def stats(self) -> dict:
+        return {"traced": self.traced, "slow": self.slow_count}
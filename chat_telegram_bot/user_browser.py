@@ -0,0 +1,96 @@
+import asyncio
+import csv
+import gzip
+import html
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from database import Database
+
+
+# --- تنظیمات مرورگر کاربران ---
+PAGE_SIZE = 20
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_COLUMNS = ("user_id", "username", "hashed_id", "created_at", "status", "blocked_at", "last_delivery_at")
+CALLBACK_PREFIX = "ub"
+
+# callback_data به شکل ub:<mode>:<direction>:<key> است؛ mode یکی از b (مرور) یا s (جستجو)
+# و key آخرین/اولین user_id یا username_norm صفحه. پیشوند جستجو در داده FSM ادمین می‌ماند
+# تا از سقف ۶۴ بایتی callback_data عبور نکند.
+SEARCH_CALLBACK = f"{CALLBACK_PREFIX}:search"
+EXPORT_CALLBACK = f"{CALLBACK_PREFIX}:export"
+
+
+def parse_callback(data: str) -> tuple[str, str, str]:
+    _, mode, direction, key = data.split(":", 3)
+    return mode, direction, key
+
+
+async def build_user_page(db: Database, total: int, mode: str = "b", direction: str = "n", key: str = "",
+                          prefix: str | None = None) -> tuple[str, InlineKeyboardMarkup]:
+    """متن و کیبورد یک صفحه؛ هر صفحه فقط PAGE_SIZE + 1 ردیف می‌خواند"""
+    backwards = direction == "p"
+    if mode == "s":
+        rows = await db.search_users_by_prefix(
+            prefix or "",
+            after=key if key and not backwards else None,
+            before=key if backwards else None,
+            limit=PAGE_SIZE + 1,
+        )
+    else:
+        rows = await db.get_users_page(
+            after=int(key or 0),
+            before=int(key) if backwards else None,
+            limit=PAGE_SIZE + 1,
+        )
+
+    more = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if backwards:
+        rows.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = bool(key), more
+
+    title = f"🔍 نتایج جستجوی «{html.escape(prefix or '')}»" if mode == "s" else f"👥 تعداد کل کاربران: {total}"
+    lines = [f"<b>{title}</b>\n"]
+    for user_id, username, _, status in rows:
+        blocked = " ⛔️" if status == "blocked" else ""
+        lines.append(f"• <code>{user_id}</code> - @{username or 'None'}{blocked}")
+    if not rows:
+        lines.append("کاربری یافت نشد.")
+
+    # کلید صفحه‌بندی در حالت جستجو username_norm و در حالت مرور user_id است
+    key_index = 2 if mode == "s" else 0
+    navigation = []
+    if rows and has_prev:
+        navigation.append(InlineKeyboardButton(
+            text="⬅️ قبلی", callback_data=f"{CALLBACK_PREFIX}:{mode}:p:{rows[0][key_index]}"
+        ))
+    if rows and has_next:
+        navigation.append(InlineKeyboardButton(
+            text="بعدی ➡️", callback_data=f"{CALLBACK_PREFIX}:{mode}:n:{rows[-1][key_index]}"
+        ))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([
+        InlineKeyboardButton(text="🔍 جستجو", callback_data=SEARCH_CALLBACK),
+        InlineKeyboardButton(text="📥 خروجی CSV", callback_data=EXPORT_CALLBACK),
+    ])
+    if mode == "s":
+        keyboard.append([InlineKeyboardButton(text="👥 همه کاربران", callback_data=f"{CALLBACK_PREFIX}:b:n:")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+async def export_users_csv(db: Database, path: str) -> int:
+    """کل جدول users را chunk به chunk در یک فایل CSV فشرده می‌نویسد؛ حافظه مصرفی ثابت است"""
+    count = 0
+    f = await asyncio.to_thread(gzip.open, path, "wt", encoding="utf-8", newline="")
+    try:
+        writer = csv.writer(f)
+        await asyncio.to_thread(writer.writerow, EXPORT_COLUMNS)
+        async for rows in db.iter_user_export_chunks(EXPORT_CHUNK_SIZE):
+            await asyncio.to_thread(writer.writerows, rows)
+            count += len(rows)
+    finally:
+        await asyncio.to_thread(f.close)
+    return count
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import multiprocessing
+import secrets
+import signal
+from typing import NamedTuple
+from urllib.parse import urlsplit
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+
+class WebhookSettings(NamedTuple):
+    base_url: str
+    path: str
+    secret: str
+    host: str
+    port: int
+    workers: int
+
+
+def load_webhook_settings(config) -> WebhookSettings:
+    """تنظیمات webhook را از config.py می‌خواند؛ فایل‌های config قدیمی مقدار پیش‌فرض می‌گیرند
+
+    آدرس نامعتبر پیش از ساخت workerها خطا می‌دهد، نه هنگام set_webhook.
+    """
+    base_url = getattr(config, "WEBHOOK_BASE_URL", "").strip()
+    parts = urlsplit(base_url)
+    # تلگرام فقط به آدرس HTTPS آپدیت می‌فرستد
+    if parts.scheme != "https" or not parts.hostname:
+        raise ValueError(
+            f"WEBHOOK_BASE_URL must be an https:// URL such as https://bot.example.com, got {base_url!r}"
+        )
+    return WebhookSettings(
+        base_url=base_url,
+        path=getattr(config, "WEBHOOK_PATH", "/webhook"),
+        # توکن مخفی باید بین همه workerها یکسان باشد؛ پس قبل از ساخت آن‌ها تولید می‌شود
+        secret=getattr(config, "WEBHOOK_SECRET", "") or secrets.token_urlsafe(32),
+        host=getattr(config, "WEBHOOK_HOST", "127.0.0.1"),
+        port=getattr(config, "WEBHOOK_PORT", 8080),
+        workers=max(1, getattr(config, "WEBHOOK_WORKERS", 1)),
+    )
+
+
+async def serve_webhook(bot: Bot, dp: Dispatcher, settings: WebhookSettings, primary: bool = True):
+    """سرور aiohttp داخلی را تا دریافت SIGINT/SIGTERM اجرا می‌کند
+
+    پاسخ هندلرهایی که متد تلگرام را برمی‌گردانند (مثلاً ``return message.answer(...)``)
+    مستقیماً در پاسخ همین درخواست webhook ارسال می‌شود و یک درخواست خروجی کمتر لازم است؛
+    چنین پاسخی از OutboundScheduler و متریک‌های API عبور نمی‌کند و نتیجه‌اش معلوم نیست.
+    """
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=settings.secret,
+        handle_in_background=False,
+    ).register(app, path=settings.path)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # با چند worker همه روی یک پورت گوش می‌دهند و هسته سیستم‌عامل اتصال‌ها را پخش می‌کند
+    site = web.TCPSite(runner, settings.host, settings.port, reuse_port=settings.workers > 1)
+    await site.start()
+
+    if primary:
+        await bot.set_webhook(
+            url=settings.base_url.rstrip("/") + settings.path,
+            secret_token=settings.secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logging.info(f"Webhook registered at {settings.base_url.rstrip('/')}{settings.path}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        if primary:
+            await bot.delete_webhook()
+            logging.info("Webhook removed.")
+        # آپدیت‌های در حال پردازش تمام می‌شوند؛ نشست را main پس از تخلیه صف‌ها می‌بندد
+        await runner.cleanup()
+
+
+def run_webhook_workers(settings: WebhookSettings, run_worker):
+    """run_worker(index) را در settings.workers پردازه اجرا می‌کند؛ پردازه 0 پردازه اصلی است"""
+    if settings.workers == 1:
+        run_worker(0)
+        return
+
+    # fork قبل از ساخت حلقه asyncio انجام می‌شود تا وضعیت حلقه به فرزندان منتقل نشود
+    context = multiprocessing.get_context("fork")
+    children = [context.Process(target=run_worker, args=(index,), daemon=True) for index in range(1, settings.workers)]
+    for child in children:
+        child.start()
+    try:
+        run_worker(0)
+    finally:
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+            child.join()
@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import Counter
+
+from database import DAILY_STATS_EVENTS, Database
+from identity import LRUCache
+
+
+# --- تنظیمات نوشتن دسته‌ای ---
+FLUSH_WINDOW = 0.05           # حداکثر تأخیر یک نوشته تا commit
+MAX_BATCH_ROWS = 500          # با رسیدن به این تعداد ردیف زودتر commit می‌شود
+MESSAGE_ID_BLOCK = 100        # شناسه‌هایی که هر بار از sqlite_sequence برداشته می‌شود
+MAX_RETRY_DELAY = 30          # سقف فاصله تلاش دوباره پس از خطای گذرا (قفل، دیسک پر)
+STOP_FLUSH_TIMEOUT = 10       # stop تا این مدت برای نوشتن باقی‌مانده صف تلاش می‌کند
+REGISTER_DEDUPE_SECONDS = 600
+MAX_REGISTERED = 100_000
+
+
+class WriteBehind:
+    """نوشته‌های پرتکرار و کم‌اهمیت را جمع می‌کند و هر FLUSH_WINDOW ثانیه در یک تراکنش می‌نویسد
+
+    همان نام متدهای Database را دارد تا بتواند جای آن استفاده شود. پیام‌ها شناسه خود را
+    از یک بلوک از پیش رزروشده می‌گیرند، پس دکمه پاسخ پیش از commit ردیف ساخته می‌شود؛
+    sync_message پیش از خواندن چنین ردیفی صف را خالی می‌کند. در crash حداکثر نوشته‌های
+    یک پنجره از دست می‌رود؛ stop همه‌چیز را می‌نویسد. خطای گذرا (قفل، دیسک پر) دسته را با
+    فاصله رو به افزایش دوباره امتحان می‌کند؛ فقط اگر دسته قیدی (constraint) را نقض کند ردیف به
+    ردیف نوشته می‌شود و ردیف‌های ناقض کنار گذاشته و با on_dropped به ادمین گزارش می‌شوند.
+    """
+
+    def __init__(self, db: Database, window: float = FLUSH_WINDOW, max_rows: int = MAX_BATCH_ROWS,
+                 id_block: int = MESSAGE_ID_BLOCK, on_dropped=None):
+        self.db = db
+        self.on_dropped = on_dropped
+        self.window = window
+        self.max_rows = max_rows
+        self.id_block = id_block
+        self._users: dict[int, str] = {}
+        self._usernames: dict[int, str | None] = {}
+        self._messages: dict[int, tuple] = {}
+        self._delivered: set[int] = set()
+        self._events: Counter = Counter()
+        self._members: dict[tuple[str, int], tuple[bool, float]] = {}
+        self._flushing: set[int] = set()
+        # user_id -> (زمان آخرین نوشتن نام کاربری، همان نام)
+        self._registered = LRUCache(MAX_REGISTERED)
+        self._next_id = 0
+        self._block_end = 0
+        self._id_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._pending = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.deduped = 0
+        self.failures = 0
+        self.dropped = 0
+        self._unreported: list[str] = []
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STOP_FLUSH_TIMEOUT
+        while True:
+            try:
+                await self.flush()
+                return
+            except Exception as e:
+                if loop.time() >= deadline:
+                    logging.error(f"Write-behind stopped with {self._queued_rows()} rows unwritten: {e}")
+                    return
+                await asyncio.sleep(self._retry_delay())
+
+    # --- صف ---
+    def _queued_rows(self) -> int:
+        return (len(self._users) + len(self._usernames) + len(self._messages) + len(self._delivered)
+                + len(self._events) + len(self._members))
+
+    def _enqueued(self):
+        self._pending.set()
+        if self._queued_rows() >= self.max_rows:
+            self._full.set()
+
+    async def add_user(self, user_id: int, username: str | None, hashed_id: str):
+        # ردیف کاربر همیشه نوشته می‌شود، چون استارت دوباره کاربری را که ربات را بلاک کرده بود
+        # (شاید در worker دیگر یا پیام همگانی) فعال می‌کند؛ فقط نام کاربری تکراری کنار گذاشته می‌شود
+        self._users[user_id] = hashed_id
+        written = self._registered.get(user_id)
+        if written is not None and written[1] == username and time.monotonic() - written[0] < REGISTER_DEDUPE_SECONDS:
+            self.deduped += 1
+        else:
+            self._usernames[user_id] = username
+        self._enqueued()
+
+    async def update_username(self, user_id: int, username: str | None):
+        self._usernames[user_id] = username
+        self._enqueued()
+
+    async def mark_user_delivered(self, user_id: int):
+        self._delivered.add(user_id)
+        self._enqueued()
+
+    async def mark_user_blocked(self, user_id: int):
+        # بلاک فوراً نوشته می‌شود و نباید با یک تحویل قدیمی‌تر در صف بازنویسی شود
+        self._delivered.discard(user_id)
+        await self.db.mark_user_blocked(user_id)
+
+    async def record_daily_event(self, event: str):
+        if event not in DAILY_STATS_EVENTS:
+            raise ValueError(f"Unknown daily stats event: {event}")
+        self._events[event] += 1
+        self._enqueued()
+
+    async def set_channel_member(self, channel: str, user_id: int, is_member: bool):
+        # چند رویداد پشت سر هم برای یک جفت فقط آخرین وضعیت را می‌نویسند
+        self._members[(channel, user_id)] = (is_member, time.time())
+        self._enqueued()
+
+    async def allocate_message_id(self) -> int:
+        """شناسه ردیف پیام را بدون نوشتن در پایگاه داده برمی‌گرداند (جز یک بار در هر بلوک)"""
+        async with self._id_lock:
+            if self._next_id >= self._block_end:
+                self._next_id = await self.db.allocate_message_ids(self.id_block)
+                self._block_end = self._next_id + self.id_block
+            message_id = self._next_id
+            self._next_id += 1
+            return message_id
+
+    async def add_message(self, message_id: int, sender_hashed_id: str, recipient_hashed_id: str,
+                          telegram_message_id: int):
+        # created_at همان قالب UTC پیش‌فرض CURRENT_TIMESTAMP را دارد
+        created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        self._messages[message_id] = (message_id, sender_hashed_id, recipient_hashed_id, telegram_message_id, created_at)
+        self._enqueued()
+
+    async def sync_message(self, message_id: int):
+        """اگر ردیف پیام هنوز در صف است آن را پیش از خواندن commit می‌کند"""
+        if message_id in self._messages or message_id in self._flushing:
+            await self.flush()
+
+    # --- commit ---
+    def _requeue(self, users: dict, usernames: dict, messages: dict, delivered: set, events: Counter, members: dict):
+        # نوشته‌های جدیدتر همان کلید اولویت دارند
+        self._users = users | self._users
+        self._usernames = usernames | self._usernames
+        self._messages = messages | self._messages
+        self._delivered |= delivered
+        self._events.update(events)
+        self._members = members | self._members
+        self._pending.set()
+
+    async def flush(self):
+        try:
+            await self._flush()
+        finally:
+            if self._unreported:
+                dropped, self._unreported = self._unreported, []
+                await self._report_dropped(dropped)
+
+    async def _flush(self):
+        async with self._flush_lock:
+            if not self._queued_rows():
+                return
+            batch = (self._users, self._usernames, self._messages, self._delivered, self._events, self._members)
+            self._users, self._usernames, self._messages = {}, {}, {}
+            self._delivered, self._events, self._members = set(), Counter(), {}
+            users, usernames, messages, delivered, events, members = batch
+            self._flushing = set(messages)
+            try:
+                await self.db.write_batch(users, usernames, list(messages.values()), delivered, events, members)
+                self.rows_written += sum(map(len, batch))
+            except sqlite3.IntegrityError as e:
+                # خطای قید به خود ردیف‌ها برمی‌گردد و با تکرار برطرف نمی‌شود
+                logging.error(f"Write-behind batch violates a constraint ({e}); writing rows one by one")
+                await self._write_rows(batch)
+            except Exception:
+                self.failures += 1
+                self._requeue(*batch)
+                raise
+            finally:
+                self._flushing = set()
+            self.failures = 0
+            now = time.monotonic()
+            for user_id, username in usernames.items():
+                self._registered.put(user_id, (now, username))
+            self.flushes += 1
+
+    async def _write_rows(self, batch: tuple):
+        """هر ردیف در تراکنش خودش؛ ردیف ناقض قید کنار گذاشته و برای گزارش نگه داشته می‌شود"""
+        users, usernames, messages, delivered, events, members = batch
+        empty = ({}, {}, {}, set(), Counter(), {})
+
+        def row(index: int, value) -> tuple:
+            return tuple(value if i == index else kind for i, kind in enumerate(empty))
+
+        rows = (
+            [(f"user {user_id}", row(0, {user_id: hashed_id})) for user_id, hashed_id in users.items()]
+            + [(f"username of {user_id}", row(1, {user_id: username})) for user_id, username in usernames.items()]
+            + [(f"message {message_id}", row(2, {message_id: values})) for message_id, values in messages.items()]
+            + [(f"delivery to {user_id}", row(3, {user_id})) for user_id in delivered]
+            + [(f"{count} {event} events", row(4, Counter({event: count}))) for event, count in events.items()]
+            + [(f"membership {key}", row(5, {key: value})) for key, value in members.items()]
+        )
+        for position, (description, single) in enumerate(rows):
+            try:
+                await self.db.write_batch(single[0], single[1], list(single[2].values()), *single[3:])
+            except sqlite3.IntegrityError as e:
+                self.dropped += 1
+                self._unreported.append(description)
+                logging.error(f"Dropping write-behind row {description}: {e}")
+            except Exception:
+                # خطای گذرا: ردیف‌های نوشته‌نشده به صف برمی‌گردند
+                self.failures += 1
+                for _, remaining in rows[position:]:
+                    self._requeue(*remaining)
+                raise
+            else:
+                self.rows_written += 1
+
+    async def _report_dropped(self, dropped: list[str]):
+        if self.on_dropped is None:
+            return
+        try:
+            await self.on_dropped(dropped)
+        except Exception as e:
+            logging.error(f"Could not report dropped write-behind rows: {e}")
+
+    def _retry_delay(self) -> float:
+        return min(self.window * 2 ** min(self.failures, 16), MAX_RETRY_DELAY)
+
+    async def _run(self):
+        while True:
+            await self._pending.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            self._pending.clear()
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                delay = self._retry_delay()
+                logging.error(f"Write-behind flush failed {self.failures} times, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queued_rows(),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "deduped": self.deduped,
+            "dropped": self.dropped,
+        }